@@ -12,7 +12,8 @@ from django.utils.text import Truncator
 import optimizations
 
 from cms import permalinks, externals
-from cms.apps.media.models import Label, File
+from cms.apps.media.models import Label, File, PREVIEW_THUMBNAIL_SIZE
+from cms.thumbnails import get_thumbnail
 
 
 class LabelAdmin(admin.ModelAdmin):
@@ -153,13 +154,13 @@ class FileAdminBase(admin.ModelAdmin):
         permalink = permalinks.create(obj)
         if icon == IMAGE_FILE_ICON:
             try:
-                thumbnail = optimizations.get_thumbnail(obj.file, 100, 66)
+                thumbnail = get_thumbnail(obj.file, *PREVIEW_THUMBNAIL_SIZE)
             except IOError:
-                pass
-            else:
+                thumbnail = None
+            if thumbnail is not None:
                 return '<img cms:permalink="%s" src="%s" width="%s" height="%s" alt="" title="%s"/>' % (permalink, thumbnail.url, thumbnail.width, thumbnail.height, obj.title)
-        else:
-            icon = optimizations.get_url(icon)
+        # Use the icon as a placeholder while the thumbnail is being generated.
+        icon = optimizations.get_url(icon)
         return '<img cms:permalink="%s" src="%s" width="66" height="66" alt="" title="%s"/>' % (permalink, icon, obj.title)
     get_preview.short_description = "preview"
     get_preview.allow_tags = True
@@ -1,9 +1,14 @@
 """Models used by the static media management application."""
 
+import re
+
 from django.db import models
 from django.contrib import admin
 from django.contrib.admin.widgets import ForeignKeyRawIdWidget
 
+from cms.cache import bump_content_version
+from cms.thumbnails import generate_thumbnail
+
 
 class Label(models.Model):
     
@@ -53,6 +58,26 @@ class File(models.Model):
         ordering = ("title",)
 
 
+models.signals.post_save.connect(bump_content_version, sender=File)
+
+models.signals.post_delete.connect(bump_content_version, sender=File)
+
+
+# The size of the thumbnail used to preview images in the admin.
+PREVIEW_THUMBNAIL_SIZE = (100, 66)
+
+RE_IMAGE_NAME = re.compile(ur"\.(png|gif|jpg|jpeg)$", re.IGNORECASE)
+
+
+def generate_preview_thumbnail(sender, instance, raw=False, **kwargs):
+    """Queues the preview thumbnail of an image for generation when it is saved."""
+    if not raw and instance.file and RE_IMAGE_NAME.search(instance.file.name):
+        generate_thumbnail(instance.file, *PREVIEW_THUMBNAIL_SIZE)
+
+
+models.signals.post_save.connect(generate_preview_thumbnail, sender=File)
+
+
 class FileRefField(models.ForeignKey):
     
     """A foreign key to a File, constrained to only select image files."""
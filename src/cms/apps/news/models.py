@@ -3,11 +3,13 @@
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
-from django.db import models
+from django.db import models, connection
+from django.db.models import Q
 
-from cms import sitemaps, externals
+from cms import sitemaps, externals, publication
+from cms.cache import bump_content_version
 from cms.apps.media.models import ImageRefField
-from cms.apps.pages.models import ContentBase, Page
+from cms.apps.pages.models import ContentBase, Page, PAGE_TREE_VERSION
 from cms.models import PageBase, OnlineBaseManager, HtmlField, PageBaseSearchAdapter
 
 
@@ -25,7 +27,8 @@ class NewsFeed(ContentBase):
     
     content_primary = HtmlField(
         "primary content",
-        blank = True
+        blank = True,
+        precompute = True,
     )
     
     per_page = models.IntegerField(
@@ -99,6 +102,11 @@ class CategoryHistoryLinkAdapter(externals.historylinks.HistoryLinkAdapter):
 externals.historylinks("register", Category, CategoryHistoryLinkAdapter)
 
 
+models.signals.post_save.connect(bump_content_version, sender=Category)
+
+models.signals.post_delete.connect(bump_content_version, sender=Category)
+
+
 class ArticleManager(OnlineBaseManager):
     
     """Manager for Article models."""
@@ -109,6 +117,40 @@ class ArticleManager(OnlineBaseManager):
             date__lte = timezone.now(),
         )
         return queryset
+    
+    def get_neighbours(self, article):
+        """
+        Returns a tuple of the articles immediately before and after the given
+        article in its news feed, or None where there is no such article.
+        
+        Articles are ordered by date and then id, so articles sharing a date
+        are neither skipped nor repeated. Only the fields needed to link to the
+        articles are loaded, and both articles are fetched in a single query,
+        except on MySQL.
+        """
+        queryset = self.get_query_set().filter(
+            news_feed = article.news_feed_id,
+        ).only("news_feed", "date", "url_title", "title")
+        before = queryset.filter(
+            Q(date__lt=article.date) | Q(date=article.date, id__lt=article.id),
+        ).order_by("-date", "-id")[:1]
+        after = queryset.filter(
+            Q(date__gt=article.date) | Q(date=article.date, id__gt=article.id),
+        ).order_by("date", "id")[:1]
+        if connection.vendor == "mysql":
+            # MySQL doesn't support LIMIT in IN subqueries, so fetch each article separately.
+            neighbours = list(before) + list(after)
+        else:
+            neighbours = queryset.filter(
+                Q(id__in=before.values("id")) | Q(id__in=after.values("id")),
+            ).order_by()
+        before_article = after_article = None
+        for neighbour in neighbours:
+            if (neighbour.date, neighbour.id) < (article.date, article.id):
+                before_article = neighbour
+            else:
+                after_article = neighbour
+        return before_article, after_article
 
 
 class Article(PageBase):
@@ -127,6 +169,12 @@ class Article(PageBase):
         default = timezone.now,
     )
     
+    last_modified = models.DateTimeField(
+        auto_now = True,
+        editable = False,
+        help_text = "The time that this article was last changed.",
+    )
+    
     image = ImageRefField(
         blank = True,
         null = True,
@@ -134,10 +182,12 @@ class Article(PageBase):
     
     content = HtmlField(
         blank = True,
+        precompute = True,
     )
     
     summary = HtmlField(
         blank = True,
+        precompute = True,
     )
     
     categories = models.ManyToManyField(
@@ -163,6 +213,10 @@ class Article(PageBase):
         """Returns the URL of the article."""
         return self._get_permalink_for_page(self.news_feed.page)
     
+    def get_cache_dependencies(self):
+        """Returns the version counters that the URL of the article depends on."""
+        return (PAGE_TREE_VERSION,)
+    
     class Meta:
         unique_together = (("news_feed", "date", "url_title",),)
         ordering = ("-date",)
@@ -171,7 +225,44 @@ class Article(PageBase):
 externals.historylinks("register", Article)
 
 
-sitemaps.register(Article)
+class ArticleSitemap(sitemaps.PageBaseSitemap):
+    
+    """Sitemap for news articles."""
+    
+    model = Article
+    
+    def get_fields(self):
+        """Only loads the fields used for the sitemap."""
+        return ("news_feed", "date", "url_title", "sitemap_changefreq", "sitemap_priority", "last_modified",)
+    
+    def get_models(self):
+        """Article URLs depend on the page of their news feed."""
+        return (Article, Page,)
+    
+    def get_locations(self, items):
+        """
+        Returns the URLs of the given articles, using a single query to load
+        their news feed pages.
+        
+        Articles in unpublished news feeds are excluded.
+        """
+        pages = Page.objects.only("path", "content_type").in_bulk(set(item.news_feed_id for item in items))
+        return [
+            item._get_permalink_for_page(pages[item.news_feed_id]) if item.news_feed_id in pages else None
+            for item
+            in items
+        ]
+
+
+sitemaps.register(Article, sitemap_cls=ArticleSitemap)
+
+
+publication.register(Article, ("date",))
+
+
+models.signals.post_save.connect(bump_content_version, sender=Article)
+
+models.signals.post_delete.connect(bump_content_version, sender=Article)
 
 
 externals.watson("register", Article, adapter_cls=PageBaseSearchAdapter)
\ No newline at end of file
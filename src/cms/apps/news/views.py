@@ -1,17 +1,21 @@
 """Views used by the CMS news app."""
 
+from django.conf import settings
+from django.core.paginator import InvalidPage
 from django.views import generic
 from django.views.generic.list import BaseListView
 from django.shortcuts import get_object_or_404
 from django.utils.feedgenerator import DefaultFeed
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 
 from cms.views import PageDetailMixin
+from cms.apps.pages.views import PageConditionalMixin
 from cms.apps.news.models import Article, Category
-from cms.html import process as process_html
+from cms.html import process_cached as process_html
+from cms.pagination import CursorPaginator
 
 
-class ArticleListMixin(object):
+class ArticleListMixin(PageConditionalMixin):
     
     """Base class for every view that handles articles."""
     
@@ -29,6 +33,24 @@ class ArticleListMixin(object):
         """Returns the number of articles to show per page."""
         return self.request.pages.current.content.per_page
     
+    def get_cursor_pagination(self):
+        """
+        Checks whether articles are paginated using cursors, rather than page
+        numbers.
+        """
+        return getattr(settings, "NEWS_CURSOR_PAGINATION", False)
+    
+    def paginate_queryset(self, queryset, page_size):
+        """Paginates the articles using cursors, if enabled."""
+        if not self.get_cursor_pagination():
+            return super(ArticleListMixin, self).paginate_queryset(queryset, page_size)
+        paginator = CursorPaginator(queryset, page_size, ordering=("-date", "-id",))
+        try:
+            page = paginator.page(self.request.GET.get(self.page_kwarg))
+        except InvalidPage:
+            raise Http404("There are no articles on that page.")
+        return (paginator, page, page.object_list, page.has_other_pages())
+    
     def get_context_data(self, **kwargs):
         """Returns the context data for the view."""
         context = super(ArticleListMixin, self).get_context_data(**kwargs)
@@ -45,7 +67,7 @@ class ArticleListMixin(object):
             "authors",
         ).select_related("image").filter(
             news_feed__page = self.request.pages.current,
-        ).order_by("-date")
+        ).order_by("-date", "-id")
 
 
 class ArticleArchiveView(ArticleListMixin, generic.ArchiveIndexView):
@@ -104,21 +126,9 @@ class ArticleDetailView(ArticleListMixin, PageDetailMixin, generic.DateDetailVie
     def get_context_data(self, **kwargs):
         """Adds the next and previous articles to the context."""
         context = super(ArticleDetailView, self).get_context_data(**kwargs)
-        # Get the next article.
-        try:
-            next_article = self.get_queryset().filter(
-                date__lt = self.object.date,
-            )[0]
-        except IndexError:
-            next_article = None
+        # Get the next and previous articles, in reverse date order.
+        next_article, prev_article = Article.objects.get_neighbours(self.object)
         context["next_article"] = next_article
-        # Get the previous article.
-        try:
-            prev_article = self.get_queryset().reverse().filter(
-                date__gt = self.object.date,
-            )[0]
-        except IndexError:
-            prev_article = None
         context["prev_article"] = prev_article
         # All done!
         return context
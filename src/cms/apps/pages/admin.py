@@ -24,7 +24,8 @@ from django import forms
 
 from cms import debug, externals
 from cms.admin import PageBaseAdmin
-from cms.apps.pages.models import Page, get_registered_content, PageSearchAdapter
+from cms.cache import bump_version
+from cms.apps.pages.models import Page, get_registered_content, PageSearchAdapter, PAGE_TREE_VERSION, lock_page_tree
 
 
 # Used to track references to and from the JS sitemap.
@@ -242,6 +243,22 @@ class PageAdmin(PageBaseAdmin):
 
         obj.content = content_obj
 
+    # Custom admin actions.
+
+    def publish_selected(self, request, queryset):
+        """Publishes the selected pages."""
+        page_ids = list(queryset.values_list("id", flat=True))
+        super(PageAdmin, self).publish_selected(request, queryset)
+        Page.objects.update_publication(page_ids)
+    publish_selected.short_description = PageBaseAdmin.publish_selected.short_description
+
+    def unpublish_selected(self, request, queryset):
+        """Unpublishes the selected pages."""
+        page_ids = list(queryset.values_list("id", flat=True))
+        super(PageAdmin, self).unpublish_selected(request, queryset)
+        Page.objects.update_publication(page_ids)
+    unpublish_selected.short_description = PageBaseAdmin.unpublish_selected.short_description
+
     # Permissions.
 
     def has_add_content_permission(self, request, model):
@@ -418,18 +435,12 @@ class PageAdmin(PageBaseAdmin):
         # Check that the user has permission to move pages.
         if not self.has_change_permission(request):
             return HttpResponseForbidden("You do not have permission to move this page.")
-        # Lock entire table.
-        existing_pages_list = Page.objects.all().select_for_update().values("id", "parent_id", "left", "right", "title").order_by("left")
-        existing_pages = dict(
-            (page["id"], page)
-            for page
-            in existing_pages_list
-        )
-        # Get the page.
-        page = existing_pages[int(request.POST["page"])]
-        parent_id = page["parent_id"]
-        # Get all the siblings.
-        siblings = [s for s in existing_pages_list if s["parent_id"] == parent_id]
+        # Lock the page tree, and load the page and its siblings.
+        lock_page_tree()
+        page = Page.objects.values("id", "parent_id").get(id=int(request.POST["page"]))
+        siblings = list(Page.objects.filter(
+            parent = page["parent_id"],
+        ).values("id", "parent_id", "left", "right").order_by("left"))
         # Find the page to swap.
         direction = request.POST["direction"]
         if direction == "up":
@@ -441,6 +452,7 @@ class PageAdmin(PageBaseAdmin):
         sibling_iter = iter(siblings)
         for sibling in sibling_iter:
             if sibling["id"] == page["id"]:
+                page = sibling
                 break
         try:
             other_page = next(sibling_iter)
@@ -453,18 +465,19 @@ class PageAdmin(PageBaseAdmin):
             left = F("left") * -1,
             right = F("right") * -1,
         )
-        # Move the other page.
-        branch_width = first_page["right"] - first_page["left"] + 1
+        # Move the other page into the position of the first page. This also works with gapped numbering.
+        first_offset = second_page["left"] - first_page["left"]
         Page.objects.filter(left__gte=second_page["left"], right__lte=second_page["right"]).update(
-            left = F("left") - branch_width,
-            right = F("right") - branch_width,
+            left = F("left") - first_offset,
+            right = F("right") - first_offset,
         )
         # Put the page back in.
-        second_branch_width = second_page["right"] - second_page["left"] + 1
+        second_offset = second_page["right"] - first_page["right"]
         Page.objects.filter(left__lte=-first_page["left"], right__gte=-first_page["right"]).update(
-            left = (F("left") - second_branch_width) * -1,
-            right = (F("right") - second_branch_width) * -1,
+            left = (F("left") - second_offset) * -1,
+            right = (F("right") - second_offset) * -1,
         )
+        bump_version(PAGE_TREE_VERSION)
         # Report back.
         return HttpResponse("Page #%s was moved %s." % (page["id"], direction))
 
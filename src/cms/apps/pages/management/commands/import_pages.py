@@ -0,0 +1,256 @@
+"""Imports a tree of pages from a JSON or CSV file."""
+
+from __future__ import with_statement
+
+import codecs, csv, json, os
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from cms.apps.pages.models import Page, get_default_page_parent
+
+
+def create_instance(model, data):
+    """Creates an unsaved model instance from the given field data."""
+    field_values = {}
+    for name, value in data.iteritems():
+        field = model._meta.get_field(name)
+        if value == "" and field.null:
+            value = None
+        else:
+            value = field.to_python(value)
+        field_values[field.attname] = value
+    return model(**field_values)
+
+
+def get_content_type(value):
+    """Returns the content type for the given app_label.model string."""
+    try:
+        app_label, model = value.lower().split(".")
+        return ContentType.objects.get_by_natural_key(app_label, model)
+    except (ValueError, ContentType.DoesNotExist):
+        raise CommandError("{value!r} is not a valid content type.".format(value=value))
+
+
+def create_branch(page_data, content_data, children):
+    """Creates a branch suitable for Page.objects.bulk_insert_tree()."""
+    try:
+        content_type = get_content_type(page_data.pop("content_type"))
+    except KeyError:
+        raise CommandError("Every page must have a content_type.")
+    page = create_instance(Page, page_data)
+    page.content_type = content_type
+    content = create_instance(content_type.model_class(), content_data)
+    return (page, content, children)
+
+
+def count_branch(branch):
+    """Returns the number of pages in the given branch."""
+    return 1 + sum(count_branch(child) for child in branch[2])
+
+
+def iter_json_items(input_file, read_size=65536):
+    """
+    Yields each item of a top-level JSON array, reading the file
+    incrementally. If the file contains a single object, then it is yielded on
+    its own.
+    """
+    reader = codecs.getreader("utf-8")(input_file)
+    decoder = json.JSONDecoder()
+    buffer = u""
+    position = 0
+    eof = False
+    in_array = None
+    while True:
+        # Skip whitespace, and the separators between array items.
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or (in_array and buffer[position] == u",")):
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            data = reader.read(read_size)
+            buffer, position, eof = buffer[position:] + data, 0, not data
+        if position >= len(buffer):
+            if in_array:
+                raise CommandError("The JSON file ends unexpectedly.")
+            return
+        if in_array is None:
+            in_array = buffer[position] == u"["
+            if in_array:
+                position += 1
+                continue
+        elif in_array and buffer[position] == u"]":
+            return
+        # Decode the next item, reading more of the file until it is complete.
+        while True:
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+                break
+            except ValueError:
+                if eof:
+                    raise CommandError("The JSON file is not valid.")
+                # Read at least as much again, so that large items are decoded in linear time.
+                data = reader.read(max(read_size, len(buffer) - position))
+                buffer, position, eof = buffer[position:] + data, 0, not data
+        yield item
+        if not in_array:
+            return
+
+
+def read_json(input_file, batch_size=500):
+    """
+    Reads branches from a JSON file, yielding (parent_id, branches) tuples
+    containing roughly batch_size pages at a time.
+    
+    The file should contain a list of pages. Each page is an object containing
+    page fields, a content_type in the form "app_label.model", an optional
+    content object of content fields, and an optional list of children. The
+    file is parsed one top-level page at a time, so the whole file is never
+    loaded into memory. A parent_id of None means the import parent.
+    """
+    def do_read_json(page_data):
+        content_data = page_data.pop("content", {})
+        children = [do_read_json(child_data) for child_data in page_data.pop("children", ())]
+        return create_branch(page_data, content_data, children)
+    branches = []
+    count = 0
+    for page_data in iter_json_items(input_file):
+        branch = do_read_json(page_data)
+        branches.append(branch)
+        count += count_branch(branch)
+        if count >= batch_size:
+            yield None, branches
+            branches = []
+            count = 0
+    if branches:
+        yield None, branches
+
+
+def read_csv(input_file, batch_size=500):
+    """
+    Reads branches from a CSV file, yielding (parent_id, branches) tuples
+    containing roughly batch_size pages at a time.
+    
+    The file should have a header row. The path column contains the URL path
+    of the page, relative to the import parent. The parent of every page must
+    appear before it in the file. The content_type column should be in the form
+    "app_label.model", and content fields should be prefixed with "content.".
+    
+    Each batch must be inserted before reading continues, as pages in later
+    batches are placed beneath the saved pages of earlier ones. A parent_id of
+    None means the import parent.
+    """
+    reader = csv.reader(input_file)
+    try:
+        header = [name.decode("utf-8") for name in next(reader)]
+    except StopIteration:
+        return
+    if not "path" in header:
+        raise CommandError("The CSV file must contain a path column.")
+    # The ids of pages in previous batches, indexed by path.
+    page_ids = {}
+    # The pages of the current batch, indexed by path.
+    pages = {}
+    children = {}
+    # The branches of the current batch, grouped by the id of their parent.
+    groups = []
+    group_branches = {}
+    for row in reader:
+        page_data = {}
+        content_data = {}
+        for name, value in zip(header, row):
+            value = value.decode("utf-8")
+            if name.startswith(u"content."):
+                content_data[name[8:]] = value
+            else:
+                page_data[name] = value
+        slugs = [slug for slug in page_data.pop("path").split(u"/") if slug]
+        page_data["url_title"] = slugs[-1] if slugs else u""
+        branch = create_branch(page_data, content_data, [])
+        # Add the branch to its parent.
+        path = u"/".join(slugs)
+        parent_path = u"/".join(slugs[:-1])
+        if parent_path in children:
+            children[parent_path].append(branch)
+        else:
+            if parent_path in page_ids:
+                parent_id = page_ids[parent_path]
+            elif not parent_path and not path in children and not path in page_ids:
+                parent_id = None
+            else:
+                raise CommandError("The parent of {path!r} must appear before it in the file.".format(path=path))
+            if not parent_id in group_branches:
+                groups.append(parent_id)
+                group_branches[parent_id] = []
+            group_branches[parent_id].append(branch)
+        pages[path] = branch[0]
+        children[path] = branch[2]
+        if len(pages) >= batch_size:
+            for parent_id in groups:
+                yield parent_id, group_branches[parent_id]
+            # The pages have now been inserted, so their ids are known.
+            for page_path, page in pages.iteritems():
+                page_ids[page_path] = page.id
+            pages = {}
+            children = {}
+            groups = []
+            group_branches = {}
+    for parent_id in groups:
+        yield parent_id, group_branches[parent_id]
+
+
+class Command(BaseCommand):
+    
+    help = "Imports a tree of pages from a JSON or CSV file."
+    
+    args = "file"
+    
+    option_list = BaseCommand.option_list + (
+        make_option("--format",
+            choices = ("json", "csv"),
+            help = "The format of the file, either json or csv. Defaults to the file extension.",
+        ),
+        make_option("--parent",
+            help = "The URL path of the page to import beneath. Defaults to the homepage, if one exists.",
+        ),
+        make_option("--batch-size",
+            type = "int",
+            default = 500,
+            help = "The number of rows to insert at a time.",
+        ),
+    )
+    
+    def handle(self, *args, **options):
+        """Runs the command."""
+        if len(args) != 1:
+            raise CommandError("Please specify a file to import.")
+        filename = args[0]
+        file_format = options["format"] or os.path.splitext(filename)[1][1:].lower()
+        if file_format == "json":
+            read_branches = read_json
+        elif file_format == "csv":
+            read_branches = read_csv
+        else:
+            raise CommandError("Unknown file format {file_format!r}.".format(file_format=file_format))
+        # Find the import parent.
+        parent_path = options["parent"]
+        if parent_path is None:
+            parent = get_default_page_parent()
+        else:
+            slugs = [slug for slug in parent_path.split(u"/") if slug]
+            try:
+                parent = Page._base_manager.get(path=u"".join(slug + u"/" for slug in slugs))
+            except Page.DoesNotExist:
+                raise CommandError("There is no page at {path!r}.".format(path=parent_path))
+        # Import the pages, one batch at a time.
+        count = 0
+        with open(filename, "rb") as input_file, transaction.atomic():
+            for parent_id, branches in read_branches(input_file, options["batch_size"]):
+                if parent_id is None:
+                    branch_parent = parent
+                else:
+                    branch_parent = Page._base_manager.get(id=parent_id)
+                count += len(Page.objects.bulk_insert_tree(branches, parent=branch_parent, batch_size=options["batch_size"]))
+        self.stdout.write("Imported {count} pages.".format(count=count))
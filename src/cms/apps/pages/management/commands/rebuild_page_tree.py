@@ -0,0 +1,42 @@
+"""Rebuilds the left, right, path and effective publication values of the page tree."""
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from cms.apps.pages.models import Page, PageTreeError
+
+
+class Command(NoArgsCommand):
+    
+    help = "Rebuilds the left, right, path and effective publication values of the page tree from the parent of each page."
+    
+    option_list = NoArgsCommand.option_list + (
+        make_option("--check",
+            action = "store_true",
+            default = False,
+            help = "Only report pages with incorrect values, without changing anything.",
+        ),
+        make_option("--batch-size",
+            type = "int",
+            default = 500,
+            help = "The number of pages to update at a time.",
+        ),
+    )
+    
+    def handle_noargs(self, **options):
+        """Runs the command."""
+        check = options["check"]
+        try:
+            page_ids = Page.objects.rebuild_tree(check=check, batch_size=options["batch_size"])
+        except PageTreeError as ex:
+            raise CommandError(str(ex))
+        if check:
+            if page_ids:
+                raise CommandError("The page tree is corrupt. {count} pages have incorrect values: {page_ids}".format(
+                    count = len(page_ids),
+                    page_ids = ", ".join(str(page_id) for page_id in page_ids),
+                ))
+            self.stdout.write("The page tree is valid.")
+        else:
+            self.stdout.write("Updated {count} pages.".format(count=len(page_ids)))
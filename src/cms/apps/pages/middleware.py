@@ -1,17 +1,26 @@
 """Custom middleware used by the pages application."""
 
-import sys
+from __future__ import with_statement
+
+import sys, hashlib
 
 from django.conf import settings
 from django.core import urlresolvers
+from django.core.cache import cache
 from django.core.handlers.base import BaseHandler
 from django.http import Http404
 from django.views.debug import technical_404_response
 from django.shortcuts import redirect
+from django.utils.cache import cc_delim_re
 from django.utils.functional import cached_property
 from django.template.response import SimpleTemplateResponse
 
-from cms.apps.pages.models import Page
+from cms.cache import get_version, CONTENT_VERSION
+from cms.models import publication_manager
+from cms.publication import get_publication_epoch, get_transition_timeout
+from cms.timing import stage, timed
+from cms.apps.pages.models import Page, PAGE_TREE_VERSION
+from cms.apps.pages.tree import is_tree_snapshot_enabled, get_page_tree, PageTreeLoader
 
 
 class RequestPageManager(object):
@@ -24,8 +33,18 @@ class RequestPageManager(object):
         self._path_info = path_info
         
     @cached_property
+    def _tree_loader(self):
+        """Loads pages from the page tree snapshot, or None if snapshots are disabled."""
+        if is_tree_snapshot_enabled():
+            return PageTreeLoader(get_page_tree(), publication_manager.select_published_active())
+        return None
+        
+    @cached_property
+    @timed("page_tree")
     def homepage(self):
         """Returns the site homepage."""
+        if self._tree_loader is not None:
+            return self._tree_loader.homepage
         try:
             return Page.objects.get_homepage()
         except Page.DoesNotExist:
@@ -37,21 +56,33 @@ class RequestPageManager(object):
         return self._path == self.homepage.get_absolute_url()
     
     @cached_property
+    @timed("page_tree")
     def breadcrumbs(self):
         """The breadcrumbs for the current request."""
-        breadcrumbs = []
+        homepage = self.homepage
+        if homepage is None:
+            return []
+        # Generate the paths of all pages that could match the request.
         slugs = self._path_info.strip("/").split("/")
-        slugs.reverse()
-        def do_breadcrumbs(page):
-            breadcrumbs.append(page)
-            if slugs:
-                slug = slugs.pop()
-                for child in page.children:
-                    if child.url_title == slug:
-                        do_breadcrumbs(child)
-                        break
-        if self.homepage:
-            do_breadcrumbs(self.homepage)
+        paths = [
+            u"".join(slug + u"/" for slug in slugs[:index])
+            for index in xrange(1, len(slugs) + 1)
+        ]
+        # Load all matching pages in one go.
+        if self._tree_loader is not None:
+            pages = self._tree_loader.get_pages_by_path(paths)
+        else:
+            pages = Page.objects.filter(path__in=paths).order_by("left")
+        # Link the pages together, re-using any prefetched pages.
+        breadcrumbs = [homepage]
+        for page in pages:
+            parent = breadcrumbs[-1]
+            if page.parent_id == parent.id:
+                if "child_set" in getattr(parent, "_prefetched_objects_cache", ()):
+                    page = next((child for child in parent.children if child.id == page.id), page)
+                else:
+                    page.parent = parent
+                breadcrumbs.append(page)
         return breadcrumbs
     
     @property
@@ -84,17 +115,143 @@ class RequestPageManager(object):
         return self.current.get_absolute_url() == self._path
 
 
+# The maximum number of resolved paths to remember.
+MAX_RESOLVED_PATHS = 1000
+
+# Resolved paths, keyed by (urlconf, path_info). Unmatched paths are stored as None.
+_resolved_paths = {}
+
+
+@timed("page_resolve")
+def resolve_page_path(path_info, urlconf):
+    """
+    Resolves the given path using the given page content urlconf.
+    
+    Returns a ResolverMatch, or None if the path could not be resolved. Results
+    are remembered, so repeated requests for the same path only need a single
+    dictionary lookup.
+    """
+    key = (urlconf, path_info)
+    try:
+        return _resolved_paths[key]
+    except KeyError:
+        pass
+    try:
+        match = urlresolvers.resolve(path_info, urlconf)
+    except urlresolvers.Resolver404:
+        match = None
+    if len(_resolved_paths) >= MAX_RESOLVED_PATHS:
+        _resolved_paths.clear()
+    _resolved_paths[key] = match
+    return match
+
+
+def get_response_cache_timeout():
+    """
+    Returns the maximum number of seconds that page responses are cached for.
+    
+    If this is zero, then page responses are not cached.
+    """
+    return getattr(settings, "PAGES_RESPONSE_CACHE_TIMEOUT", 0)
+
+
 class PageMiddleware(object):
     
     """Serves up pages when no other view is matched."""
     
+    def get_response_cache_key(self, request):
+        """
+        Returns the key used to cache the page response for the given request,
+        or None if the response should not be cached.
+        
+        Responses are only cached for anonymous GET requests for pages outside
+        of preview mode. The key changes whenever the page tree or any content
+        changes, and whenever a publication transition passes.
+        """
+        if not get_response_cache_timeout() or request.method not in ("GET", "HEAD"):
+            return None
+        # Never cache unpublished content.
+        if not publication_manager.select_published_active():
+            return None
+        # Logged in users may see personalized content, so never cache for them.
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated():
+            return None
+        # Only page views are cached, so don't look up requests that are handled by the project urlconf.
+        if not getattr(settings, "PAGES_DISPATCH_FIRST", False) and resolve_page_path(request.path_info, getattr(request, "urlconf", settings.ROOT_URLCONF)) is not None:
+            return None
+        if request.pages.current is None:
+            return None
+        return u"cms.pages.response.{url_hash}.{tree_version}.{content_version}.{publication_epoch}".format(
+            url_hash = hashlib.md5(request.build_absolute_uri().encode("utf-8")).hexdigest(),
+            tree_version = get_version(PAGE_TREE_VERSION),
+            content_version = get_version(CONTENT_VERSION),
+            publication_epoch = get_publication_epoch(),
+        )
+        
+    def cache_response(self, request, response):
+        """Caches the given page response, if possible."""
+        cache_key = getattr(request, "_page_response_cache_key", None)
+        if cache_key is None or request.method != "GET":
+            return
+        # Only cache successful responses that are the same for every visitor.
+        if response.status_code != 200 or response.streaming or response.cookies:
+            return
+        if request.META.get("CSRF_COOKIE_USED"):
+            return  # The response contains a CSRF token for this visitor.
+        cache_control = response.get("Cache-Control", "").lower()
+        if "private" in cache_control or "no-cache" in cache_control or "no-store" in cache_control:
+            return
+        # The cache key ignores request headers, so the response can only vary on the cookie of an anonymous user.
+        vary_headers = set(header.strip().lower() for header in cc_delim_re.split(response.get("Vary", "")))
+        if vary_headers - set(("", "cookie")):
+            return
+        timeout = get_transition_timeout(get_response_cache_timeout())
+        if timeout:
+            cache.set(cache_key, response, timeout)
+    
+    def call_page_view(self, request, match):
+        """Calls the page view from the given ResolverMatch, returning a rendered response."""
+        callback, callback_args, callback_kwargs = match
+        with stage("page_view"):
+            response = callback(request, *callback_args, **callback_kwargs)
+        # Validate the response.
+        if not response:
+            raise ValueError, "The view {0!r} didn't return an HttpResponse object.".format(callback.__name__)
+        if isinstance(response, SimpleTemplateResponse):
+            with stage("render"):
+                response = response.render()
+        self.cache_response(request, response)
+        return response
+    
     def process_request(self, request):
-        """Annotates the request with a page manager."""
+        """
+        Annotates the request with a page manager, and serves cached page
+        responses.
+        
+        If PAGES_DISPATCH_FIRST is set, then any request that matches a view
+        of the current page content is dispatched straight away, without first
+        trying the project urlconf.
+        """
         request.pages = RequestPageManager(request.path, request.path_info)
+        cache_key = request._page_response_cache_key = self.get_response_cache_key(request)
+        if cache_key is not None:
+            response = cache.get(cache_key)
+            if response is not None:
+                return response
+        if getattr(settings, "PAGES_DISPATCH_FIRST", False):
+            page = request.pages.current
+            if page is not None:
+                match = resolve_page_path(request.path[len(page.get_absolute_url()) - 1:], page.content_cls.urlconf)
+                if match is not None:
+                    # Exceptions are handled by the normal Django mechanisms, so make sure
+                    # that a 404 from the page view isn't dispatched to the page again.
+                    request._page_dispatched = True
+                    return self.call_page_view(request, match)
             
     def process_response(self, request, response):
         """If the response was a 404, attempt to serve up a page."""
-        if response.status_code != 404:
+        if response.status_code != 404 or getattr(request, "_page_dispatched", False):
             return response
         # Get the current page.
         page = request.pages.current
@@ -104,30 +261,20 @@ class PageMiddleware(object):
         path_info = request.path[len(script_name):]
         # Dispatch to the content.
         try:
-            try:
-                callback, callback_args, callback_kwargs = urlresolvers.resolve(path_info, page.content.urlconf)
-            except urlresolvers.Resolver404:
+            urlconf = page.content_cls.urlconf  # Optimization - don't load the content just to find the urlconf.
+            match = resolve_page_path(path_info, urlconf)
+            if match is None:
                 # First of all see if adding a slash will help matters.
                 if settings.APPEND_SLASH:
                     new_path_info = path_info + "/"
-                    try:
-                        urlresolvers.resolve(new_path_info, page.content.urlconf)
-                    except urlresolvers.Resolver404:
-                        pass
-                    else:
+                    if resolve_page_path(new_path_info, urlconf) is not None:
                         return redirect(script_name + new_path_info)
                 return response
-            response = callback(request, *callback_args, **callback_kwargs)
-            # Validate the response.
-            if not response:
-                raise ValueError, "The view {0!r} didn't return an HttpResponse object.".format(callback.__name__)
-            if isinstance(response, SimpleTemplateResponse):
-                return response.render()
-            return response
+            return self.call_page_view(request, match)
         except Http404, ex:
             if settings.DEBUG:
                 return technical_404_response(request, ex)
             # Let the normal 404 mechanisms render an error page.
             return response
         except:
-            return BaseHandler().handle_uncaught_exception(request, urlresolvers.get_resolver(None), sys.exc_info())
\ No newline at end of file
+            return BaseHandler().handle_uncaught_exception(request, urlresolvers.get_resolver(None), sys.exc_info())
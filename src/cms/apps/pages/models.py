@@ -1,15 +1,360 @@
 """Core models used by the CMS."""
 
+import operator
+from itertools import islice
+
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core import urlresolvers
-from django.db import models, connection
-from django.db.models import Q, F
+from django.db import models, connection, transaction, router
+from django.db.models import Q, F, Max
+from django.db.models.query import QuerySet
 from django.utils.functional import cached_property
 from django.utils import timezone
 
-from cms import sitemaps, externals
+from cms import sitemaps, externals, publication, permalinks
+from cms.cache import bump_version, has_object_versions, CONTENT_VERSION
+from cms.html import schedule_rerender
 from cms.models import PageBase, OnlineBaseManager, PageBaseSearchAdapter
 from cms.models.managers import publication_manager
+from cms.timing import timed
+
+
+# The name of the version counter that changes whenever the page tree changes.
+PAGE_TREE_VERSION = "pages.tree"
+
+
+# The largest left or right value that can be stored in the database.
+MAX_TREE_VALUE = 2147483647
+
+# The smallest spacing between left and right values left after a rebalance.
+MIN_REBALANCE_SPACING = 4
+
+
+def get_tree_stride():
+    """
+    Returns the spacing between left and right values of newly placed pages.
+    
+    If this is zero, then the tree is numbered without gaps, and every insert
+    shifts all pages to the right of the change. Otherwise, new pages are
+    placed into the gaps between existing pages, and only a local part of the
+    tree is renumbered when a gap is full.
+    """
+    return getattr(settings, "PAGES_TREE_STRIDE", 0)
+
+
+# An arbitrary key used to identify the page tree advisory lock.
+PAGE_TREE_LOCK_ID = 0x70616765
+
+
+def lock_page_tree():
+    """
+    Locks the page tree against modification by any other transaction until
+    the current transaction ends.
+    
+    On PostgreSQL, this takes a transaction-level advisory lock. On other
+    databases, the root pages are selected for update, which serializes all
+    tree changes without reading the rest of the table.
+    """
+    if connection.vendor == "postgresql":
+        connection.cursor().execute("SELECT pg_advisory_xact_lock(%s)", (PAGE_TREE_LOCK_ID,))
+    else:
+        list(Page._base_manager.filter(parent=None).select_for_update().values_list("id", flat=True))
+
+
+def iter_tree_tokens(rows):
+    """
+    Yields a (page_id, is_left) token for every left and right value in the
+    given rows, in tree order.
+    
+    The rows should be (page_id, left, right) tuples, ordered by left.
+    """
+    stack = []
+    for page_id, left, right in rows:
+        while stack and stack[-1][1] < left:
+            yield stack.pop()[0], False
+        yield page_id, True
+        stack.append((page_id, right))
+    while stack:
+        yield stack.pop()[0], False
+
+
+def shift_tree(value, width):
+    """
+    Shifts every left and right value greater than or equal to the given value
+    by the given width.
+    """
+    Page.objects.filter(left__gte=value).update(
+        left = F("left") + width,
+    )
+    Page.objects.filter(right__gte=value).update(
+        right = F("right") + width,
+    )
+
+
+def number_tree_tokens(tokens, left, spacing):
+    """
+    Numbers the given tree tokens with the given spacing, starting after the
+    given left value.
+    
+    Returns a dictionary of (left, right) tuples, keyed by page id.
+    """
+    values = {}
+    for index, (page_id, is_left) in enumerate(tokens, 1):
+        values.setdefault(page_id, [None, None])[0 if is_left else 1] = left + index * spacing
+    return dict(
+        (page_id, tuple(page_values))
+        for page_id, page_values
+        in values.iteritems()
+    )
+
+
+def place_branch(parent, branch_tokens, branch_values=None, batch_size=500):
+    """
+    Places a branch as the last child of the given parent, using gapped
+    numbering.
+    
+    The branch tokens should be generated by iter_tree_tokens(). If the branch
+    already exists in the tree, then branch_values should contain the current
+    (left, right) tuples of the pages in the branch that need updating.
+    
+    Any existing pages whose values change are updated in the database, in
+    batches of the given size. Returns a dictionary of the new (left, right)
+    tuples for every page in the branch.
+    """
+    branch_values = branch_values or {}
+    # Try to fit the branch into the gap after the last child of the parent.
+    last_right = Page.objects.filter(
+        parent = parent["id"],
+    ).aggregate(Max("right"))["right__max"]
+    if last_right is None:
+        last_right = parent["left"]
+    spacing = min(get_tree_stride(), (parent["right"] - last_right) // (len(branch_tokens) + 1))
+    if spacing >= 1:
+        old_values = branch_values
+        new_values = number_tree_tokens(branch_tokens, last_right, spacing)
+    else:
+        # Find the smallest enclosing range with enough room to be rebalanced.
+        ranges = list(Page.objects.filter(
+            left__lte = parent["left"],
+            right__gte = parent["right"],
+        ).order_by("-left").values_list("id", "left", "right"))
+        ranges.append((None, 0, MAX_TREE_VALUE))
+        for range_id, range_left, range_right in ranges:
+            descendants = Page.objects.filter(left__gt=range_left, right__lt=range_right)
+            if branch_values:
+                descendants = descendants.exclude(
+                    left__gte = min(left for left, _ in branch_values.itervalues()),
+                    right__lte = max(right for _, right in branch_values.itervalues()),
+                )
+            token_count = descendants.count() * 2 + len(branch_tokens)
+            spacing = (range_right - range_left) // (token_count + 1)
+            if spacing >= MIN_REBALANCE_SPACING:
+                break
+        # Spread the whole range evenly, with the branch appended to the parent.
+        rows = list(descendants.order_by("left").values_list("id", "left", "right"))
+        tokens = list(iter_tree_tokens(rows))
+        if range_id == parent["id"]:
+            tokens.extend(branch_tokens)
+        else:
+            parent_right_index = tokens.index((parent["id"], False))
+            tokens[parent_right_index:parent_right_index] = branch_tokens
+        old_values = dict(
+            (page_id, (left, right))
+            for page_id, left, right
+            in rows
+        )
+        old_values.update(branch_values)
+        new_values = number_tree_tokens(tokens, range_left, spacing)
+    # Update all existing pages that have changed.
+    changed_rows = [
+        (page_id,) + new_values[page_id]
+        for page_id, values
+        in old_values.iteritems()
+        if new_values[page_id] != values
+    ]
+    for batch_start in xrange(0, len(changed_rows), batch_size):
+        update_tree_rows(changed_rows[batch_start:batch_start + batch_size], ("left", "right"))
+    return new_values
+
+
+class PageTreeError(Exception):
+
+    """Error raised when the page tree cannot be rebuilt."""
+
+
+def iter_branch_tokens(child_ids, page_ids):
+    """
+    Yields a (page_id, is_left) token for every left and right value in the
+    given branches, in tree order.
+    
+    The child_ids should be a dictionary of lists of child page ids, keyed by
+    parent page id.
+    """
+    stack = [(page_id, True) for page_id in reversed(page_ids)]
+    while stack:
+        page_id, is_left = stack.pop()
+        yield page_id, is_left
+        if is_left:
+            stack.append((page_id, False))
+            stack.extend((child_id, True) for child_id in reversed(child_ids.get(page_id, ())))
+
+
+def fit_tree_branches(child_ids, values, valid_page_ids, parent_id, low, high):
+    """
+    Fits the children of the given page between the given low and high values,
+    keeping the values of valid branches where possible.
+    
+    The values should be a dictionary of (left, right) tuples, keyed by page id,
+    and valid_page_ids a set of pages whose branches are correctly nested.
+    Returns a dictionary of new (left, right) tuples for the renumbered pages,
+    or None if there is not enough room between the given values.
+    """
+    children = child_ids.get(parent_id, ())
+    new_values = {}
+    kept_page_ids = set()
+    last_value = low
+    for page_id in children:
+        left, right = values[page_id][:2]
+        if last_value < left < right < high:
+            if page_id in valid_page_ids:
+                kept_page_ids.add(page_id)
+                last_value = right
+                continue
+            # The page fits, so try to repair its children within it.
+            branch_values = fit_tree_branches(child_ids, values, valid_page_ids, page_id, left, right)
+            if branch_values is not None:
+                new_values.update(branch_values)
+                kept_page_ids.add(page_id)
+                last_value = right
+    def number_branches(page_ids, low, high):
+        tokens = list(iter_branch_tokens(child_ids, page_ids))
+        spacing = min(max(get_tree_stride(), 1), (high - low - 1) // len(tokens))
+        if spacing < 1:
+            return False
+        new_values.update(number_tree_tokens(tokens, low, spacing))
+        return True
+    # Renumber each run of siblings between the kept pages.
+    run = []
+    run_low = low
+    for page_id in list(children) + [None]:
+        if page_id is not None and not page_id in kept_page_ids:
+            run.append(page_id)
+            continue
+        if run:
+            if not number_branches(run, run_low, high if page_id is None else values[page_id][0]):
+                break
+            run = []
+        if page_id is not None:
+            run_low = values[page_id][1]
+    else:
+        return new_values
+    # There is no room between the kept pages, so renumber all of the children.
+    new_values = {}
+    if children and not number_branches(children, low, high):
+        return None
+    return new_values
+
+
+def update_tree_rows(rows, fields=("left", "right", "path")):
+    """
+    Updates the given fields of the given pages using a single query.
+    
+    The rows should be (page_id, value, ...) tuples, with a value for each of
+    the fields, which default to the left, right and path.
+    """
+    quote_name = connection.ops.quote_name
+    case_sql = "CASE {id} {whens} END".format(
+        id = quote_name("id"),
+        whens = " ".join(["WHEN %s THEN %s"] * len(rows)),
+    )
+    params = []
+    for index in xrange(1, len(fields) + 1):
+        for row in rows:
+            params.extend((row[0], row[index]))
+    params.extend(row[0] for row in rows)
+    connection.cursor().execute("""
+        UPDATE {pages_page}
+        SET {assignments}
+        WHERE {id} IN ({ids})
+    """.format(
+        pages_page = quote_name("pages_page"),
+        id = quote_name("id"),
+        assignments = ", ".join(
+            "{field} = {case_sql}".format(
+                field = quote_name(field),
+                case_sql = case_sql,
+            )
+            for field in fields
+        ),
+        ids = ", ".join(["%s"] * len(rows)),
+    ), params)
+
+
+def get_effective_publication(parent_publication, is_online, publication_date, expiry_date):
+    """
+    Returns the effective (online, from, until) publication state of a page,
+    given the effective publication state of its parent.
+    
+    A page is only online if all its ancestors are online, and is only
+    published between the latest publication date and earliest expiry date of
+    itself and its ancestors.
+    """
+    parent_online, parent_from, parent_until = parent_publication
+    return (
+        parent_online and is_online,
+        max(parent_from, publication_date) if parent_from and publication_date else parent_from or publication_date,
+        min(parent_until, expiry_date) if parent_until and expiry_date else parent_until or expiry_date,
+    )
+
+
+# The effective publication state inherited by root pages.
+ROOT_PUBLICATION = (True, None, None)
+
+
+def update_effective_publication(changed_pages, batch_size=500):
+    """
+    Writes new effective publication states to the database.
+    
+    The changed pages should be a dictionary of lists of page ids, keyed by
+    their new (online, from, until) state. A single update query is used for
+    each distinct state.
+    """
+    for (effective_online, effective_from, effective_until), page_ids in changed_pages.iteritems():
+        for batch_start in xrange(0, len(page_ids), batch_size):
+            Page.objects.filter(id__in=page_ids[batch_start:batch_start + batch_size]).update(
+                effective_online = effective_online,
+                effective_from = effective_from,
+                effective_until = effective_until,
+            )
+
+
+def update_branch_publication(left, right, parent_publication):
+    """
+    Recalculates the effective publication state of every page between the
+    given left and right values, inclusive.
+    
+    The parent publication should be the effective publication state of the
+    parent of the top of the range.
+    """
+    publications = {}
+    changed_pages = {}
+    for page_id, parent_id, is_online, publication_date, expiry_date, effective_online, effective_from, effective_until in Page.objects.filter(
+        left__gte = left,
+        right__lte = right,
+    ).order_by("left").values_list(
+        "id", "parent_id", "is_online", "publication_date", "expiry_date", "effective_online", "effective_from", "effective_until",
+    ).iterator():
+        # As pages are ordered by left, the parent has always been seen already.
+        publication = publications[page_id] = get_effective_publication(
+            publications.get(parent_id, parent_publication),
+            is_online,
+            publication_date,
+            expiry_date,
+        )
+        if publication != (effective_online, effective_from, effective_until):
+            changed_pages.setdefault(publication, []).append(page_id)
+    update_effective_publication(changed_pages)
 
 
 def get_default_page_parent():
@@ -20,55 +365,291 @@ def get_default_page_parent():
         return None
 
 
+def prefetch_content(pages):
+    """
+    Loads the content of all the given pages, using a single query for each
+    type of content.
+    
+    Returns the pages, as a list.
+    """
+    pages = list(pages)
+    pages_by_content_type = {}
+    for page in pages:
+        if not "content" in page.__dict__:
+            pages_by_content_type.setdefault(page.content_type_id, {})[page.id] = page
+    for content_type_id, content_pages in pages_by_content_type.iteritems():
+        content_cls = ContentType.objects.get_for_id(content_type_id).model_class()
+        for content in content_cls._default_manager.filter(page__in=content_pages.keys()):
+            page = content_pages[content.page_id]
+            content.page = page
+            page.content = content
+    return pages
+
+
+class PageQuerySet(QuerySet):
+    
+    """A queryset of Page objects."""
+    
+    _prefetch_content = False
+    
+    # The number of pages to load content for at a time.
+    _prefetch_content_chunk_size = 100
+    
+    def prefetch_content(self):
+        """Loads the content of the pages in batches, when they are fetched."""
+        return self._clone(_prefetch_content=True)
+        
+    def _clone(self, klass=None, setup=False, **kwargs):
+        """Clones the queryset."""
+        kwargs.setdefault("_prefetch_content", self._prefetch_content)
+        return super(PageQuerySet, self)._clone(klass, setup, **kwargs)
+        
+    def iterator(self):
+        """Iterates over the pages, loading their content if required."""
+        iterator = super(PageQuerySet, self).iterator()
+        if not self._prefetch_content:
+            return iterator
+        return self._iterator_prefetch_content(iterator)
+        
+    def _iterator_prefetch_content(self, iterator):
+        """Loads the content of the pages from the given iterator in chunks."""
+        while True:
+            pages = prefetch_content(islice(iterator, self._prefetch_content_chunk_size))
+            if not pages:
+                break
+            for page in pages:
+                yield page
+
+
 class PageManager(OnlineBaseManager):
     
     """Manager for Page objects."""
     
+    def get_query_set(self):
+        """Returns the queryset, filtered if appropriate."""
+        return super(PageManager, self).get_query_set()._clone(klass=PageQuerySet)
+        
+    def prefetch_content(self):
+        """Returns all pages, loading their content in batches."""
+        return self.get_query_set().prefetch_content()
+        
     def select_published(self, queryset, page_alias=None):
-        """Selects only published pages."""
+        """
+        Selects only published pages.
+        
+        The page_alias argument is no longer used, and is only accepted for
+        backwards compatibility.
+        """
         queryset = super(PageManager, self).select_published(queryset)
         now = timezone.now()
-        # Perform local filtering.
-        queryset = queryset.filter(Q(publication_date=None) | Q(publication_date__lte=now))
-        queryset = queryset.filter(Q(expiry_date=None) | Q(expiry_date__gt=now))
-        # Perform parent ordering.
-        quote_name = connection.ops.quote_name
-        page_alias = page_alias  or quote_name("pages_page")
-        queryset = queryset.extra(
-            where = ("""
-                NOT EXISTS (
-                    SELECT *
-                    FROM {pages_page} AS {ancestors}
-                    WHERE
-                        {ancestors}.{left} < {page_alias}.{left} AND
-                        {ancestors}.{right} > {page_alias}.{right} AND (
-                            {ancestors}.{is_online} = FALSE OR
-                            {ancestors}.{publication_date} > %s OR
-                            {ancestors}.{expiry_date} <= %s
-                        )
-                )
-            """.format(
-                page_alias = page_alias,
-                **dict(
-                    (name, quote_name(name))
-                    for name in (
-                        "pages_page",
-                        "ancestors",
-                        "left",
-                        "right",
-                        "is_online",
-                        "publication_date",
-                        "expiry_date",
-                    )
-                )
-            ),),
-            params = (now, now),
-        )
+        # Filter on the publication state inherited from the page ancestors.
+        queryset = queryset.filter(effective_online=True)
+        queryset = queryset.filter(Q(effective_from=None) | Q(effective_from__lte=now))
+        queryset = queryset.filter(Q(effective_until=None) | Q(effective_until__gt=now))
         return queryset
     
+    def update_publication(self, page_ids):
+        """
+        Recalculates the effective publication state of the given pages and
+        their descendants.
+        
+        This should be called after the publication fields of pages have been
+        changed without calling save(), such as by a queryset update.
+        """
+        with transaction.atomic(), publication_manager.select_published(False):
+            lock_page_tree()
+            branch_right = None
+            for parent_id, left, right in self.filter(id__in=page_ids).order_by("left").values_list("parent_id", "left", "right"):
+                if branch_right is not None and right < branch_right:
+                    continue  # Optimization - this page has already been updated as part of a previous branch.
+                if parent_id is None:
+                    parent_publication = ROOT_PUBLICATION
+                else:
+                    parent_publication = self.filter(id=parent_id).values_list("effective_online", "effective_from", "effective_until").get()
+                update_branch_publication(left, right, parent_publication)
+                branch_right = right
+        bump_version(PAGE_TREE_VERSION)
+    
     def get_homepage(self):
         """Returns the site homepage."""
         return self.prefetch_related("child_set__child_set").get(parent=None)
+    
+    def bulk_insert_tree(self, branches, parent=None, batch_size=500):
+        """
+        Inserts whole branches of new pages into the page tree.
+        
+        Each branch should be a (page, content, children) tuple, where page is an
+        unsaved Page, content is an unsaved instance of a ContentBase subclass (or
+        None), and children is a list of branches to insert beneath the page. The
+        branches are added as the last children of the given parent, or as root
+        pages if no parent is given.
+        
+        This is much faster than saving pages one at a time, as the whole batch is
+        numbered in memory, the existing tree is shifted at most once, and all rows
+        are inserted using bulk_create(). No model signals are sent, so search
+        indexes will need to be rebuilt afterwards.
+        
+        Returns a list of all inserted pages, in tree order.
+        """
+        # Flatten the branches into tree order. New pages are keyed by a tuple, so
+        # that they can't clash with the ids of existing pages when rebalancing.
+        nodes = []
+        tokens = []
+        def flatten(branch, parent_index, depth):
+            page, content, children = branch
+            index = len(nodes)
+            nodes.append((page, content, parent_index, depth))
+            tokens.append(((None, index), True))
+            for child in children:
+                flatten(child, index, depth + 1)
+            tokens.append(((None, index), False))
+        for branch in branches:
+            flatten(branch, None, 0)
+        if not nodes:
+            return []
+        with transaction.atomic(), publication_manager.select_published(False):
+            lock_page_tree()
+            # Number the new pages.
+            if parent is None:
+                values = number_tree_tokens(tokens, self.aggregate(Max("right"))["right__max"] or 0, 1)
+            else:
+                parent_row = self.filter(id=parent.id).values("id", "left", "right", "path", "effective_online", "effective_from", "effective_until").get()
+                parent_path = parent_row["path"]
+                parent_publication = (parent_row["effective_online"], parent_row["effective_from"], parent_row["effective_until"])
+                if get_tree_stride():
+                    values = place_branch(parent_row, tokens)
+                else:
+                    shift_tree(parent_row["right"], len(tokens))
+                    values = number_tree_tokens(tokens, parent_row["right"] - 1, 1)
+            for index, (page, content, parent_index, depth) in enumerate(nodes):
+                page.left, page.right = values[(None, index)]
+                if parent_index is not None:
+                    page.path = nodes[parent_index][0].path + page.url_title + u"/"
+                    page_parent_publication = nodes[parent_index][0].effective_publication
+                elif parent is not None:
+                    page.path = parent_path + page.url_title + u"/"
+                    page_parent_publication = parent_publication
+                else:
+                    page.path = u""
+                    page_parent_publication = ROOT_PUBLICATION
+                page.effective_online, page.effective_from, page.effective_until = get_effective_publication(
+                    page_parent_publication,
+                    page.is_online,
+                    page.publication_date,
+                    page.expiry_date,
+                )
+            # Insert the pages one level at a time, so that parent ids are known.
+            db = router.db_for_write(Page)
+            levels = {}
+            for page, content, parent_index, depth in nodes:
+                levels.setdefault(depth, []).append((page, parent_index))
+            for depth in sorted(levels):
+                level = levels[depth]
+                for batch_start in xrange(0, len(level), batch_size):
+                    batch = level[batch_start:batch_start + batch_size]
+                    for page, parent_index in batch:
+                        page.parent = parent if parent_index is None else nodes[parent_index][0]
+                    self.bulk_create([page for page, _ in batch])
+                    # Bulk inserts don't set the page ids, so look them up by their unique left values.
+                    page_ids = dict(self.filter(
+                        left__in = [page.left for page, _ in batch],
+                    ).values_list("left", "id"))
+                    for page, _ in batch:
+                        page.id = page_ids[page.left]
+                        page._state.adding = False
+                        page._state.db = db
+            # Insert the page content.
+            contents = {}
+            for page, content, parent_index, depth in nodes:
+                if content is not None:
+                    content.page = page
+                    contents.setdefault(content.__class__, []).append(content)
+            for content_cls, content_list in contents.iteritems():
+                content_cls._default_manager.bulk_create(content_list, batch_size=batch_size)
+        bump_version(PAGE_TREE_VERSION)
+        return [page for page, _, _, _ in nodes]
+
+    def rebuild_tree(self, check=False, batch_size=500):
+        """
+        Checks the left, right, path and effective publication state of every
+        page against the parent of each page, repairing any corruption in the
+        page tree.
+        
+        The left and right values of a page are valid if they are nested within
+        the values of its parent, and do not overlap its siblings. Gaps between
+        values are allowed, so valid values are kept, and only the branches
+        with invalid values are renumbered, into the space around them. Siblings
+        keep their current order. If check is True, then nothing is written to
+        the database.
+        
+        Returns a list of the ids of all pages with incorrect values.
+        """
+        with transaction.atomic(), publication_manager.select_published(False):
+            if not check:
+                lock_page_tree()
+            # Load the tree structure, in the current tree order.
+            page_fields = {}
+            old_values = {}
+            old_publications = {}
+            child_ids = {}
+            for page_id, parent_id, url_title, left, right, path, is_online, publication_date, expiry_date, effective_online, effective_from, effective_until in self.order_by("left", "id").values_list(
+                "id", "parent_id", "url_title", "left", "right", "path",
+                "is_online", "publication_date", "expiry_date", "effective_online", "effective_from", "effective_until",
+            ).iterator():
+                page_fields[page_id] = (url_title, is_online, publication_date, expiry_date)
+                old_values[page_id] = (left, right, path)
+                old_publications[page_id] = (effective_online, effective_from, effective_until)
+                child_ids.setdefault(parent_id, []).append(page_id)
+            # Calculate the path and effective publication of every page, in tree order.
+            new_rows = []
+            changed_publications = {}
+            stack = [(page_id, None, ROOT_PUBLICATION) for page_id in reversed(child_ids.get(None, ()))]
+            while stack:
+                page_id, parent_path, parent_publication = stack.pop()
+                url_title, is_online, publication_date, expiry_date = page_fields.pop(page_id)
+                path = u"" if parent_path is None else parent_path + url_title + u"/"
+                new_rows.append([page_id, None, None, path])
+                publication = get_effective_publication(parent_publication, is_online, publication_date, expiry_date)
+                if publication != old_publications[page_id]:
+                    changed_publications.setdefault(publication, []).append(page_id)
+                stack.extend((child_id, path, publication) for child_id in reversed(child_ids.get(page_id, ())))
+            if page_fields:
+                raise PageTreeError("The pages {page_ids} are not descendants of a root page.".format(
+                    page_ids = ", ".join(str(page_id) for page_id in sorted(page_fields)),
+                ))
+            # Check which branches are correctly nested, children first.
+            valid_page_ids = set()
+            for page_id, _, _, _ in reversed(new_rows):
+                left, right, _ = old_values[page_id]
+                last_value = left
+                for child_id in child_ids.get(page_id, ()):
+                    child_left, child_right, _ = old_values[child_id]
+                    if not (child_id in valid_page_ids and last_value < child_left and child_right < right):
+                        break
+                    last_value = child_right
+                else:
+                    if left < right:
+                        valid_page_ids.add(page_id)
+            # Renumber the invalid branches.
+            new_values = fit_tree_branches(child_ids, old_values, valid_page_ids, None, 0, MAX_TREE_VALUE + 1)
+            if new_values is None:
+                raise PageTreeError("There is not enough room to number the page tree.")
+            for row in new_rows:
+                row[1], row[2] = new_values.get(row[0], old_values[row[0]][:2])
+            # Update the changed pages.
+            changed_rows = [
+                row for row in new_rows
+                if tuple(row[1:]) != old_values[row[0]]
+            ]
+            changed_page_ids = set(row[0] for row in changed_rows)
+            for page_ids in changed_publications.itervalues():
+                changed_page_ids.update(page_ids)
+            if not check and changed_page_ids:
+                for batch_start in xrange(0, len(changed_rows), batch_size):
+                    update_tree_rows(changed_rows[batch_start:batch_start + batch_size])
+                update_effective_publication(changed_publications, batch_size)
+                bump_version(PAGE_TREE_VERSION)
+        return [row[0] for row in new_rows if row[0] in changed_page_ids]
 
 
 class Page(PageBase):
@@ -97,9 +678,20 @@ class Page(PageBase):
         db_index = True,
     )
     
+    path = models.CharField(
+        max_length = 1000,
+        editable = False,
+        db_index = True,
+        blank = True,
+        help_text = "The URL path of the page, relative to the site root. This is maintained automatically.",
+    )
+    
     @cached_property
     def children(self):
         """The child pages for this page."""
+        tree_loader = getattr(self, "_tree_loader", None)
+        if tree_loader is not None:  # Optimization - use the page tree snapshot, if loaded from one.
+            return tree_loader.get_children(self)
         children = []
         if self.right - self.left > 1:  # Optimization - don't fetch children we know aren't there!
             for child in self.child_set.all():
@@ -127,6 +719,34 @@ class Page(PageBase):
         db_index = True,
         help_text = "The date that this page will be removed from the website.  Leave this blank to never expire this page.",
     )
+    
+    effective_online = models.BooleanField(
+        default = True,
+        editable = False,
+        db_index = True,
+        help_text = "Whether this page and all of its ancestors are online. This is maintained automatically.",
+    )
+    
+    effective_from = models.DateTimeField(
+        blank = True,
+        null = True,
+        editable = False,
+        db_index = True,
+        help_text = "The latest publication date of this page and its ancestors. This is maintained automatically.",
+    )
+    
+    effective_until = models.DateTimeField(
+        blank = True,
+        null = True,
+        editable = False,
+        db_index = True,
+        help_text = "The earliest expiry date of this page and its ancestors. This is maintained automatically.",
+    )
+    
+    @property
+    def effective_publication(self):
+        """The effective (online, from, until) publication state of this page."""
+        return (self.effective_online, self.effective_from, self.effective_until)
 
     # Navigation fields.
 
@@ -144,11 +764,22 @@ class Page(PageBase):
         help_text="The type of page content.",
     )
     
+    last_modified = models.DateTimeField(
+        auto_now = True,
+        editable = False,
+        help_text = "The time that this page or its content was last changed.",
+    )
+    
+    @property
+    def content_cls(self):
+        """The class of the associated content model for this page."""
+        return ContentType.objects.get_for_id(self.content_type_id).model_class()
+    
     @cached_property
+    @timed("page_content")
     def content(self):
         """The associated content model for this page."""
-        content_cls = ContentType.objects.get_for_id(self.content_type_id).model_class()
-        content = content_cls._default_manager.get(page=self)
+        content = self.content_cls._default_manager.get(page=self)
         content.page = self
         return content
 
@@ -158,16 +789,18 @@ class Page(PageBase):
             args = ()
         if kwargs is None:
             kwargs = {}
-        urlconf = ContentType.objects.get_for_id(self.content_type_id).model_class().urlconf
+        urlconf = self.content_cls.urlconf
         return self.get_absolute_url() + urlresolvers.reverse(view_func, args=args, kwargs=kwargs, urlconf=urlconf, prefix="")
 
     # Standard model methods.
     
     def get_absolute_url(self):
         """Generates the absolute url of the page."""
-        if self.parent:
-            return self.parent.get_absolute_url() + self.url_title + "/"
-        return urlresolvers.get_script_prefix()
+        return urlresolvers.get_script_prefix() + self.path
+    
+    def get_cache_dependencies(self):
+        """Returns the version counters that the URL of the page depends on."""
+        return (PAGE_TREE_VERSION,)
     
     # Tree management.
     
@@ -177,84 +810,166 @@ class Page(PageBase):
     
     def _excise_branch(self):
         """Excises this whole branch from the tree."""
-        branch_width = self._branch_width
-        Page.objects.filter(left__gte=self.left).update(
-            left = F("left") - branch_width,
-        )
-        Page.objects.filter(right__gte=self.left).update(
-            right = F("right") - branch_width,
-        )
+        shift_tree(self.left, -self._branch_width)
         
     def _insert_branch(self):
         """Inserts this whole branch into the tree."""
-        branch_width = self._branch_width
-        Page.objects.filter(left__gte=self.left).update(
-            left = F("left") + branch_width,
-        )
-        Page.objects.filter(right__gte=self.left).update(
-            right = F("right") + branch_width,
-        )
+        shift_tree(self.left, self._branch_width)
         
+    def _update_descendant_paths(self, old_path, left, right):
+        """
+        Replaces the old path prefix of all descendants of this page with
+        the current path of this page.
+        """
+        quote_name = connection.ops.quote_name
+        if connection.vendor == "mysql":
+            path_sql = "CONCAT(%s, SUBSTRING({path}, %s))"
+        else:
+            path_sql = "%s || SUBSTR({path}, %s)"
+        connection.cursor().execute("""
+            UPDATE {pages_page}
+            SET {path} = {path_sql}
+            WHERE {left} > %s AND {right} < %s
+        """.format(
+            path_sql = path_sql.format(path=quote_name("path")),
+            **dict(
+                (name, quote_name(name))
+                for name in (
+                    "pages_page",
+                    "path",
+                    "left",
+                    "right",
+                )
+            )
+        ), (self.path, len(old_path) + 1, left, right))
+        
+    @transaction.atomic
     def save(self, *args, **kwargs):
         """Saves the page."""
-        # Lock entire table.
-        existing_pages = dict(
-            (page["id"], page)
-            for page
-            in Page.objects.all().select_for_update().values("id", "parent_id", "left", "right")
-        )
-        if self.left is None or self.right is None:
-            # This page is being inserted.
-            if existing_pages:
-                parent_right = existing_pages[self.parent_id]["right"]
-                # Set the model left and right.
-                self.left = parent_right
-                self.right = self.left + 1
-                # Update the whole tree structure.
-                self._insert_branch()
+        with publication_manager.select_published(False):
+            lock_page_tree()
+            # Load the parent and the existing version of this page.
+            existing_pages = dict(
+                (page["id"], page)
+                for page
+                in Page.objects.filter(
+                    id__in = [page_id for page_id in (self.id, self.parent_id) if page_id is not None],
+                ).values("id", "parent_id", "left", "right", "path", "effective_online", "effective_from", "effective_until")
+            )
+            # Generate the URL path.
+            if self.parent_id is None:
+                self.path = u""
             else:
-                # This is the first page to be created, ever!
-                self.left = 1
-                self.right = 2
-        else:
-            # This is an update.
-            old_parent_id = existing_pages[self.id]["parent_id"]
-            if old_parent_id != self.parent_id:
-                # The page has moved.
-                branch_width = self.right - self.left + 1
-                # Disconnect child branch.
-                if branch_width > 2:
-                    Page.objects.filter(left__gt=self.left, right__lt=self.right).update(
-                        left = F("left") * -1,
-                        right = F("right") * -1,
-                    )
-                self._excise_branch()
-                # Store old left and right values.
-                old_left = self.left
-                old_right = self.right
-                # Put self into the tree.
-                parent_right = existing_pages[self.parent_id]["right"]
-                if parent_right > self.right:
-                    parent_right -= self._branch_width
-                self.left = parent_right
-                self.right = self.left + branch_width - 1
-                self._insert_branch()
-                # Put all children back into the tree.
-                if branch_width > 2:
-                    child_offset = self.left - old_left
-                    Page.objects.filter(left__lt=-old_left, right__gt=-old_right).update(
-                        left = (F("left") - child_offset) * -1,
-                        right = (F("right") - child_offset) * -1,
-                    )
-        # Now actually save it!
-        super(Page, self).save(*args, **kwargs)
+                self.path = existing_pages[self.parent_id]["path"] + self.url_title + u"/"
+            # Inherit the publication state of the parent.
+            if self.parent_id is None:
+                parent_publication = ROOT_PUBLICATION
+            else:
+                parent_page = existing_pages[self.parent_id]
+                parent_publication = (parent_page["effective_online"], parent_page["effective_from"], parent_page["effective_until"])
+            self.effective_online, self.effective_from, self.effective_until = get_effective_publication(
+                parent_publication,
+                self.is_online,
+                self.publication_date,
+                self.expiry_date,
+            )
+            publication_changed = False
+            path_changed = False
+            if self.id not in existing_pages:
+                # This page is being inserted.
+                if self.parent_id is None:
+                    # This is a root page, so place it after all other pages.
+                    self.left = (Page.objects.aggregate(Max("right"))["right__max"] or 0) + 1
+                    self.right = self.left + 1
+                elif get_tree_stride():
+                    self.left, self.right = place_branch(
+                        existing_pages[self.parent_id],
+                        [(None, True), (None, False)],
+                    )[None]
+                else:
+                    parent_right = existing_pages[self.parent_id]["right"]
+                    # Set the model left and right.
+                    self.left = parent_right
+                    self.right = self.left + 1
+                    # Update the whole tree structure.
+                    self._insert_branch()
+            else:
+                # This is an update.
+                old_page = existing_pages[self.id]
+                self.left = old_page["left"]
+                self.right = old_page["right"]
+                publication_changed = self.effective_publication != (old_page["effective_online"], old_page["effective_from"], old_page["effective_until"])
+                path_changed = old_page["path"] != self.path
+                if path_changed and self.right - self.left > 1:
+                    # The URL of the page has changed, so update the whole branch.
+                    self._update_descendant_paths(old_page["path"], self.left, self.right)
+                old_parent_id = old_page["parent_id"]
+                if old_parent_id != self.parent_id and get_tree_stride():
+                    # The page has moved, so place it into a gap in the new parent.
+                    branch_rows = list(Page.objects.filter(
+                        left__gte = self.left,
+                        right__lte = self.right,
+                    ).order_by("left").values_list("id", "left", "right"))
+                    self.left, self.right = place_branch(
+                        existing_pages[self.parent_id],
+                        list(iter_tree_tokens(branch_rows)),
+                        dict(
+                            (page_id, (left, right))
+                            for page_id, left, right
+                            in branch_rows
+                        ),
+                    )[self.id]
+                elif old_parent_id != self.parent_id:
+                    # The page has moved.
+                    branch_width = self.right - self.left + 1
+                    # Disconnect child branch.
+                    if branch_width > 2:
+                        Page.objects.filter(left__gt=self.left, right__lt=self.right).update(
+                            left = F("left") * -1,
+                            right = F("right") * -1,
+                        )
+                    self._excise_branch()
+                    # Store old left and right values.
+                    old_left = self.left
+                    old_right = self.right
+                    # Put self into the tree.
+                    parent_right = existing_pages[self.parent_id]["right"]
+                    if parent_right > self.right:
+                        parent_right -= self._branch_width
+                    self.left = parent_right
+                    self.right = self.left + branch_width - 1
+                    self._insert_branch()
+                    # Put all children back into the tree.
+                    if branch_width > 2:
+                        child_offset = self.left - old_left
+                        Page.objects.filter(left__lt=-old_left, right__gt=-old_right).update(
+                            left = (F("left") - child_offset) * -1,
+                            right = (F("right") - child_offset) * -1,
+                        )
+            # Now actually save it!
+            super(Page, self).save(*args, **kwargs)
+            # Update the publication state of all descendants.
+            if publication_changed and self.right - self.left > 1:
+                update_branch_publication(self.left + 1, self.right - 1, self.effective_publication)
+            # The URLs of descendants, and of content published under them, depend on this page.
+            if path_changed or publication_changed:
+                changed_permalinks = get_page_permalinks(Page.objects.filter(
+                    left__gte = self.left,
+                    right__lte = self.right,
+                ).values_list("id", flat=True))
+                if changed_permalinks:
+                    schedule_rerender(*changed_permalinks)
 
+    @transaction.atomic
     def delete(self, *args, **kwargs):
         """Deletes the page."""
-        list(Page.objects.all().select_for_update().values_list("left", "right"))  # Lock entire table.
-        super(Page, self).delete(*args, **kwargs)
-        # Update the entire tree.
-        self._excise_branch()
+        with publication_manager.select_published(False):
+            lock_page_tree()
+            self.left, self.right = Page.objects.filter(id=self.id).values_list("left", "right").get()
+            super(Page, self).delete(*args, **kwargs)
+            # Update the entire tree. With gapped numbering, the gap can simply be left behind.
+            if not get_tree_stride():
+                self._excise_branch()
 
     class Meta:
         unique_together = (("parent", "url_title",),)
@@ -264,6 +979,39 @@ class Page(PageBase):
 externals.historylinks("register", Page)
 
 
+def bump_page_tree_version(**kwargs):
+    """Marks the page tree as changed."""
+    bump_version(PAGE_TREE_VERSION)
+
+
+models.signals.post_save.connect(bump_page_tree_version, sender=Page)
+
+models.signals.post_delete.connect(bump_page_tree_version, sender=Page)
+
+
+# Pages are published and expired by their effective publication state, which
+# can only change along with the page tree version.
+publication.register(Page, ("effective_from", "effective_until"), version_name=PAGE_TREE_VERSION)
+
+
+def schedule_page_transition_rerender(sender, start, end, **kwargs):
+    """
+    Signal handler that schedules the precomputed HTML linking to content
+    under pages published or unpublished by a publication transition to be
+    re-rendered. Links to the pages themselves are handled by cms.html.
+    """
+    if start is None:
+        return
+    for model, ids in publication.get_transitioned_ids(start, end):
+        if model is Page:
+            changed_permalinks = get_page_permalinks(ids, include_pages=False)
+            if changed_permalinks:
+                schedule_rerender(*changed_permalinks)
+
+
+publication.transitions_passed.connect(schedule_page_transition_rerender)
+
+
 class PageSitemap(sitemaps.PageBaseSitemap):
     
     """Sitemap for page models."""
@@ -273,6 +1021,20 @@ class PageSitemap(sitemaps.PageBaseSitemap):
     def items(self):
         """Only lists items that are marked as indexable."""
         return filter_indexable_pages(super(PageSitemap, self).items())
+    
+    def get_fields(self):
+        """Only loads the fields used for the sitemap."""
+        return ("path", "sitemap_changefreq", "sitemap_priority", "last_modified",)
+    
+    def get_changed_pks(self, instance):
+        """The URLs of the descendants of a page depend on its path."""
+        pks = super(PageSitemap, self).get_changed_pks(instance)
+        if pks is not None and instance.right - instance.left > 1:
+            pks.update(Page._base_manager.filter(
+                left__gt = instance.left,
+                right__lt = instance.right,
+            ).values_list("pk", flat=True))
+        return pks
 
 
 sitemaps.register(Page, sitemap_cls=PageSitemap)
@@ -299,13 +1061,14 @@ class PageSearchAdapter(PageBaseSearchAdapter):
         
     def get_live_queryset(self):
         """Selects the live page queryset."""
-        # HACK: Prevents a table name collision in the Django queryset manager.
         with publication_manager.select_published(False):
             qs = Page._base_manager.all()
         if publication_manager.select_published_active():
-            qs = Page.objects.select_published(qs, page_alias="U0")
+            qs = Page.objects.select_published(qs)
         # Filter out unindexable pages.
         qs = filter_indexable_pages(qs)
+        # Load the page content in batches, rather than once per page.
+        qs = qs.prefetch_content()
         # All done!
         return qs
         
@@ -339,6 +1102,44 @@ def filter_indexable_pages(queryset):
     )
     
 
+def get_page_permalinks(page_ids, include_pages=True, batch_size=500):
+    """
+    Returns a list of permalinks to the given pages, and to any objects that
+    belong to the pages or to their content, and so have URLs under them.
+    """
+    page_ids = list(page_ids)
+    result = []
+    try:
+        for model in models.get_models():
+            if not has_object_versions(model):
+                continue
+            if model is Page:
+                if include_pages:
+                    result.extend(permalinks.create_for_id(Page, page_id) for page_id in page_ids)
+                continue
+            lookups = [
+                field.name
+                for field
+                in model._meta.fields
+                if isinstance(field, models.ForeignKey) and (field.rel.to is Page or issubclass(field.rel.to, ContentBase))
+            ]
+            if not lookups:
+                continue
+            with publication_manager.select_published(False):
+                for batch_start in xrange(0, len(page_ids), batch_size):
+                    batch = page_ids[batch_start:batch_start + batch_size]
+                    object_ids = model._base_manager.filter(reduce(operator.or_, (
+                        Q(**{lookup + "__in": batch})
+                        for lookup
+                        in lookups
+                    ))).values_list("pk", flat=True)
+                    result.extend(permalinks.create_for_id(model, object_id) for object_id in object_ids)
+    except urlresolvers.NoReverseMatch:
+        # Permalinks are not installed, so nothing can link to these objects.
+        return []
+    return result
+
+
 class ContentBase(models.Model):
     
     """Base class for page content."""
@@ -370,4 +1171,21 @@ class ContentBase(models.Model):
         return unicode(self.page)
     
     class Meta:
-        abstract = True
\ No newline at end of file
+        abstract = True
+
+
+def bump_page_content_version(sender, instance, **kwargs):
+    """
+    Signal handler that changes the content version and the last modified time
+    of the page when page content changes.
+    """
+    if issubclass(sender, ContentBase):
+        with publication_manager.select_published(False):
+            Page.objects.filter(id=instance.page_id).update(last_modified=timezone.now())
+        bump_version(PAGE_TREE_VERSION)  # The page tree snapshot contains the last modified time.
+        bump_version(CONTENT_VERSION)
+
+
+models.signals.post_save.connect(bump_page_content_version)
+
+models.signals.post_delete.connect(bump_page_content_version)
@@ -1,14 +1,60 @@
 """Tests for the pages app."""
 
+import json, os, tempfile
+from datetime import timedelta
+
+from django.conf.urls import patterns, url
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import Http404, HttpResponse, HttpResponseNotFound
+from django.test.client import RequestFactory
+from django.views.generic import View, DetailView
 from django.test import TestCase
 from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
 
 from cms import externals
-from cms.apps.pages.models import Page, ContentBase
+from cms.publication import get_next_transition, get_transition_timeout, get_publication_epoch, run_publication_transitions
+from cms.middleware import PublicationMiddleware
+from cms.models import publication_manager
+from cms.apps.pages.models import Page, ContentBase, prefetch_content
+from cms.apps.pages.middleware import RequestPageManager, PageMiddleware, resolve_page_path
+from cms.apps.pages.tree import get_page_tree
+from cms.apps.pages.management.commands.import_pages import iter_json_items
+from cms.apps.pages.views import PageConditionalMixin
+
+
+def test_page_view(request):
+    test_page_view.calls += 1
+    return HttpResponse(request.pages.current.title)
+
+test_page_view.calls = 0
+
+
+urlpatterns = patterns("",
+    url(r"^$", test_page_view),
+)
+
+
+class TestConditionalView(PageConditionalMixin, View):
+    
+    def get(self, request):
+        return HttpResponse(request.pages.current.title)
+
+
+class TestConditionalDetailView(PageConditionalMixin, DetailView):
+    
+    model = Page
+    
+    def render_to_response(self, context):
+        return HttpResponse(self.object.title)
 
 
 class TestPageContent(ContentBase):
     
+    urlconf = __name__
+    
     class Meta:
         app_label = "pages"
 
@@ -28,6 +74,7 @@ class PageEfficiencyTest(TestCase):
             self.section = Page.objects.create(
                 parent = self.homepage,
                 title = "Section",
+                url_title = "section",
                 content_type = content_type,
             )
             TestPageContent.objects.create(
@@ -36,6 +83,7 @@ class PageEfficiencyTest(TestCase):
             self.subsection = Page.objects.create(
                 parent = self.section,
                 title = "Subsection",
+                url_title = "subsection",
                 content_type = content_type,
             )
             TestPageContent.objects.create(
@@ -44,6 +92,7 @@ class PageEfficiencyTest(TestCase):
             self.subsubsection = Page.objects.create(
                 parent = self.subsection,
                 title = "Subsubsection",
+                url_title = "subsubsection",
                 content_type = content_type,
             )
             TestPageContent.objects.create(
@@ -66,4 +115,354 @@ class PageEfficiencyTest(TestCase):
         self.assertEqual(subsubsection.title, "Subsubsection")
         with self.assertNumQueries(0):
             subsubsection = subsection.children[0]
-        self.assertEqual(subsubsection.title, "Subsubsection")
\ No newline at end of file
+        self.assertEqual(subsubsection.title, "Subsubsection")
+        
+    def testBreadcrumbs(self):
+        path = "/section/subsection/subsubsection/foo/"
+        # The homepage is loaded with its prefetched children, plus a single path lookup.
+        with self.assertNumQueries(4):
+            pages = RequestPageManager(path, path)
+            breadcrumbs = pages.breadcrumbs
+        self.assertEqual([page.id for page in breadcrumbs], [
+            self.homepage.id,
+            self.section.id,
+            self.subsection.id,
+            self.subsubsection.id,
+        ])
+        with self.assertNumQueries(0):
+            self.assertEqual(pages.current.get_absolute_url(), "/section/subsection/subsubsection/")
+            self.assertEqual(pages.current.parent.parent, pages.section)
+        self.assertFalse(pages.is_exact)
+        
+    def testPathMaintenance(self):
+        self.section.url_title = "renamed"
+        self.section.save()
+        self.assertEqual(Page.objects.get(id=self.subsubsection.id).get_absolute_url(), "/renamed/subsection/subsubsection/")
+        # Move a branch.
+        subsection = Page.objects.get(id=self.subsection.id)
+        subsection.parent = self.homepage
+        subsection.save()
+        self.assertEqual(Page.objects.get(id=self.subsubsection.id).get_absolute_url(), "/subsection/subsubsection/")
+        self.assertEqual(Page.objects.get(id=self.section.id).get_absolute_url(), "/renamed/")
+        
+    def testTreeSnapshot(self):
+        with self.settings(PAGES_TREE_SNAPSHOT=True):
+            get_page_tree()
+            path = "/section/subsection/subsubsection/"
+            with self.assertNumQueries(0):
+                pages = RequestPageManager(path, path)
+                self.assertEqual([page.id for page in pages.breadcrumbs], [
+                    self.homepage.id,
+                    self.section.id,
+                    self.subsection.id,
+                    self.subsubsection.id,
+                ])
+                self.assertEqual(pages.section.title, "Section")
+                self.assertEqual(pages.homepage.navigation[0].navigation[0].title, "Subsection")
+                self.assertEqual(pages.current.get_absolute_url(), path)
+                self.assertTrue(pages.is_exact)
+            # Changes to the tree should be picked up by the next request.
+            self.subsection.is_online = False
+            self.subsection.save()
+            with publication_manager.select_published(True):
+                pages = RequestPageManager(path, path)
+                self.assertEqual(pages.current.id, self.section.id)
+                self.assertEqual(pages.section.children, [])
+            with publication_manager.select_published(False):
+                pages = RequestPageManager(path, path)
+                self.assertEqual(pages.current.id, self.subsubsection.id)
+        
+    def assertTreeValid(self):
+        pages = dict((page.id, page) for page in Page.objects.all())
+        for page in pages.itervalues():
+            self.assertTrue(page.left < page.right)
+            ancestor_ids = set()
+            parent_id = page.parent_id
+            while parent_id is not None:
+                ancestor_ids.add(parent_id)
+                parent_id = pages[parent_id].parent_id
+            self.assertEqual(ancestor_ids, set(
+                ancestor.id for ancestor in pages.itervalues()
+                if ancestor.left < page.left and ancestor.right > page.right
+            ))
+        
+    def testGappedNumbering(self):
+        content_type = ContentType.objects.get_for_model(TestPageContent)
+        with self.settings(PAGES_TREE_STRIDE=1000):
+            # Force a rebalance of the whole tree.
+            page = Page.objects.create(
+                parent = self.subsection,
+                title = "Foo",
+                url_title = "foo",
+                content_type = content_type,
+            )
+            self.assertTreeValid()
+            # Inserts should now only touch the inserted page.
+            values = dict(Page.objects.values_list("id", "left"))
+            for n in xrange(5):
+                Page.objects.create(
+                    parent = self.section,
+                    title = "Bar",
+                    url_title = "bar-{n}".format(n=n),
+                    content_type = content_type,
+                )
+                self.assertTreeValid()
+            self.assertEqual(values, dict(Page.objects.filter(id__in=values.keys()).values_list("id", "left")))
+            # Move a branch.
+            subsection = Page.objects.get(id=self.subsection.id)
+            subsection.parent = self.homepage
+            subsection.save()
+            self.assertTreeValid()
+            self.assertEqual(Page.objects.get(id=page.id).get_absolute_url(), "/subsection/foo/")
+            # Delete a branch.
+            subsection.delete()
+            self.assertTreeValid()
+        # Gapped trees can still be modified without gaps.
+        Page.objects.create(
+            parent = self.section,
+            title = "Baz",
+            url_title = "baz",
+            content_type = content_type,
+        )
+        self.assertTreeValid()
+        
+    def testBulkInsertTree(self):
+        content_type = ContentType.objects.get_for_model(TestPageContent)
+        def branch(url_title, *children):
+            page = Page(title=url_title.title(), url_title=url_title, content_type=content_type)
+            return (page, TestPageContent(), list(children))
+        for stride in (0, 1000):
+            with self.settings(PAGES_TREE_STRIDE=stride):
+                pages = Page.objects.bulk_insert_tree([
+                    branch("foo{stride}".format(stride=stride), branch("bar"), branch("baz", branch("qux"))),
+                ], parent=self.section)
+                self.assertTreeValid()
+                self.assertEqual(len(pages), 4)
+                qux = Page.objects.get(id=pages[-1].id)
+                self.assertEqual(qux.get_absolute_url(), "/section/foo{stride}/baz/qux/".format(stride=stride))
+                self.assertEqual(qux.parent_id, pages[2].id)
+                self.assertEqual(qux.content.page_id, qux.id)
+        
+    def testImportPages(self):
+        handle, filename = tempfile.mkstemp(suffix=".csv")
+        try:
+            with os.fdopen(handle, "wb") as output:
+                output.write("path,title,content_type,is_online\n")
+                output.write("foo,Foo,pages.testpagecontent,1\n")
+                output.write("foo/bar,Bar,pages.testpagecontent,0\n")
+                output.write("baz,Baz,pages.testpagecontent,1\n")
+                output.write("foo/qux,Qux,pages.testpagecontent,1\n")
+            # Insert one page at a time, so later pages are placed beneath saved ones.
+            call_command("import_pages", filename, parent="/section/", batch_size=1, stdout=open(os.devnull, "w"))
+        finally:
+            os.remove(filename)
+        self.assertTreeValid()
+        bar = Page.objects.get(path="section/foo/bar/")
+        self.assertEqual(bar.title, "Bar")
+        self.assertFalse(bar.is_online)
+        self.assertEqual(bar.parent.parent_id, self.section.id)
+        self.assertEqual([page.url_title for page in bar.parent.children], ["bar", "qux"])
+        
+    def testImportPagesJson(self):
+        handle, filename = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(handle, "wb") as output:
+                json.dump([
+                    {"title": "Foo", "url_title": "foo", "content_type": "pages.testpagecontent", "children": [
+                        {"title": "Bar", "url_title": "bar", "content_type": "pages.testpagecontent"},
+                    ]},
+                    {"title": "Baz", "url_title": "baz", "content_type": "pages.testpagecontent"},
+                ], output)
+            with open(filename, "rb") as input_file:
+                # Items are decoded correctly when split across reads.
+                self.assertEqual(len(list(iter_json_items(input_file, read_size=7))), 2)
+            call_command("import_pages", filename, parent="/section/", batch_size=1, stdout=open(os.devnull, "w"))
+        finally:
+            os.remove(filename)
+        self.assertTreeValid()
+        self.assertEqual(Page.objects.get(path="section/foo/bar/").title, "Bar")
+        self.assertEqual(Page.objects.get(path="section/baz/").parent_id, self.section.id)
+        
+    def testRebuildTree(self):
+        self.assertEqual(Page.objects.rebuild_tree(check=True), [])
+        # Corrupt the tree.
+        Page.objects.filter(id=self.subsection.id).update(left=100, right=101, path="foo/")
+        Page.objects.filter(id=self.homepage.id).update(right=3)
+        self.assertEqual(Page.objects.rebuild_tree(check=True), [self.homepage.id, self.subsection.id])
+        self.assertEqual(Page.objects.get(id=self.subsection.id).left, 100)
+        # Repair the tree.
+        self.assertEqual(Page.objects.rebuild_tree(), [self.homepage.id, self.subsection.id])
+        self.assertTreeValid()
+        self.assertEqual(Page.objects.get(id=self.subsubsection.id).path, "section/subsection/subsubsection/")
+        self.assertEqual(Page.objects.rebuild_tree(check=True), [])
+        
+    def testRebuildGappedTree(self):
+        content_type = ContentType.objects.get_for_model(TestPageContent)
+        with self.settings(PAGES_TREE_STRIDE=1000):
+            for n in xrange(3):
+                Page.objects.create(
+                    parent = self.section,
+                    title = "Foo",
+                    url_title = "foo-{n}".format(n=n),
+                    content_type = content_type,
+                )
+            # A valid tree with gaps is not corrupt.
+            self.assertEqual(Page.objects.rebuild_tree(check=True), [])
+            values = dict((page_id, (left, right)) for page_id, left, right in Page.objects.values_list("id", "left", "right"))
+            # Only the corrupt branch is renumbered, into the gap around it.
+            foo = Page.objects.get(path="section/foo-1/")
+            Page.objects.filter(id=foo.id).update(left=values[self.homepage.id][1] + 10)
+            self.assertEqual(Page.objects.rebuild_tree(check=True), [foo.id])
+            self.assertEqual(Page.objects.rebuild_tree(), [foo.id])
+            self.assertTreeValid()
+            del values[foo.id]
+            self.assertEqual(values, dict((page_id, (left, right)) for page_id, left, right in Page.objects.exclude(id=foo.id).values_list("id", "left", "right")))
+            self.assertEqual(Page.objects.rebuild_tree(check=True), [])
+        
+    def testPrefetchContent(self):
+        with self.assertNumQueries(2):
+            pages = list(Page.objects.prefetch_content().order_by("left"))
+            self.assertEqual(len(pages), 4)
+            for page in pages:
+                self.assertEqual(page.content.page, page)
+        # Pages with loaded content are skipped.
+        with self.assertNumQueries(0):
+            prefetch_content(pages)
+        # Prefetching works with the _base_manager, as used by the search adapter.
+        with self.assertNumQueries(2):
+            for page in Page._base_manager.filter(parent=None).prefetch_content():
+                self.assertEqual(page.content.page_id, self.homepage.id)
+        
+    def testEffectivePublication(self):
+        def get_published_ids():
+            with publication_manager.select_published(True):
+                return set(Page.objects.values_list("id", flat=True))
+        # Taking a page offline hides its whole branch.
+        self.section.is_online = False
+        self.section.save()
+        self.assertFalse(Page.objects.get(id=self.subsubsection.id).effective_online)
+        self.assertEqual(get_published_ids(), set([self.homepage.id]))
+        # Moving a page out of the branch publishes it again.
+        subsubsection = Page.objects.get(id=self.subsubsection.id)
+        subsubsection.parent = self.homepage
+        subsubsection.save()
+        self.assertEqual(get_published_ids(), set([self.homepage.id, self.subsubsection.id]))
+        # Publication dates are inherited.
+        publication_date = timezone.now() + timedelta(days=1)
+        Page.objects.filter(id=self.section.id).update(is_online=True, publication_date=publication_date)
+        Page.objects.update_publication([self.section.id])
+        self.assertEqual(Page.objects.get(id=self.subsection.id).effective_from, publication_date)
+        self.assertEqual(get_published_ids(), set([self.homepage.id, self.subsubsection.id]))
+        self.assertEqual(Page.objects.rebuild_tree(check=True), [])
+        
+    def testPublicationTransitions(self):
+        now = timezone.now()
+        self.assertEqual(get_next_transition(), None)
+        self.assertEqual(get_transition_timeout(60), 60)
+        # Scheduling a page invalidates the cached transition.
+        publication_date = now + timedelta(minutes=5)
+        self.subsection.publication_date = publication_date
+        self.subsection.save()
+        self.assertEqual(get_next_transition(), publication_date)
+        self.assertEqual(get_next_transition(now + timedelta(minutes=5)), None)
+        self.assertTrue(0 < get_transition_timeout(3600) <= 300)
+        # The epoch only changes once the transition has passed.
+        run_publication_transitions(now)
+        epoch = get_publication_epoch()
+        self.assertFalse(run_publication_transitions(now + timedelta(minutes=1)))
+        self.assertEqual(get_publication_epoch(), epoch)
+        self.assertTrue(run_publication_transitions(now + timedelta(minutes=6)))
+        self.assertNotEqual(get_publication_epoch(), epoch)
+        
+    def testResponseCache(self):
+        def get_response(user=AnonymousUser(), **params):
+            request = RequestFactory().get("/section/", params)
+            request.user = user
+            publication_middleware = PublicationMiddleware()
+            page_middleware = PageMiddleware()
+            publication_middleware.process_request(request)
+            response = page_middleware.process_request(request) or HttpResponseNotFound()
+            response = page_middleware.process_response(request, response)
+            return publication_middleware.process_response(request, response)
+        with self.settings(PAGES_RESPONSE_CACHE_TIMEOUT=60):
+            calls = test_page_view.calls
+            self.assertEqual(get_response().content, "Section")
+            self.assertEqual(get_response().content, "Section")
+            self.assertEqual(test_page_view.calls, calls + 1)
+            # Content changes invalidate the cache.
+            self.section.content.save()
+            get_response()
+            self.assertEqual(test_page_view.calls, calls + 2)
+            self.section.title = "Foo"
+            self.section.save()
+            self.assertEqual(get_response().content, "Foo")
+            self.assertEqual(test_page_view.calls, calls + 3)
+            # Staff never use the cache.
+            staff = User(username="staff", is_staff=True)
+            get_response(staff)
+            get_response(staff, preview=1)
+            self.assertEqual(test_page_view.calls, calls + 5)
+            # Requests handled by the project urlconf don't look up the cache.
+            request = RequestFactory().get("/sitemap.xml")
+            request.user = AnonymousUser()
+            request.pages = RequestPageManager(request.path, request.path_info)
+            with self.assertNumQueries(0):
+                self.assertEqual(PageMiddleware().get_response_cache_key(request), None)
+            # Responses that vary on request headers other than the cookie are not cached.
+            for vary, cached in (("Accept-Language", False), ("Cookie", True)):
+                cache.clear()
+                request = RequestFactory().get("/section/")
+                request._page_response_cache_key = "test"
+                response = HttpResponse("Section")
+                response["Vary"] = vary
+                PageMiddleware().cache_response(request, response)
+                self.assertEqual(cache.get("test") is not None, cached)
+        
+    def testResolvePagePath(self):
+        match = resolve_page_path("/", __name__)
+        self.assertEqual(match.func, test_page_view)
+        self.assertTrue(resolve_page_path("/", __name__) is match)
+        self.assertEqual(resolve_page_path("/foo/", __name__), None)
+        # Dispatching does not need to load the page content.
+        self.assertEqual(Page.objects.get(id=self.section.id).content_cls.urlconf, __name__)
+        
+    def testDispatchFirst(self):
+        def process_request(path):
+            request = RequestFactory().get(path)
+            return PageMiddleware().process_request(request)
+        self.assertEqual(process_request("/section/"), None)
+        with self.settings(PAGES_DISPATCH_FIRST=True):
+            self.assertEqual(process_request("/section/").content, "Section")
+            # Unmatched paths fall back to the project urlconf.
+            self.assertEqual(process_request("/section/foo/"), None)
+        
+    def testConditionalGet(self):
+        view = TestConditionalView.as_view()
+        def get_response(**headers):
+            request = RequestFactory().get("/section/", **headers)
+            request.user = AnonymousUser()
+            request.pages = RequestPageManager(request.path, request.path_info)
+            with publication_manager.select_published(True):
+                return view(request)
+        response = get_response()
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+        self.assertEqual(get_response(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(get_response(HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        # A "*" ETag is not enough to skip the view.
+        self.assertEqual(get_response(HTTP_IF_NONE_MATCH="*").status_code, 200)
+        # Detail views only respond with 304 Not Modified for objects that exist.
+        detail_view = TestConditionalDetailView.as_view()
+        def get_detail_response(pk, **headers):
+            request = RequestFactory().get("/section/", **headers)
+            request.user = AnonymousUser()
+            request.pages = RequestPageManager(request.path, request.path_info)
+            with publication_manager.select_published(True):
+                return detail_view(request, pk=pk)
+        last_modified = get_detail_response(self.section.id)["Last-Modified"]
+        self.assertEqual(get_detail_response(self.section.id, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertRaises(Http404, lambda: get_detail_response(0, HTTP_IF_MODIFIED_SINCE=last_modified))
+        # Saving the page content changes the validators.
+        self.section.content.save()
+        self.assertEqual(get_response(HTTP_IF_NONE_MATCH=etag).status_code, 200)
@@ -0,0 +1,217 @@
+"""
+In-memory snapshots of the page tree.
+
+Loading the page tree for every request is expensive on large sites. Instead,
+each process can hold an immutable snapshot of the whole tree, which is only
+rebuilt when the page tree version changes.
+
+Snapshots are enabled using the PAGES_TREE_SNAPSHOT setting. As the page tree
+version is stored in the default cache, this should only be enabled if the
+default cache is shared between all processes serving the site.
+"""
+
+from __future__ import with_statement
+
+import threading
+
+from django.conf import settings
+from django.db import router
+from django.utils import timezone
+
+from cms.cache import get_version
+from cms.models.managers import publication_manager
+from cms.apps.pages.models import Page, PAGE_TREE_VERSION
+
+
+def is_tree_snapshot_enabled():
+    """Returns whether page tree snapshots should be used."""
+    return getattr(settings, "PAGES_TREE_SNAPSHOT", False)
+
+
+class PageTree(object):
+
+    """
+    An immutable snapshot of the whole page tree.
+
+    The snapshot stores the field values of every page, indexed by id, path
+    and parent.
+    """
+
+    def __init__(self, version, rows, db=None):
+        """
+        Initializes the PageTree.
+
+        The rows should be tuples of page field values, in the order of the
+        page's concrete fields, ordered by their left value.
+        """
+        self.version = version
+        self._db = db
+        self.homepage_id = None
+        field_indexes = dict(
+            (field.attname, index)
+            for index, field
+            in enumerate(Page._meta.concrete_fields)
+        )
+        id_index = field_indexes["id"]
+        parent_id_index = field_indexes["parent_id"]
+        path_index = field_indexes["path"]
+        self._effective_online_index = field_indexes["effective_online"]
+        self._effective_from_index = field_indexes["effective_from"]
+        self._effective_until_index = field_indexes["effective_until"]
+        rows_by_id = {}
+        path_ids = {}
+        child_ids = {}
+        for row in rows:
+            page_id = row[id_index]
+            parent_id = row[parent_id_index]
+            rows_by_id[page_id] = row
+            path_ids[row[path_index]] = page_id
+            child_ids.setdefault(parent_id, []).append(page_id)
+            if parent_id is None and self.homepage_id is None:
+                self.homepage_id = page_id
+        self._rows = rows_by_id
+        self._path_ids = path_ids
+        self._child_ids = dict(
+            (parent_id, tuple(ids))
+            for parent_id, ids
+            in child_ids.iteritems()
+        )
+
+    def __len__(self):
+        """Returns the number of pages in the tree."""
+        return len(self._rows)
+
+    def __contains__(self, page_id):
+        """Checks whether the given page id is in the tree."""
+        return page_id in self._rows
+
+    def get_page_id(self, path):
+        """Returns the id of the page with the given path, or None."""
+        return self._path_ids.get(path)
+
+    def get_child_ids(self, page_id):
+        """Returns the ids of the children of the given page, in tree order."""
+        return self._child_ids.get(page_id, ())
+
+    def is_published(self, page_id, now):
+        """
+        Checks whether the given page, and all of its ancestors, are published
+        at the given time.
+        """
+        row = self._rows[page_id]
+        effective_from = row[self._effective_from_index]
+        effective_until = row[self._effective_until_index]
+        return (
+            row[self._effective_online_index] and
+            (effective_from is None or effective_from <= now) and
+            (effective_until is None or effective_until > now)
+        )
+
+    def create_page(self, page_id):
+        """
+        Creates a new page instance from the snapshot.
+
+        The page will not be linked to any other page instances.
+        """
+        page = Page(*self._rows[page_id])
+        page._state.adding = False
+        page._state.db = self._db
+        return page
+
+
+def load_page_tree(version):
+    """Loads a snapshot of the page tree from the database."""
+    field_names = [field.name for field in Page._meta.concrete_fields]
+    with publication_manager.select_published(False):
+        rows = Page.objects.values_list(*field_names).order_by("left")
+        return PageTree(version, rows, router.db_for_read(Page))
+
+
+# The page tree snapshot for this process.
+_page_tree = None
+
+_page_tree_lock = threading.Lock()
+
+
+def get_page_tree():
+    """
+    Returns a snapshot of the page tree.
+
+    The snapshot is only reloaded from the database if the page tree has changed
+    since it was last loaded.
+    """
+    global _page_tree
+    version = get_version(PAGE_TREE_VERSION)
+    page_tree = _page_tree
+    if page_tree is None or page_tree.version != version:
+        with _page_tree_lock:
+            page_tree = _page_tree
+            if page_tree is None or page_tree.version != version:
+                page_tree = _page_tree = load_page_tree(version)
+    return page_tree
+
+
+class PageTreeLoader(object):
+
+    """
+    Creates linked page instances from a page tree snapshot.
+
+    A loader should only be used for the duration of a single request, as it
+    caches the instances it creates.
+    """
+
+    def __init__(self, page_tree, select_published, now=None):
+        """Initializes the PageTreeLoader."""
+        self._page_tree = page_tree
+        self._select_published = select_published
+        self._now = now or timezone.now()
+        self._pages = {}
+
+    def get_page(self, page_id):
+        """
+        Returns the page with the given id, or None if the page does not exist
+        or is not published.
+        """
+        try:
+            return self._pages[page_id]
+        except KeyError:
+            pass
+        page = None
+        page_tree = self._page_tree
+        if page_id in page_tree and (not self._select_published or page_tree.is_published(page_id, self._now)):
+            page = page_tree.create_page(page_id)
+            page._tree_loader = self
+            if page.parent_id is not None:
+                parent = self.get_page(page.parent_id)
+                if parent is not None:
+                    page.parent = parent
+        self._pages[page_id] = page
+        return page
+
+    @property
+    def homepage(self):
+        """Returns the site homepage, or None."""
+        if self._page_tree.homepage_id is None:
+            return None
+        return self.get_page(self._page_tree.homepage_id)
+
+    def get_pages_by_path(self, paths):
+        """Returns the pages with the given paths, in tree order."""
+        pages = []
+        for path in paths:
+            page_id = self._page_tree.get_page_id(path)
+            if page_id is not None:
+                page = self.get_page(page_id)
+                if page is not None:
+                    pages.append(page)
+        pages.sort(key=lambda page: page.left)
+        return pages
+
+    def get_children(self, page):
+        """Returns the child pages for the given page."""
+        children = []
+        for child_id in self._page_tree.get_child_ids(page.id):
+            child = self.get_page(child_id)
+            if child is not None:
+                children.append(child)
+        return children
@@ -1,10 +1,108 @@
 """Views used by the pages app."""
 
+import calendar, hashlib, time
+
 from django.contrib.contenttypes.models import ContentType
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
 from django.views.generic import TemplateView
+from django.views.generic.detail import SingleObjectMixin
+
+from cms.cache import get_version, get_version_modified, CONTENT_VERSION
+from cms.models import publication_manager
+from cms.publication import PUBLICATION_VERSION
+from cms.apps.pages.models import PAGE_TREE_VERSION
+
 
+def get_timestamp(value):
+    """Converts the given datetime into a UNIX timestamp."""
+    if value.tzinfo is None:
+        return int(time.mktime(value.timetuple()))
+    return calendar.timegm(value.utctimetuple())
+
+
+class PageConditionalMixin(object):
+    
+    """
+    Responds to conditional GET requests with 304 Not Modified if the response
+    would not have changed.
+    
+    The ETag and Last-Modified validators are calculated before the view does
+    any work, from the page tree version, the content version, the publication
+    epoch and the last modified time of the current page. Detail views only
+    respond with 304 Not Modified once their object has been found. Conditional
+    requests are only handled for anonymous visitors outside of preview mode.
+    """
+    
+    def get_validators(self):
+        """
+        Returns a list of (version, last_modified) tuples for everything that the
+        response depends on.
+        """
+        page = self.request.pages.current
+        return [
+            (get_version(PAGE_TREE_VERSION), get_version_modified(PAGE_TREE_VERSION)),
+            (get_version(CONTENT_VERSION), get_version_modified(CONTENT_VERSION)),
+            (get_version(PUBLICATION_VERSION), get_version_modified(PUBLICATION_VERSION)),
+            (page.id, page.last_modified),
+        ]
+    
+    def get_not_modified_response(self):
+        """Returns a 304 Not Modified response if the client's copy is still current, or None."""
+        if_none_match = self.request.META.get("HTTP_IF_NONE_MATCH")
+        if_modified_since = parse_http_date_safe(self.request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+        if if_none_match or if_modified_since:
+            # A "*" ETag would match missing objects too, so only exact ETags are accepted.
+            etags = parse_etags(if_none_match) if if_none_match else ()
+            if (not if_none_match or self._etag in etags) and (not if_modified_since or self._last_modified <= if_modified_since):
+                response = HttpResponseNotModified()
+                response["ETag"] = quote_etag(self._etag)
+                response["Last-Modified"] = http_date(self._last_modified)
+                return response
+        return None
+    
+    def dispatch(self, request, *args, **kwargs):
+        """Dispatches the request, handling conditional GET requests."""
+        self._etag = None
+        user = getattr(request, "user", None)
+        if request.method not in ("GET", "HEAD") or not publication_manager.select_published_active() or (user is not None and user.is_authenticated()):
+            return super(PageConditionalMixin, self).dispatch(request, *args, **kwargs)
+        # Calculate the validators.
+        validators = self.get_validators()
+        self._etag = hashlib.md5(repr((request.get_full_path(),) + tuple(
+            version for version, _ in validators
+        ))).hexdigest()
+        self._last_modified = max(get_timestamp(modified) for _, modified in validators)
+        # Check whether the client's copy is still current. Detail views check once the object is found.
+        if not isinstance(self, SingleObjectMixin):
+            response = self.get_not_modified_response()
+            if response is not None:
+                return response
+        # Generate the response.
+        response = super(PageConditionalMixin, self).dispatch(request, *args, **kwargs)
+        if response.status_code == 200 and not response.has_header("ETag"):
+            response["ETag"] = quote_etag(self._etag)
+            response["Last-Modified"] = http_date(self._last_modified)
+        return response
+    
+    def get(self, request, *args, **kwargs):
+        """Checks the validators of detail views once the object has been found."""
+        if isinstance(self, SingleObjectMixin) and self._etag is not None:
+            self._conditional_object = self.get_object()
+            response = self.get_not_modified_response()
+            if response is not None:
+                return response
+        return super(PageConditionalMixin, self).get(request, *args, **kwargs)
+    
+    def get_object(self, *args, **kwargs):
+        """Returns the object already loaded while checking the validators, if any."""
+        obj = getattr(self, "_conditional_object", None)
+        if obj is None:
+            obj = super(PageConditionalMixin, self).get_object(*args, **kwargs)
+        return obj
+        
 
-class ContentIndexView(TemplateView):
+class ContentIndexView(PageConditionalMixin, TemplateView):
     
     """Displays the index page for a page."""
     
@@ -19,4 +117,4 @@ class ContentIndexView(TemplateView):
             "{app_label}/{model_name}.html".format(**params),
             "{app_label}/base.html".format(**params),
             "base.html",
-        )
\ No newline at end of file
+        )
@@ -0,0 +1,79 @@
+"""
+Background tasks.
+
+Work that is scheduled during a request, such as re-rendering stored HTML,
+is queued here once the request has finished, and run one task at a time by
+a single worker thread, so that it does not hold up the response.
+
+Set CMS_BACKGROUND_TASKS to False to run tasks as soon as they are queued,
+in the calling thread.
+"""
+
+from __future__ import with_statement
+
+import atexit, logging, threading, Queue
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger("cms.background")
+
+
+def is_background_enabled():
+    """Checks whether tasks should be run in the background worker thread."""
+    return getattr(settings, "CMS_BACKGROUND_TASKS", True)
+
+
+_queue = Queue.Queue()
+
+_worker = None
+
+_worker_lock = threading.Lock()
+
+
+def _run_task(func, args):
+    """Runs a single task, logging any errors."""
+    try:
+        func(*args)
+    except Exception:
+        logger.exception(u"Background task {func!r} failed.".format(
+            func = func,
+        ))
+
+
+def _run_worker():
+    """Runs queued tasks until the process exits."""
+    while True:
+        func, args = _queue.get()
+        try:
+            _run_task(func, args)
+        finally:
+            # The worker lives for the whole process, so don't leave connections open between tasks.
+            for connection in connections.all():
+                connection.close()
+            _queue.task_done()
+
+
+def run_in_background(func, *args):
+    """Queues the given function to be called with the given arguments in the background."""
+    global _worker
+    if not is_background_enabled():
+        _run_task(func, args)
+        return
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_run_worker, name="cms.background")
+            _worker.daemon = True
+            _worker.start()
+    _queue.put((func, args))
+
+
+def wait_for_background_tasks():
+    """Blocks until all queued tasks have been run."""
+    if _worker is not None:
+        _queue.join()
+
+
+# Don't lose queued work when the process exits.
+atexit.register(wait_for_background_tasks)
@@ -0,0 +1,198 @@
+"""
+Shared version counters used to invalidate CMS caches.
+
+A version counter is a number stored in the Django cache that changes every
+time the data it describes changes. Cache entries that include the version in
+their key are then implicitly invalidated, without having to track them down
+and delete them.
+
+For the counters to be useful in a multi-process deployment, the default cache
+must be shared between processes (e.g. memcached).
+"""
+
+import datetime, threading, time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+
+
+def _get_version_key(name):
+    """Returns the cache key used to store the named version."""
+    return u"cms.version.{name}".format(
+        name = name,
+    )
+
+
+def _get_initial_version():
+    """
+    Returns a starting value for a version counter.
+
+    The value is based on the current time, so that a counter that has been
+    evicted from the cache will never be reset to a value that a process might
+    already have cached data under.
+    """
+    return int(time.time() * 1000000)
+
+
+def _get_modified_key(name):
+    """Returns the cache key used to store the time the named version last changed."""
+    return u"cms.version.{name}.modified".format(
+        name = name,
+    )
+
+
+def get_version(name):
+    """Returns the current value of the named version counter."""
+    key = _get_version_key(name)
+    version = cache.get(key)
+    if version is None:
+        version = _get_initial_version()
+        if cache.add(key, version, None):
+            cache.set(_get_modified_key(name), time.time(), None)
+        else:
+            version = cache.get(key, version)
+    return version
+
+
+def get_versions(names):
+    """
+    Returns a dictionary of the current values of the named version counters,
+    using a single cache fetch.
+    
+    Version counters that have not been set are left out of the dictionary.
+    """
+    keys = dict(
+        (_get_version_key(name), name)
+        for name
+        in names
+    )
+    return dict(
+        (keys[key], version)
+        for key, version
+        in cache.get_many(keys.keys()).iteritems()
+    )
+
+
+def get_version_modified(name):
+    """
+    Returns the time that the named version counter last changed, as a
+    datetime.
+    
+    If the time is not known, then the current time is assumed.
+    """
+    key = _get_modified_key(name)
+    modified = cache.get(key)
+    if modified is None:
+        modified = time.time()
+        if not cache.add(key, modified, None):
+            modified = cache.get(key, modified)
+    return datetime.datetime.fromtimestamp(modified, timezone.utc if settings.USE_TZ else None)
+
+
+def _bump_version(name):
+    """Changes the value of the named version counter."""
+    key = _get_version_key(name)
+    cache.set(_get_modified_key(name), time.time(), None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # The counter has not been set, or has been evicted from the cache.
+        version = _get_initial_version()
+        cache.set(key, version, None)
+        return version
+
+
+# The name of the version counter that changes whenever any page content changes.
+CONTENT_VERSION = "content"
+
+
+def bump_content_version(sender, **kwargs):
+    """Signal handler that changes the content version."""
+    bump_version(CONTENT_VERSION)
+
+
+def get_object_version_name(app_label, model_name, object_id):
+    """Returns the name of the version counter for a single object."""
+    return u"object.{app_label}.{model_name}.{object_id}".format(
+        app_label = app_label,
+        model_name = model_name,
+        object_id = object_id,
+    )
+
+
+def has_object_versions(model):
+    """
+    Checks whether version counters are kept for instances of the given model.
+    
+    Object versions are only read when expanding permalinks, which requires
+    the model to have a get_absolute_url() method.
+    """
+    return hasattr(model, "get_absolute_url")
+
+
+def bump_object_version(sender, instance, **kwargs):
+    """
+    Signal handler that changes the version counter for a single object.
+    
+    The counter is only changed if it has been set, as nothing can depend on a
+    version counter that does not exist. Models without object versions are
+    ignored without accessing the cache.
+    """
+    if instance.pk is None or not has_object_versions(sender):
+        return
+    opts = instance._meta.concrete_model._meta
+    name = get_object_version_name(opts.app_label, opts.object_name.lower(), instance.pk)
+    if cache.get(_get_version_key(name)) is not None:
+        bump_version(name)
+
+
+# Version counters waiting for the current transaction to be committed.
+_pending_versions = threading.local()
+
+
+def _install_commit_hook(connection):
+    """Makes the given database connection change all pending version counters when it commits."""
+    if getattr(connection, "_version_commit_hook_installed", False):
+        return
+    commit = connection.commit
+    def commit_and_bump_versions():
+        commit()
+        bump_pending_versions()
+    connection.commit = commit_and_bump_versions
+    connection._version_commit_hook_installed = True
+
+
+def bump_version(name):
+    """
+    Changes the value of the named version counter.
+
+    If this is called within a database transaction, then the counter will be
+    changed again once the transaction has been committed. This prevents other
+    processes from caching data read before the transaction was committed
+    under the new version.
+    """
+    version = _bump_version(name)
+    connection = connections[DEFAULT_DB_ALIAS]
+    if connection.in_atomic_block or not connection.get_autocommit():
+        _install_commit_hook(connection)
+        if not hasattr(_pending_versions, "names"):
+            _pending_versions.names = set()
+        _pending_versions.names.add(name)
+    return version
+
+
+def bump_pending_versions():
+    """Changes all version counters that were changed within a transaction."""
+    names = getattr(_pending_versions, "names", None)
+    if names:
+        _pending_versions.names = set()
+        for name in names:
+            _bump_version(name)
+
+
+post_save.connect(bump_object_version)
+
+post_delete.connect(bump_object_version)
@@ -1,81 +1,467 @@
 """HTML processing routines."""
 
 
-import re
+import re, hashlib, operator, threading
 
-from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
+from django.core import urlresolvers
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
 from django.db import models
+from django.db.models import Q, F
+from django.db.models.signals import post_save, post_delete
 from django.utils.html import escape
 
-import optimizations
+from cms import permalinks, thumbnails
+from cms.background import run_in_background
+from cms.cache import get_versions, has_object_versions
+from cms.models.fields import precomputed_html_fields
+from cms.models.managers import publication_manager
+from cms.publication import get_transitioned_ids, transitions_passed
+from cms.timing import stage, timed
 
-from cms import permalinks
 
+# A single attribute, with an optional quoted or unquoted value.
+RE_TAG_ATTR = re.compile(ur"""([^\s"'<>/=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'=<>`]+))?""")
 
-RE_TAG = re.compile(ur"<(img|a)(\s+.*?)(/?)>", re.IGNORECASE)
+# A whole <a/> or <img/> tag. Quoted attribute values may contain ">".
+RE_TAG = re.compile(ur"""<(a|img)((?:(?:\s+|(?<=["']))[^\s"'<>/=]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'=<>`]+))?)*)\s*(/?)>""", re.IGNORECASE)
 
-RE_ATTR = re.compile(ur"\s([\w-]+)=(\".*?\"|'.*?')", re.IGNORECASE)
+def iter_tags(text):
+    """
+    Scans the given text for <a/> and <img/> tags.
+    
+    Yields a tuple of (start, end, tagname, attr_text, closing) for each tag.
+    The attr_text can be parsed using parse_attrs(). Closing is "/" for
+    self-closing tags.
+    
+    Quoted attribute values may contain ">". Malformed tags are skipped.
+    """
+    for match in RE_TAG.finditer(text):
+        yield match.start(), match.end(), match.group(1), match.group(2), match.group(3)
 
 
-def process(text):
+def parse_attrs(attr_text):
     """
-    Expands permalinks in <a/> and <img/> tags.
+    Parses the attributes of a tag.
     
-    Images will also be automatically thumbnailed to fit their specified width
-    and height.
+    Returns a list of [name, value] pairs in document order, where the value
+    includes any quotes, or is None for attributes without a value.
+    """
+    return [
+        [name, value or None]
+        for name, value
+        in RE_TAG_ATTR.findall(attr_text)
+    ]
+
+
+def _get_permalink(attr_text):
+    """
+    Returns the unquoted href or src of a tag, without building its attribute list.
+    
+    Attributes are scanned in order, so names inside quoted values are skipped.
+    """
+    for match in RE_TAG_ATTR.finditer(attr_text):
+        if match.group(1).lower() in (u"href", u"src"):
+            value = match.group(2)
+            if value is None:
+                return None
+            return _unquote(value)
+    return None
+
+
+def _unquote(value):
+    """Removes the quotes from an attribute value."""
+    if value[:1] in (u'"', u"'"):
+        return value[1:-1]
+    return value
+
+
+# The attribute that holds the permalink for each processed tag.
+PERMALINK_ATTRS = {
+    "a": "href",
+    "img": "src",
+}
+
+
+def _get_attr_value(attrs, attr_name):
+    """Returns the unquoted value of the given attribute, or None."""
+    for name, value in attrs:
+        if name.lower() == attr_name:
+            if value is None:
+                return None
+            return _unquote(value)
+    return None
+
+
+def _set_attr_value(attrs, attr_name, value, replace=True):
+    """Sets the given attribute to the given quoted value, adding it if it is not present."""
+    for attr in attrs:
+        if attr[0].lower() == attr_name:
+            if replace:
+                attr[1] = value
+            return
+    attrs.append([attr_name, value])
+
+
+def _scan_permalinks(text):
+    """
+    Returns the set of permalinks in <a/> and <img/> tags in the given text,
+    and the set of permalinks used as image sources.
     """
+    values = set()
+    image_values = set()
+    for _, _, tagname, attr_text, _ in iter_tags(text):
+        value = _get_permalink(attr_text)
+        if value is not None:
+            values.add(value)
+            if tagname.lower() == "img":
+                image_values.add(value)
+    return values, image_values
+
+
+def get_permalinks(text):
+    """Returns the set of permalinks in <a/> and <img/> tags in the given text."""
+    return _scan_permalinks(text)[0]
+
+
+def _resolve_permalinks(values, image_values):
+    """
+    Resolves the given permalinks.
+    
+    Returns a dictionary of (obj, url, title) tuples, and a dictionary of the
+    version counters that the result depends on. Objects are only loaded for
+    image permalinks, as they are needed to generate thumbnails.
+    """
+    expanded_permalinks = permalinks.expand_many(values)
+    images = permalinks.resolve_many(image_values) if image_values else {}
     resolved_permalinks = {}
-    def sub_tag(match):
-        tagname = match.group(1)
-        attrs = dict(RE_ATTR.findall(match.group(2)))
-        def get_obj(attr_name):
-            if attr_name in attrs:
-                value = attrs[attr_name][1:-1]
-                if not value in resolved_permalinks:
-                    try:
-                        resolved_permalinks[value] = permalinks.resolve(value)
-                    except (permalinks.PermalinkError, ObjectDoesNotExist):
-                        resolved_permalinks[value] = None
-                obj = resolved_permalinks[value]
-                if obj:
-                    # Add in the URL of the obj.
-                    attrs[attr_name] = '"%s"' % escape(obj.get_absolute_url())
-                    # Add in the title of the obj.
-                    attrs.setdefault("title", u'"%s"' % escape(getattr(obj, "title", unicode(obj))))
-                return obj
-            return None
-        if tagname == "a":
-            # Process hyperlinks.
-            get_obj("href")
-        elif tagname == "img":
-            # Process images.            
-            obj = get_obj("src")
-            if obj:
+    versions = {}
+    for value in values:
+        expanded_permalink = expanded_permalinks.get(value)
+        if expanded_permalink is None:
+            resolved_permalinks[value] = None
+            continue
+        versions.update(expanded_permalink.versions)
+        if expanded_permalink.url is None:
+            resolved_permalinks[value] = None
+        else:
+            resolved_permalinks[value] = (images.get(value), expanded_permalink.url, expanded_permalink.title)
+    return resolved_permalinks, versions
+
+
+def resolve_permalinks(text):
+    """
+    Resolves all permalinks in <a/> and <img/> tags in the given text.
+    
+    Returns a dictionary mapping each permalink to a tuple of (obj, url, title),
+    or None if the permalink could not be resolved. The URLs and titles are
+    cached, and objects are only loaded for images.
+    """
+    return _resolve_permalinks(*_scan_permalinks(text))[0]
+
+
+def _process_tag(tagname, attr_text, closing, resolved_permalinks, pending_thumbnails=None):
+    """
+    Expands the permalink in a single tag.
+    
+    Returns the regenerated tag, or None if the tag does not contain a
+    resolvable permalink. Images whose thumbnail has not been generated yet are
+    added to the list of pending thumbnails.
+    """
+    # Check for a permalink before parsing the rest of the tag.
+    if not resolved_permalinks or not resolved_permalinks.get(_get_permalink(attr_text)):
+        return None
+    attr_name = PERMALINK_ATTRS[tagname.lower()]
+    attrs = parse_attrs(attr_text)
+    resolved_permalink = resolved_permalinks.get(_get_attr_value(attrs, attr_name))
+    if not resolved_permalink:
+        return None
+    obj, url, title = resolved_permalink
+    # Add in the URL of the obj.
+    _set_attr_value(attrs, attr_name, u'"%s"' % escape(url))
+    # Add in the title of the obj.
+    _set_attr_value(attrs, "title", u'"%s"' % escape(title), replace=False)
+    # Process images.
+    if attr_name == "src" and obj is not None:
+        try:
+            width = int(_get_attr_value(attrs, "width"))
+            height = int(_get_attr_value(attrs, "height"))
+        except (ValueError, TypeError):
+            pass
+        else:
+            # Automagically detect a FileField.
+            fieldname = None
+            for field in obj._meta.fields:
+                if isinstance(field, models.FileField):
+                    fieldname = field.name
+            # Generate the thumbnail.
+            if fieldname:
                 try:
-                    width = int(attrs["width"][1:-1])
-                    height = int(attrs["height"][1:-1])
-                except (ValueError, KeyError, TypeError):
+                    thumbnail = thumbnails.get_thumbnail(getattr(obj, fieldname), width, height, "resize")
+                except IOError:
+                    # The thumbnail can't be generated, so keep the original image.
                     pass
                 else:
-                    # Automagically detect a FileField.
-                    fieldname = None
-                    for field in obj._meta.fields:
-                        if isinstance(field, models.FileField):
-                            fieldname = field.name
-                    # Generate the thumbnail.
-                    if fieldname:
-                        try:
-                            thumbnail = optimizations.get_thumbnail(getattr(obj, fieldname), width, height, "resize")
-                        except IOError:
-                            pass
-                        else:
-                            attrs["src"] = '"%s"' % escape(thumbnail.url)
-                            attrs["width"] = '"%s"' % thumbnail.width
-                            attrs["height"] = '"%s"' % thumbnail.height
-        else:
-            assert False
-        # Regenerate the html tag.
-        attrs = u" ".join(u"%s=%s" % (key, value) for key, value in sorted(attrs.iteritems()))
-        return u"<%s %s%s>" % (tagname, attrs, match.group(3))
-    return RE_TAG.sub(sub_tag, text)
+                    if thumbnail is None:
+                        # Use the original image until the thumbnail has been generated.
+                        if pending_thumbnails is not None:
+                            pending_thumbnails.append(obj)
+                    else:
+                        _set_attr_value(attrs, "src", u'"%s"' % escape(thumbnail.url))
+                        _set_attr_value(attrs, "width", u'"%s"' % thumbnail.width)
+                        _set_attr_value(attrs, "height", u'"%s"' % thumbnail.height)
+    # Regenerate the html tag.
+    attrs = u" ".join(
+        name if value is None else u"%s=%s" % (name, value)
+        for name, value
+        in attrs
+    )
+    return u"<%s %s%s>" % (tagname, attrs, closing)
+
+
+def _process(text, resolved_permalinks, pending_thumbnails=None):
+    """
+    Expands permalinks in <a/> and <img/> tags, using the given resolved permalinks.
+    
+    Only tags containing a resolvable permalink are regenerated. The rest of the
+    text is copied through unchanged.
+    """
+    parts = []
+    pos = 0
+    for start, end, tagname, attr_text, closing in iter_tags(text):
+        tag = _process_tag(tagname, attr_text, closing, resolved_permalinks, pending_thumbnails)
+        if tag is not None:
+            parts.append(text[pos:start])
+            parts.append(tag)
+            pos = end
+    if not parts:
+        return text
+    parts.append(text[pos:])
+    return u"".join(parts)
+
+
+@timed("html_process")
+def process(text):
+    """
+    Expands permalinks in <a/> and <img/> tags.
+    
+    Images will also be automatically thumbnailed to fit their specified width
+    and height.
+    
+    All permalinks in the text are resolved up front, so the cost of processing
+    grows with the number of linked content types, not the number of links.
+    """
+    return _process(text, resolve_permalinks(text))
+
+
+def get_cache_timeout():
+    """Returns the number of seconds to cache processed HTML for."""
+    return getattr(settings, "CMS_HTML_CACHE_TIMEOUT", 60 * 60 * 24)
+
+
+def _get_cache_key(text):
+    """Returns the cache key used to store the processed version of the given text."""
+    return u"cms.html.{hash}".format(
+        hash = hashlib.md5(u"{published}:{prefix}:{text}".format(
+            published = int(publication_manager.select_published_active()),
+            prefix = urlresolvers.get_script_prefix(),
+            text = text,
+        ).encode("utf-8")).hexdigest(),
+    )
+
+
+def process_cached(text):
+    """
+    Expands permalinks in <a/> and <img/> tags, caching the result.
+    
+    The cached result is discarded as soon as any object referenced by a
+    permalink changes. Referenced objects can declare further version counters
+    that their URL depends on using a get_cache_dependencies() method.
+    
+    If the text has a precomputed processed version, then it is returned
+    directly, unless unpublished content is being previewed.
+    """
+    processed_text = getattr(text, "processed", None)
+    if processed_text is not None and publication_manager.select_published_active():
+        return processed_text
+    timeout = get_cache_timeout()
+    if not timeout:
+        return process(text)
+    cache_key = _get_cache_key(text)
+    cached_value = cache.get(cache_key)
+    if cached_value is not None:
+        processed_text, versions = cached_value
+        if get_versions(versions.iterkeys()) == versions:
+            return processed_text
+    with stage("html_process"):
+        resolved_permalinks, versions = _resolve_permalinks(*_scan_permalinks(text))
+        pending_thumbnails = []
+        processed_text = _process(text, resolved_permalinks, pending_thumbnails)
+    # Don't cache text that is still waiting for thumbnails.
+    if not pending_thumbnails:
+        cache.set(cache_key, (processed_text, versions), timeout)
+    return processed_text
+
+
+# Precomputed HTML.
+
+def process_for_storage(text):
+    """
+    Expands permalinks in <a/> and <img/> tags, for storing in a HtmlField
+    with a precomputed processed version.
+    
+    Only links to published content are expanded, as the stored version is
+    served to the public. Links to other content are re-rendered when it is
+    saved, or when it is published by a publication transition. Returns None
+    if the text is still waiting for thumbnails.
+    """
+    if not text:
+        return text
+    pending_thumbnails = []
+    with publication_manager.select_published(True):
+        processed_text = _process(text, resolve_permalinks(text), pending_thumbnails)
+    if pending_thumbnails:
+        return None
+    return processed_text
+
+
+# The number of permalinks to search for in a single query.
+RERENDER_BATCH_SIZE = 100
+
+
+def rerender_html_fields(changed_permalinks=None):
+    """
+    Re-renders the precomputed processed version of HtmlFields that link to
+    any of the given permalinks.
+    
+    If no permalinks are given, then every value containing links is
+    re-rendered. Returns the number of values re-rendered.
+    """
+    if changed_permalinks is not None:
+        changed_permalinks = list(changed_permalinks)
+    count = 0
+    with publication_manager.select_published(False):
+        for model, field in precomputed_html_fields:
+            rerendered_pks = set()
+            if changed_permalinks is None:
+                querysets = [model._base_manager.filter(
+                    Q(**{field.processed_attname + "__isnull": True}) |
+                    Q(**{field.attname + "__icontains": u"<a"}) |
+                    Q(**{field.attname + "__icontains": u"<img"})
+                )]
+            else:
+                querysets = [
+                    model._base_manager.filter(reduce(operator.or_, (
+                        Q(**{field.attname + "__contains": permalink})
+                        for permalink
+                        in changed_permalinks[batch_start:batch_start + RERENDER_BATCH_SIZE]
+                    )))
+                    for batch_start
+                    in xrange(0, len(changed_permalinks), RERENDER_BATCH_SIZE)
+                ]
+            for queryset in querysets:
+                for pk, value in queryset.values_list("pk", field.attname).iterator():
+                    # Values can link to permalinks in several batches.
+                    if pk in rerendered_pks:
+                        continue
+                    rerendered_pks.add(pk)
+                    # Skip values that have been changed since they were read, as they have been re-rendered by their save.
+                    count += model._base_manager.filter(pk=pk, **{field.attname: value}).update(**{
+                        field.processed_attname: process_for_storage(value),
+                    })
+    return count
+
+
+# Permalinks whose linking HTML should be re-rendered at the end of the request.
+# This is None outside of a request, when re-renders are run immediately.
+_pending_rerenders = threading.local()
+
+
+def _rerender(pending):
+    """Re-renders the precomputed HTML for the given set of permalinks, where None means everything."""
+    if None in pending:
+        return rerender_html_fields()
+    return rerender_html_fields(pending)
+
+
+def schedule_rerender(*changed_permalinks):
+    """
+    Schedules the precomputed HTML linking to any of the given permalinks to
+    be re-rendered in the background once the current request has finished.
+    Outside of a request, it is re-rendered immediately.
+    
+    If no permalinks are given, then all precomputed HTML containing links
+    will be re-rendered.
+    """
+    if not precomputed_html_fields:
+        return
+    changed_permalinks = set(changed_permalinks) or set((None,))
+    pending = getattr(_pending_rerenders, "permalinks", None)
+    if pending is None:
+        _rerender(changed_permalinks)
+    else:
+        pending.update(changed_permalinks)
+
+
+def schedule_object_rerender(sender, instance, created=False, **kwargs):
+    """Signal handler that schedules the precomputed HTML linking to an object to be re-rendered."""
+    # Nothing can link to a new object, or to an object without a URL.
+    if not precomputed_html_fields or created or instance.pk is None or not has_object_versions(sender):
+        return
+    try:
+        permalink = permalinks.create(instance)
+    except urlresolvers.NoReverseMatch:
+        return
+    schedule_rerender(permalink)
+
+
+def schedule_transition_rerender(sender, start, end, **kwargs):
+    """
+    Signal handler that schedules the precomputed HTML linking to objects
+    published or unpublished by a publication transition to be re-rendered.
+    """
+    if not precomputed_html_fields:
+        return
+    # Without a previous check, anything could have been published.
+    if start is None:
+        schedule_rerender()
+        return
+    changed_permalinks = []
+    for model, ids in get_transitioned_ids(start, end):
+        if not has_object_versions(model):
+            continue
+        for object_id in ids:
+            try:
+                changed_permalinks.append(permalinks.create_for_id(model, object_id))
+            except urlresolvers.NoReverseMatch:
+                break
+    if changed_permalinks:
+        schedule_rerender(*changed_permalinks)
+
+
+def start_pending_rerenders(**kwargs):
+    """Starts collecting the re-renders scheduled by the current request."""
+    _pending_rerenders.permalinks = set()
+
+
+def run_pending_rerenders(**kwargs):
+    """
+    Queues all precomputed HTML scheduled by the current request to be
+    re-rendered in the background.
+    """
+    pending = getattr(_pending_rerenders, "permalinks", None)
+    _pending_rerenders.permalinks = None
+    if pending:
+        run_in_background(_rerender, pending)
+
+
+post_save.connect(schedule_object_rerender)
+
+post_delete.connect(schedule_object_rerender)
+
+transitions_passed.connect(schedule_transition_rerender)
+
+request_started.connect(start_pending_rerenders)
 
+request_finished.connect(run_pending_rerenders)
@@ -0,0 +1,96 @@
+"""Compares the speed of the HTML tokenizer with the regular expressions it replaced."""
+
+from __future__ import with_statement
+
+import re, timeit
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.utils.html import escape
+
+from cms.html import _process
+
+
+# The regular expressions previously used to process HTML.
+RE_TAG = re.compile(ur"<(img|a)(\s+.*?)(/?)>", re.IGNORECASE)
+
+RE_ATTR = re.compile(ur"\s([\w-]+)=(\".*?\"|'.*?')", re.IGNORECASE)
+
+
+def process_regex(text, resolved_permalinks):
+    """Expands permalinks in <a/> tags using regular expressions."""
+    def sub_tag(match):
+        tagname = match.group(1)
+        attrs = dict(RE_ATTR.findall(match.group(2)))
+        attr_name = "href" if tagname.lower() == "a" else "src"
+        if attr_name in attrs:
+            resolved_permalink = resolved_permalinks.get(attrs[attr_name][1:-1])
+            if resolved_permalink:
+                _, url, title = resolved_permalink
+                attrs[attr_name] = '"%s"' % escape(url)
+                attrs.setdefault("title", u'"%s"' % escape(title))
+        attrs = u" ".join(u"%s=%s" % (key, value) for key, value in sorted(attrs.iteritems()))
+        return u"<%s %s%s>" % (tagname, attrs, match.group(3))
+    return RE_TAG.sub(sub_tag, text)
+
+
+PARAGRAPH = (
+    u'<p class="intro">Lorem ipsum dolor sit amet, <strong>consectetur</strong> adipiscing elit. '
+    u'Read the <a href="/r/12-{index}/">related article</a> or visit '
+    u'<a href="http://www.example.com/{index}/" target="_blank" rel="external">our partner</a>. '
+    u'Sed do eiusmod tempor <em>incididunt</em> ut labore et dolore magna aliqua, '
+    u'<a href="/r/12-{index}/" title="Comparison: a &gt; b" data-note="a > b">see also</a>.</p>\n'
+    u'<img src="/media/uploads/{index}.jpg" alt="Figure {index}" width="200" height="100"/>\n'
+)
+
+
+def create_text(size):
+    """Creates a realistic article body of approximately the given size in bytes."""
+    parts = []
+    length = 0
+    index = 0
+    while length < size:
+        part = PARAGRAPH.format(index=index)
+        parts.append(part)
+        length += len(part)
+        index += 1
+    return u"".join(parts), index
+
+
+class Command(NoArgsCommand):
+
+    help = "Compares the speed of HTML processing with the regular expression implementation it replaced."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option("--size",
+            action = "store",
+            type = "int",
+            dest = "size",
+            default = 100,
+            help = "The size of the article body to process, in kilobytes. Defaults to 100.",
+        ),
+        make_option("--iterations",
+            action = "store",
+            type = "int",
+            dest = "iterations",
+            default = 20,
+            help = "The number of times to process the article body. Defaults to 20.",
+        ),
+    )
+
+    def handle_noargs(self, **options):
+        """Runs the command."""
+        text, count = create_text(options["size"] * 1024)
+        resolved_permalinks = dict(
+            (u"/r/12-{index}/".format(index=index), (None, u"/articles/{index}/".format(index=index), u"Article {index}".format(index=index)))
+            for index
+            in xrange(0, count, 2)
+        )
+        iterations = options["iterations"]
+        for name, func in (("regex", process_regex), ("tokenizer", _process)):
+            duration = min(timeit.repeat(lambda: func(text, resolved_permalinks), repeat=3, number=iterations)) / iterations
+            self.stdout.write("{name}: {duration:.2f}ms per {size}KB body".format(
+                name = name,
+                duration = duration * 1000,
+                size = len(text) // 1024,
+            ))
@@ -0,0 +1,19 @@
+"""Re-renders the precomputed processed version of HtmlFields."""
+
+from django.core.management.base import NoArgsCommand
+
+from cms.html import rerender_html_fields
+
+
+class Command(NoArgsCommand):
+    
+    help = "Re-renders the precomputed processed version of all HtmlFields that contain links. This should be run after restructuring the site, or importing content."
+    
+    def handle_noargs(self, **options):
+        """Runs the command."""
+        count = rerender_html_fields()
+        verbosity = int(options.get("verbosity", 1))
+        if verbosity >= 1:
+            self.stdout.write("Re-rendered {count} HTML values.".format(
+                count = count,
+            ))
@@ -0,0 +1,27 @@
+"""Changes the publication epoch when publication transitions have passed."""
+
+from django.core.management.base import NoArgsCommand
+
+from cms.publication import run_publication_transitions, get_next_transition
+from cms.sitemaps import is_prerender_enabled, write_sitemaps
+
+
+class Command(NoArgsCommand):
+    
+    help = "Invalidates cached content when content has been published or expired. This should be run regularly, e.g. every minute."
+    
+    def handle_noargs(self, **options):
+        """Runs the command."""
+        if run_publication_transitions():
+            self.stdout.write("Publication transitions have passed. Cached content has been invalidated.")
+            if is_prerender_enabled():
+                write_sitemaps()
+        verbosity = int(options.get("verbosity", 1))
+        if verbosity >= 2:
+            next_transition = get_next_transition()
+            if next_transition is None:
+                self.stdout.write("There are no scheduled publication transitions.")
+            else:
+                self.stdout.write("The next publication transition is at {next_transition}.".format(
+                    next_transition = next_transition.isoformat(),
+                ))
@@ -0,0 +1,19 @@
+"""Writes pre-rendered sitemaps to storage."""
+
+from django.core.management.base import NoArgsCommand
+
+from cms.sitemaps import write_sitemaps
+
+
+class Command(NoArgsCommand):
+    
+    help = "Writes all registered sitemaps, and the sitemap index, to storage. This should be run after enabling CMS_SITEMAPS_PRERENDER, or importing content."
+    
+    def handle_noargs(self, **options):
+        """Runs the command."""
+        count = write_sitemaps()
+        verbosity = int(options.get("verbosity", 1))
+        if verbosity >= 1:
+            self.stdout.write("Wrote {count} sitemap pages.".format(
+                count = count,
+            ))
@@ -6,6 +6,7 @@ from django.conf import settings
 from django.template.response import SimpleTemplateResponse
 
 from cms.models import publication_manager, PublicationManagementError
+from cms.timing import start_recording, stop_recording, format_server_timing, get_sinks
 
 
 class PublicationMiddleware(object):
@@ -30,7 +31,7 @@ class PublicationMiddleware(object):
                 preview_mode = False
             # Only allow preview mode if the user is a logged in administrator.
             preview_mode = preview_mode and request.user.is_authenticated() and request.user.is_staff and request.user.is_active
-            publication_manager.begin(not preview_mode)
+            request._publication_token = publication_manager.begin(not preview_mode)
         
     def process_response(self, request, response):
         """Cleans up after preview mode."""
@@ -38,11 +39,38 @@ class PublicationMiddleware(object):
         if publication_manager.select_published_active():
             if isinstance(response, SimpleTemplateResponse):
                 response = response.render()
-        # Clean up all blocks.
-        while True:
+        # Clean up the block started for this request, along with any blocks left open within it.
+        token = getattr(request, "_publication_token", None)
+        if token is not None:
+            del request._publication_token
             try:
-                publication_manager.end()
+                publication_manager.end(token)
             except PublicationManagementError:
-                break
+                pass
         # Carry on as normal.
-        return response
\ No newline at end of file
+        return response
+
+
+class TimingMiddleware(object):
+    
+    """
+    Middleware that records the timing of each stage of the request pipeline.
+    
+    This should be placed first in MIDDLEWARE_CLASSES, and is only active if
+    the CMS_TIMING setting is True.
+    """
+    
+    def process_request(self, request):
+        """Starts recording timings."""
+        if getattr(settings, "CMS_TIMING", False):
+            start_recording()
+            
+    def process_response(self, request, response):
+        """Reports the recorded timings."""
+        timings = stop_recording()
+        if timings is not None:
+            if getattr(settings, "CMS_TIMING_HEADER", True):
+                response["Server-Timing"] = format_server_timing(timings)
+            for sink in get_sinks():
+                sink(request, timings)
+        return response
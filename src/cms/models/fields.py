@@ -8,9 +8,125 @@ from django.db import models
 from cms.forms import HtmlWidget
 
 
+class HtmlText(unicode):
+    
+    """
+    The value of a HtmlField with a precomputed processed version.
+    
+    The processed version is available as the processed attribute, or None
+    if it has not been computed for this exact text.
+    """
+    
+    processed = None
+
+
+class HtmlFieldDescriptor(object):
+    
+    """
+    Accessor for a HtmlField that stores a precomputed processed version.
+    
+    The processed version is only attached to the value if it was computed from
+    the current value of the field.
+    """
+    
+    def __init__(self, field):
+        """Initializes the HtmlFieldDescriptor."""
+        self.field = field
+        
+    def __get__(self, instance, owner):
+        """Returns the value of the field."""
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.field.attname)
+        if value is None:
+            return value
+        value = HtmlText(value)
+        processed = instance.__dict__.get(self.field.processed_attname)
+        if processed is not None and instance.__dict__.get(self.field.source_attname) == value:
+            value.processed = processed
+        return value
+    
+    def __set__(self, instance, value):
+        """Sets the value of the field."""
+        instance.__dict__[self.field.attname] = value
+        
+        
+class ProcessedHtmlDescriptor(object):
+    
+    """
+    Accessor for the precomputed processed version of a HtmlField.
+    
+    The processed version is marked as belonging to the current value of the
+    HtmlField, so it should be set after the HtmlField.
+    """
+    
+    def __init__(self, html_field):
+        """Initializes the ProcessedHtmlDescriptor."""
+        self.html_field = html_field
+        
+    def __get__(self, instance, owner):
+        """Returns the processed version."""
+        if instance is None:
+            return self
+        return instance.__dict__.get(self.html_field.processed_attname)
+    
+    def __set__(self, instance, value):
+        """Sets the processed version."""
+        instance.__dict__[self.html_field.processed_attname] = value
+        instance.__dict__[self.html_field.source_attname] = instance.__dict__.get(self.html_field.attname)
+
+
+# A list of (model, field) tuples for every HtmlField with a precomputed processed version.
+precomputed_html_fields = []
+
+
 class HtmlField(models.TextField):
     
-    """A field that contains HTML data."""
+    """
+    A field that contains HTML data.
+    
+    If precompute is True, then a processed version of the HTML is stored in
+    a companion {name}_processed field whenever the model is saved, and used by
+    the html template filter instead of processing the HTML on every render.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        """Initializes the HtmlField."""
+        self.precompute = kwargs.pop("precompute", False)
+        super(HtmlField, self).__init__(*args, **kwargs)
+    
+    def contribute_to_class(self, cls, name):
+        """Adds in the companion field for the processed HTML."""
+        super(HtmlField, self).contribute_to_class(cls, name)
+        # Abstract models pass a copy of their fields to each subclass.
+        if self.precompute and not cls._meta.abstract:
+            self.processed_attname = "{name}_processed".format(name=name)
+            self.source_attname = "_{name}_source".format(name=name)
+            setattr(cls, self.attname, HtmlFieldDescriptor(self))
+            cls.add_to_class(self.processed_attname, models.TextField(
+                blank = True,
+                null = True,
+                editable = False,
+            ))
+            setattr(cls, self.processed_attname, ProcessedHtmlDescriptor(self))
+            precomputed_html_fields.append((cls, self))
+            # Start re-rendering the processed HTML when linked objects change.
+            import cms.html  # @UnusedImport
+    
+    def pre_save(self, model_instance, add):
+        """Processes the HTML, if it should be precomputed."""
+        value = super(HtmlField, self).pre_save(model_instance, add)
+        if getattr(self, "processed_attname", None):
+            from cms.html import process_for_storage
+            setattr(model_instance, self.processed_attname, process_for_storage(value))
+        return value
+    
+    def get_prep_value(self, value):
+        """Converts HtmlText back into plain text."""
+        value = super(HtmlField, self).get_prep_value(value)
+        if isinstance(value, HtmlText):
+            value = unicode(value)
+        return value
     
     def formfield(self, **kwargs):
         """Returns a HtmlWidget."""
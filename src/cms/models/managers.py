@@ -3,7 +3,17 @@
 
 from __future__ import with_statement
 
-import threading, contextlib
+import threading, contextlib, weakref
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
 
 from django.db import models
 
@@ -15,23 +25,115 @@ class PublicationManagementError(Exception):
     """
 
 
-class PublicationManager(threading.local):
+class ThreadContextStack(object):
+    
+    """Stores a stack of values for each thread."""
+    
+    def __init__(self):
+        """Initializes the ThreadContextStack."""
+        self._local = threading.local()
+        
+    def get(self):
+        """Returns the stack for the current context, as a tuple."""
+        return getattr(self._local, "stack", ())
+        
+    def set(self, stack):
+        """Sets the stack for the current context."""
+        self._local.stack = stack
+        
+        
+class GreenletContextStack(object):
     
     """
-    Tracks a thread-local state of whether querysets should be filtered based on
-    publication state.
+    Stores a stack of values for each greenlet.
     
-    By default, unpublished content will be filtered out.
+    Each thread has its own main greenlet, so this also works for threads. The
+    stack of a greenlet is discarded when the greenlet is garbage collected.
     """
     
     def __init__(self):
+        """Initializes the GreenletContextStack."""
+        self._stacks = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        
+    def get(self):
+        """Returns the stack for the current context, as a tuple."""
+        return self._stacks.get(greenlet.getcurrent(), ())
+        
+    def set(self, stack):
+        """Sets the stack for the current context."""
+        current = greenlet.getcurrent()
+        with self._lock:
+            if stack:
+                self._stacks[current] = stack
+            else:
+                self._stacks.pop(current, None)
+                
+                
+class ContextVarContextStack(object):
+    
+    """
+    Stores a stack of values in a context variable.
+    
+    This works for threads, greenlets (with a contextvars-aware greenlet) and
+    asyncio tasks, which each receive a copy of the context they were started
+    from.
+    """
+    
+    def __init__(self):
+        """Initializes the ContextVarContextStack."""
+        self._var = contextvars.ContextVar("cms_publication_stack", default=())
+        
+    def get(self):
+        """Returns the stack for the current context, as a tuple."""
+        return self._var.get()
+        
+    def set(self, stack):
+        """Sets the stack for the current context."""
+        self._var.set(stack)
+
+
+def create_context_stack():
+    """
+    Creates the best available context-local stack.
+    
+    Context variables are used if available, followed by greenlet-local storage,
+    falling back to thread-local storage.
+    """
+    if contextvars is not None:
+        return ContextVarContextStack()
+    if greenlet is not None:
+        return GreenletContextStack()
+    return ThreadContextStack()
+
+
+class PublicationManager(object):
+    
+    """
+    Tracks a context-local state of whether querysets should be filtered based
+    on publication state.
+    
+    The state is stored separately for each thread, greenlet or asyncio task,
+    so it is safe to use with cooperative workers.
+    
+    By default, unpublished content will be filtered out.
+    """
+    
+    def __init__(self, stack=None):
         """Initializes the PublicationManager."""
         super(PublicationManager, self).__init__()
-        self._stack = []
+        self._stack = stack or create_context_stack()
         
     def begin(self, select_published):
-        """Starts a block using the given publication setting."""
-        self._stack.append(select_published)
+        """
+        Starts a block using the given publication setting.
+        
+        Returns a token that can be passed to end() to close this block, along
+        with any blocks started within it.
+        """
+        stack = self._stack.get()
+        self._stack.set(stack + (select_published,))
+        return len(stack)
         
     def select_published_active(self):
         """
@@ -39,27 +141,33 @@ class PublicationManager(threading.local):
         content.
         """
         try:
-            return self._stack[-1]
+            return self._stack.get()[-1]
         except IndexError:
             return False
         
-    def end(self):
-        """Ends a block of publication control."""
-        try:
-            self._stack.pop()
-        except IndexError:
+    def end(self, token=None):
+        """
+        Ends a block of publication control.
+        
+        If a token from begin() is given, then the corresponding block is ended,
+        along with any blocks that were left open within it. Otherwise, the
+        innermost block is ended.
+        """
+        stack = self._stack.get()
+        if token is None:
+            token = len(stack) - 1
+        if token < 0 or token >= len(stack):
             raise PublicationManagementError, "There is no active block of publication management."
+        self._stack.set(stack[:token])
         
     @contextlib.contextmanager
     def select_published(self, select_published):
         """Marks a block of publication management."""
-        self.begin(select_published)
+        token = self.begin(select_published)
         try:
             yield
-        except:
-            raise
         finally:
-            self.end()
+            self.end(token)
             
     
 # A single, thread-safe publication manager.
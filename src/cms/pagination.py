@@ -0,0 +1,250 @@
+"""
+Keyset (cursor) pagination of querysets.
+
+Django's Paginator counts the whole queryset, then uses an OFFSET to find each
+page, so the cost of a page grows with its depth. A CursorPaginator instead
+filters on the ordering fields of the first or last item of the adjacent page,
+which are stored in an opaque cursor token. Every page then costs a single
+indexed query, however deep it is.
+
+The total count is only calculated when asked for, and is cached for the
+number of seconds given by the CMS_PAGINATION_COUNT_TIMEOUT setting.
+"""
+
+import collections, hashlib, json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage, EmptyPage
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.functional import cached_property
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+
+
+def get_count_timeout():
+    """Returns the number of seconds that queryset counts are cached for."""
+    return getattr(settings, "CMS_PAGINATION_COUNT_TIMEOUT", 60 * 5)
+
+
+# Cursor directions.
+NEXT = "n"
+
+PREVIOUS = "p"
+
+
+class CursorPaginator(object):
+
+    """
+    Paginates a queryset using cursors.
+
+    The ordering should be a list of local field names, optionally prefixed
+    with "-", that uniquely orders the queryset. If no ordering is given, then
+    the ordering of the queryset is used, with the primary key added to break
+    ties.
+
+    Raises ValueError if the ordering cannot be used for cursors, such as a
+    random ordering, or an ordering on a related model.
+    """
+
+    def __init__(self, object_list, per_page, ordering=None):
+        """Initializes the CursorPaginator."""
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        if ordering is None:
+            ordering = list(object_list.query.order_by or object_list.model._meta.ordering)
+            # A reversed queryset flips the direction of its ordering.
+            if not object_list.query.standard_ordering:
+                ordering = [
+                    name[1:] if name.startswith("-") else "-" + name
+                    for name
+                    in ordering
+                    if isinstance(name, basestring)
+                ]
+            if not any(isinstance(name, basestring) and name.lstrip("-") in ("pk", object_list.model._meta.pk.name) for name in ordering):
+                ordering.append("-pk" if ordering and ordering[-1].startswith("-") else "pk")
+        self.ordering = tuple(ordering)
+        self._fields = self._get_fields()
+
+    def _get_fields(self):
+        """Returns a list of (name, field, descending) tuples for the ordering."""
+        opts = self.object_list.model._meta
+        fields = []
+        for name in self.ordering:
+            if not isinstance(name, basestring) or name == "?" or "__" in name:
+                raise ValueError("Cannot paginate using cursors on the ordering {name!r}.".format(
+                    name = name,
+                ))
+            descending = name.startswith("-")
+            name = name.lstrip("-")
+            try:
+                field = opts.pk if name == "pk" else opts.get_field(name)
+            except FieldDoesNotExist:
+                field = None
+            # Related fields are ordered by the ordering of their model, not by their value.
+            if field is None or field.rel is not None and field is not opts.pk:
+                raise ValueError("Cannot paginate using cursors on the ordering {name!r}.".format(
+                    name = name,
+                ))
+            fields.append((name, field, descending))
+        return fields
+
+    def _create_cursor(self, obj, direction):
+        """Returns a cursor token for the page before or after the given object."""
+        values = [
+            field.value_to_string(obj)
+            for _, field, _
+            in self._fields
+        ]
+        return urlsafe_base64_encode(json.dumps([direction] + values))
+
+    def _parse_cursor(self, cursor):
+        """Returns the direction and field values stored in the given cursor token."""
+        try:
+            data = json.loads(urlsafe_base64_decode(str(cursor)))
+        except (TypeError, ValueError, UnicodeEncodeError):
+            raise InvalidPage("That cursor is not valid.")
+        # Cursors are created as a list of strings, so reject anything else, including nulls.
+        if not isinstance(data, list) or len(data) != len(self._fields) + 1 or not all(isinstance(value, basestring) for value in data):
+            raise InvalidPage("That cursor is not valid.")
+        direction = data[0]
+        if direction not in (NEXT, PREVIOUS):
+            raise InvalidPage("That cursor is not valid.")
+        try:
+            values = [
+                field.to_python(value)
+                for (_, field, _), value
+                in zip(self._fields, data[1:])
+            ]
+        except (TypeError, ValueError, ValidationError):
+            raise InvalidPage("That cursor is not valid.")
+        if None in values:
+            raise InvalidPage("That cursor is not valid.")
+        return direction, values
+
+    def _filter_from(self, queryset, values, backwards):
+        """Filters the queryset to items after the given field values, in the given direction."""
+        condition = Q()
+        for index, (name, _, descending) in enumerate(self._fields):
+            lookup = dict(
+                (previous_name, value)
+                for (previous_name, _, _), value
+                in zip(self._fields[:index], values)
+            )
+            lookup["{name}__{operator}".format(
+                name = name,
+                operator = "gt" if descending == backwards else "lt",
+            )] = values[index]
+            condition |= Q(**lookup)
+        return queryset.filter(condition)
+
+    def page(self, cursor=None):
+        """
+        Returns the page for the given cursor token, or the first page if no
+        cursor is given.
+        """
+        queryset = self.object_list.order_by(*self.ordering)
+        # The ordering already accounts for a reversed queryset.
+        if not queryset.query.standard_ordering:
+            queryset = queryset.reverse()
+        if cursor:
+            direction, values = self._parse_cursor(cursor)
+            backwards = direction == PREVIOUS
+            queryset = self._filter_from(queryset, values, backwards)
+            if backwards:
+                queryset = queryset.reverse()
+        else:
+            backwards = False
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if backwards:
+            object_list.reverse()
+        if cursor and not object_list:
+            raise EmptyPage("That page contains no results.")
+        # Items before a cursor are assumed to exist, as the cursor was created from one.
+        has_next = has_more if not backwards else True
+        has_previous = has_more if backwards else bool(cursor)
+        return CursorPage(
+            object_list,
+            self,
+            next_cursor = self._create_cursor(object_list[-1], NEXT) if has_next and object_list else None,
+            previous_cursor = self._create_cursor(object_list[0], PREVIOUS) if has_previous and object_list else None,
+        )
+
+    @cached_property
+    def count(self):
+        """
+        Returns the total number of items.
+
+        The count is cached, so may be slightly out of date.
+        """
+        cache_key = u"cms.pagination.count.{hash}".format(
+            hash = hashlib.md5(unicode(self.object_list.query).encode("utf-8")).hexdigest(),
+        )
+        count = cache.get(cache_key)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(cache_key, count, get_count_timeout())
+        return count
+
+    @property
+    def num_pages(self):
+        """Returns the total number of pages."""
+        return max(1, (self.count + self.per_page - 1) // self.per_page)
+
+
+class CursorPage(collections.Sequence):
+
+    """
+    A single page of items from a CursorPaginator.
+
+    The page can be used in place of a Django pagination page, except that
+    page numbers are replaced by cursor tokens.
+    """
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        """Initializes the CursorPage."""
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        """Returns a debug representation of the CursorPage."""
+        return "<CursorPage of {count} items>".format(
+            count = len(self.object_list),
+        )
+
+    def __len__(self):
+        """Returns the number of items on this page."""
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        """Returns the given item on this page."""
+        return self.object_list[index]
+
+    def has_next(self):
+        """Checks whether there is a next page."""
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        """Checks whether there is a previous page."""
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        """Checks whether there are any other pages."""
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        """Returns the cursor token for the next page."""
+        if not self.has_next():
+            raise EmptyPage("That page contains no results.")
+        return self.next_cursor
+
+    def previous_page_number(self):
+        """Returns the cursor token for the previous page."""
+        if not self.has_previous():
+            raise EmptyPage("That page contains no results.")
+        return self.previous_cursor
@@ -3,16 +3,26 @@ Generic permalink generation utilities.
 
 A permalink is a model and object id encoded into a URL.  It allows the model to
 change it's absolute URL without breaking links.
+
+The URL and title that each permalink expands to are cached, and invalidated
+whenever the referenced object, or anything its URL depends on, changes.
 """
 
+import re, collections, threading
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.views import shortcut
 from django.core import urlresolvers
-from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ValidationError, ObjectDoesNotExist
+
+from cms.cache import get_version, get_versions, get_object_version_name, has_object_versions
+from cms.models.managers import publication_manager
+from cms.publication import PUBLICATION_VERSION
 
 
-__all__ = ("PermalinkError", "create", "resolve", "expand",)
+__all__ = ("PermalinkError", "ExpandedPermalink", "create", "resolve", "resolve_many", "parse", "expand", "expand_many",)
 
 
 class PermalinkError(Exception):
@@ -20,23 +30,94 @@ class PermalinkError(Exception):
     """Exception thrown when an error occurs with a permalink."""
 
 
+# Sample ids used to find the format of the permalink URL.
+SAMPLE_CONTENT_TYPE_ID = 918273645
+
+SAMPLE_OBJECT_ID = 546372819
+
+
+PermalinkFormat = collections.namedtuple("PermalinkFormat", ("prefix", "separator", "suffix", "regex",))
+
+
+# The permalink URL formats for each urlconf and script prefix.
+_permalink_formats = {}
+
+_permalink_formats_lock = threading.Lock()
+
+
+def _get_permalink_format():
+    """
+    Returns the format of permalink URLs, or None if the format could not be
+    determined.
+    
+    The format is found by reversing the permalink URL with sample ids.
+    """
+    format_key = (urlresolvers.get_urlconf() or settings.ROOT_URLCONF, urlresolvers.get_script_prefix())
+    try:
+        return _permalink_formats[format_key]
+    except KeyError:
+        pass
+    permalink_format = None
+    try:
+        url = urlresolvers.reverse("permalink_redirect", kwargs={
+            "content_type_id": SAMPLE_CONTENT_TYPE_ID,
+            "object_id": SAMPLE_OBJECT_ID,
+        })
+    except urlresolvers.NoReverseMatch:
+        pass
+    else:
+        content_type_id = unicode(SAMPLE_CONTENT_TYPE_ID)
+        object_id = unicode(SAMPLE_OBJECT_ID)
+        if url.count(content_type_id) == 1 and url.count(object_id) == 1 and url.index(content_type_id) < url.index(object_id):
+            prefix, rest = url.split(content_type_id)
+            separator, suffix = rest.split(object_id)
+            permalink_format = PermalinkFormat(prefix, separator, suffix, re.compile(u"^{prefix}(\\d+){separator}([^/?#]+?){suffix}$".format(
+                prefix = re.escape(prefix),
+                separator = re.escape(separator),
+                suffix = re.escape(suffix),
+            )))
+    with _permalink_formats_lock:
+        _permalink_formats[format_key] = permalink_format
+    return permalink_format
+
+
 def create(obj):
     """Generates a permalink for the given object."""
-    content_type = ContentType.objects.get_for_model(obj)
+    return create_for_id(obj, obj.pk)
+
+
+def create_for_id(model, object_id):
+    """Generates a permalink for the object of the given model with the given primary key."""
+    content_type = ContentType.objects.get_for_model(model)
     content_type_id = content_type.id
-    object_id = obj.pk
+    # Integer ids need no escaping, so can be formatted directly.
+    if isinstance(object_id, (int, long)):
+        permalink_format = _get_permalink_format()
+        if permalink_format is not None:
+            return u"{prefix}{content_type_id}{separator}{object_id}{suffix}".format(
+                prefix = permalink_format.prefix,
+                content_type_id = content_type_id,
+                separator = permalink_format.separator,
+                object_id = object_id,
+                suffix = permalink_format.suffix,
+            )
     kwargs = {"content_type_id": content_type_id,
               "object_id": object_id}
     return urlresolvers.reverse("permalink_redirect", kwargs=kwargs)
     
     
-def resolve(permalink):
+def parse(permalink):
     """
-    Resolves the given permalink into an object.
+    Parses the given permalink into a content type id and object id.
     
-    Raises a PermalinkError if the URL is not a valid permalink. Raises an
-    ObjectDoesNotExist if the referenced object does not exist.
+    Raises a PermalinkError if the URL is not a valid permalink.
     """
+    # Recognize the standard permalink format without the URL resolver.
+    permalink_format = _get_permalink_format()
+    if permalink_format is not None:
+        match = permalink_format.regex.match(permalink)
+        if match is not None:
+            return match.group(1), match.group(2)
     # Attempt to resolve the URL.
     try:
         callback, _, callback_kwargs = urlresolvers.resolve(permalink)  # @UnusedVariable
@@ -47,16 +128,159 @@ def resolve(permalink):
         raise PermalinkError, "'%s' is not a valid permalink." % permalink
     # Get the permalink attributes.
     try:
-        content_type_id = callback_kwargs["content_type_id"]
-        object_id = callback_kwargs["object_id"]
+        return callback_kwargs["content_type_id"], callback_kwargs["object_id"]
     except KeyError:
         raise ImproperlyConfigured, "The permalink_redirect view should be configured using keyword arguments."
+    
+    
+def resolve(permalink):
+    """
+    Resolves the given permalink into an object.
+    
+    Raises a PermalinkError if the URL is not a valid permalink. Raises an
+    ObjectDoesNotExist if the referenced object does not exist.
+    """
+    content_type_id, object_id = parse(permalink)
     # Resolve the object. 
     content_type = ContentType.objects.get_for_id(content_type_id)
     obj = content_type.get_object_for_this_type(id=object_id)
     return obj
 
 
+def resolve_many(permalinks):
+    """
+    Resolves the given permalinks into objects.
+    
+    Returns a dictionary mapping each permalink to its object. Permalinks
+    that are not valid, or that reference objects that do not exist, are mapped
+    to None. Objects are loaded using a single query per content type.
+    """
+    resolved_permalinks = {}
+    object_ids = {}
+    for permalink in permalinks:
+        resolved_permalinks[permalink] = None
+        try:
+            content_type_id, object_id = parse(permalink)
+            content_type_id = int(content_type_id)
+        except (PermalinkError, ValueError):
+            continue
+        object_ids.setdefault(content_type_id, []).append((object_id, permalink))
+    # Load the objects for each content type.
+    for content_type_id, content_type_permalinks in object_ids.iteritems():
+        try:
+            content_type = ContentType.objects.get_for_id(content_type_id)
+        except ContentType.DoesNotExist:
+            continue
+        model = content_type.model_class()
+        if model is None:
+            continue
+        pk_field = model._meta.pk
+        permalinks_by_pk = {}
+        for object_id, permalink in content_type_permalinks:
+            try:
+                pk = pk_field.to_python(object_id)
+            except ValidationError:
+                continue
+            permalinks_by_pk.setdefault(pk, []).append(permalink)
+        if not permalinks_by_pk:
+            continue
+        for obj in model._base_manager.using(content_type._state.db).filter(pk__in=permalinks_by_pk.keys()):
+            for permalink in permalinks_by_pk.get(obj.pk, ()):
+                resolved_permalinks[permalink] = obj
+    return resolved_permalinks
+
+
+def get_cache_timeout():
+    """Returns the number of seconds to cache expanded permalinks for."""
+    return getattr(settings, "CMS_PERMALINK_CACHE_TIMEOUT", 60 * 60 * 24)
+
+
+def _get_cache_key(content_type_id, object_id):
+    """Returns the cache key used to store an expanded permalink."""
+    return u"cms.permalinks.{published}.{content_type_id}.{object_id}.{prefix}".format(
+        published = int(publication_manager.select_published_active()),
+        content_type_id = content_type_id,
+        object_id = object_id,
+        prefix = urlresolvers.get_script_prefix(),
+    )
+
+
+class ExpandedPermalink(collections.namedtuple("ExpandedPermalinkBase", ("url", "title", "versions",))):
+    
+    """
+    The URL and title of the object referenced by a permalink.
+    
+    The versions are a dictionary of the version counters that the URL and
+    title depend on. The url and title are None if the object does not exist.
+    """
+    
+    __slots__ = ()
+
+
+def expand_many(permalinks):
+    """
+    Expands the given permalinks into the URL and title of the objects they
+    reference.
+    
+    Returns a dictionary mapping each valid permalink to an ExpandedPermalink.
+    Invalid permalinks are left out of the dictionary. The result is cached,
+    so repeat expansions cost two cache fetches in total.
+    """
+    # Look up the permalinks in the cache.
+    cache_keys = {}
+    for permalink in permalinks:
+        try:
+            content_type_id, object_id = parse(permalink)
+            content_type_id = int(content_type_id)
+        except (PermalinkError, ValueError):
+            continue
+        cache_keys[permalink] = (content_type_id, object_id, _get_cache_key(content_type_id, object_id))
+    cached_values = cache.get_many([cache_key for _, _, cache_key in cache_keys.itervalues()])
+    # Check that the cached values are still current.
+    version_names = set()
+    for _, _, versions in cached_values.itervalues():
+        version_names.update(versions.iterkeys())
+    current_versions = get_versions(version_names)
+    expanded_permalinks = {}
+    missing_permalinks = []
+    for permalink, (_, _, cache_key) in cache_keys.iteritems():
+        cached_value = cached_values.get(cache_key)
+        if cached_value is not None and all(current_versions.get(name) == version for name, version in cached_value[2].iteritems()):
+            expanded_permalinks[permalink] = ExpandedPermalink(*cached_value)
+        else:
+            missing_permalinks.append(permalink)
+    # Expand the remaining permalinks, reading the versions before loading the objects.
+    if missing_permalinks:
+        missing_versions = {}
+        for permalink in missing_permalinks:
+            content_type_id, object_id, _ = cache_keys[permalink]
+            try:
+                content_type = ContentType.objects.get_for_id(content_type_id)
+            except ContentType.DoesNotExist:
+                continue
+            if not has_object_versions(content_type.model_class()):
+                continue
+            object_version_name = get_object_version_name(content_type.app_label, content_type.model, object_id)
+            missing_versions[permalink] = {
+                PUBLICATION_VERSION: get_version(PUBLICATION_VERSION),
+                object_version_name: get_version(object_version_name),
+            }
+        objs = resolve_many(missing_versions.iterkeys())
+        values_to_cache = {}
+        for permalink, versions in missing_versions.iteritems():
+            obj = objs[permalink]
+            if obj is None:
+                expanded_permalink = ExpandedPermalink(None, None, versions)
+            else:
+                for name in getattr(obj, "get_cache_dependencies", tuple)():
+                    versions[name] = get_version(name)
+                expanded_permalink = ExpandedPermalink(obj.get_absolute_url(), getattr(obj, "title", unicode(obj)), versions)
+            expanded_permalinks[permalink] = expanded_permalink
+            values_to_cache[cache_keys[permalink][2]] = tuple(expanded_permalink)
+        cache.set_many(values_to_cache, get_cache_timeout())
+    return expanded_permalinks
+
+
 def expand(permalink):
     """
     Expands the given permalink into a full URL.
@@ -64,7 +288,10 @@ def expand(permalink):
     Raises a permalink error if the URL is not a valid permalink. Raises an
     ObjectDoesNotExist if the referenced object does not exist.
     """
-    obj = resolve(permalink)
-    return obj.get_absolute_url()
-    
-    
\ No newline at end of file
+    try:
+        expanded_permalink = expand_many((permalink,))[permalink]
+    except KeyError:
+        raise PermalinkError, "'%s' is not a valid permalink." % permalink
+    if expanded_permalink.url is None:
+        raise ObjectDoesNotExist, "The object referenced by '%s' does not exist." % permalink
+    return expanded_permalink.url
@@ -25,8 +25,8 @@ urlpatterns = patterns("",
     url(r"^r/(?P<content_type_id>\d+)-(?P<object_id>[^/]+)/$", "django.contrib.contenttypes.views.shortcut", name="permalink_redirect"),
     
     # Google sitemap service.
-    url(r"^sitemap.xml$", "django.contrib.sitemaps.views.index", {"sitemaps": registered_sitemaps}),
-    url(r"^sitemap-(?P<section>.+)\.xml$", "django.contrib.sitemaps.views.sitemap", {"sitemaps": registered_sitemaps}),
+    url(r"^sitemap.xml$", "cms.views.sitemap_index", {"sitemaps": registered_sitemaps}),
+    url(r"^sitemap-(?P<section>.+)\.xml$", "cms.views.sitemap", {"sitemaps": registered_sitemaps}),
     
     # Basic robots.txt.
     url(r"^robots.txt$", TextTemplateView.as_view(template_name="robots.txt")),
@@ -0,0 +1,239 @@
+"""
+Scheduling of publication transitions.
+
+Published content goes live and expires based on date fields that are
+evaluated against the current time whenever content is queried. A publication
+transition is an instant at which the result of such a query changes.
+
+Models register the date fields that control their publication. The next
+transition across all registered models can then be used to expire cached
+content at exactly the right time, and the publication epoch changes every
+time a transition passes, as long as the run_publication_transitions command
+is run regularly.
+"""
+
+import datetime, math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models import Min
+from django.dispatch import Signal
+from django.utils import timezone
+
+from cms.cache import get_version, bump_version
+from cms.models.managers import publication_manager
+
+
+# The name of the version counter that changes whenever a publication transition passes.
+PUBLICATION_VERSION = "publication"
+
+
+# A list of registered (model, field_names, version_name) tuples.
+registered_models = []
+
+
+class PublicationRegistrationError(Exception):
+
+    """Error raised when a model could not be registered."""
+
+
+def bump_model_version(sender, **kwargs):
+    """Changes the publication version of the given model."""
+    bump_version(_get_model_version_name(sender))
+
+
+def _get_model_version_name(model):
+    """Returns the name of the default version counter for the given model."""
+    return u"publication.{app_label}-{model_name}".format(
+        app_label = model._meta.app_label,
+        model_name = model.__name__.lower(),
+    )
+
+
+def register(model, field_names, version_name=None):
+    """
+    Registers the date fields that control the publication of a model.
+
+    The version name should be a version counter that changes whenever the
+    given fields of any instance of the model change. If no version name is
+    given, then a version counter is maintained using model signals.
+    """
+    for registered_model, _, _ in registered_models:
+        if registered_model is model:
+            raise PublicationRegistrationError(u"{model!r} has already been registered.".format(
+                model = model,
+            ))
+    if version_name is None:
+        version_name = _get_model_version_name(model)
+        models.signals.post_save.connect(bump_model_version, sender=model)
+        models.signals.post_delete.connect(bump_model_version, sender=model)
+    registered_models.append((model, tuple(field_names), version_name))
+
+
+def _is_date_field(model, field_name):
+    """Checks whether the given field stores a date without a time."""
+    field = model._meta.get_field(field_name)
+    return isinstance(field, models.DateField) and not isinstance(field, models.DateTimeField)
+
+
+def _get_local_date(value):
+    """Returns the date that the given time falls on, in the default timezone."""
+    if settings.USE_TZ and timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.get_default_timezone())
+    return value.date()
+
+
+def _get_date_start(value):
+    """Returns the time that the given date starts, in the default timezone."""
+    value = datetime.datetime.combine(value, datetime.time.min)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value
+
+
+def _get_next_field_transition(model, field_name, now):
+    """Returns the first value of the given field after the given time, or None."""
+    if _is_date_field(model, field_name):
+        value = model._base_manager.filter(**{
+            field_name + "__gt": _get_local_date(now),
+        }).aggregate(transition=Min(field_name))["transition"]
+        if value is not None:
+            value = _get_date_start(value)
+        return value
+    return model._base_manager.filter(**{
+        field_name + "__gt": now,
+    }).aggregate(transition=Min(field_name))["transition"]
+
+
+def _get_transition_cache_key():
+    """Returns the cache key used to store the next transition."""
+    return u"cms.publication.next_transition.{versions}".format(
+        versions = u".".join(
+            unicode(get_version(version_name))
+            for _, _, version_name
+            in registered_models
+        ),
+    )
+
+
+def get_next_transition(now=None):
+    """
+    Returns the time of the next publication transition, or None if there are
+    no future transitions.
+
+    The result is cached until the transition passes, or any registered model
+    changes.
+    """
+    if now is None:
+        now = timezone.now()
+        cache_key = _get_transition_cache_key()
+        cached_transition = cache.get(cache_key)
+        if cached_transition is not None and (cached_transition[0] is None or cached_transition[0] > now):
+            return cached_transition[0]
+    else:
+        cache_key = None
+    transitions = []
+    with publication_manager.select_published(False):
+        for model, field_names, _ in registered_models:
+            for field_name in field_names:
+                transition = _get_next_field_transition(model, field_name, now)
+                if transition is not None:
+                    transitions.append(transition)
+    next_transition = min(transitions) if transitions else None
+    if cache_key is not None:
+        cache.set(cache_key, (next_transition,), None)
+    return next_transition
+
+
+def get_transition_timeout(max_timeout=None, now=None):
+    """
+    Returns the number of seconds until the next publication transition,
+    limited to the given maximum.
+
+    Returns the maximum timeout if there are no future transitions.
+    """
+    next_transition = get_next_transition(now)
+    if now is None:
+        now = timezone.now()
+    if next_transition is None:
+        return max_timeout
+    timeout = max(0, int(math.ceil((next_transition - now).total_seconds())))
+    if max_timeout is not None:
+        timeout = min(timeout, max_timeout)
+    return timeout
+
+
+def _filter_field_transitions(model, field_name, start, end):
+    """Returns the instances of the model whose given field transitions after start, up to and including end."""
+    if _is_date_field(model, field_name):
+        start, end = _get_local_date(start), _get_local_date(end)
+    return model._base_manager.filter(**{
+        field_name + "__gt": start,
+        field_name + "__lte": end,
+    })
+
+
+def has_transitions(start, end):
+    """Checks whether any publication transitions fall after start, up to and including end."""
+    with publication_manager.select_published(False):
+        for model, field_names, _ in registered_models:
+            for field_name in field_names:
+                if _filter_field_transitions(model, field_name, start, end).exists():
+                    return True
+    return False
+
+
+def get_transitioned_ids(start, end):
+    """
+    Returns a list of (model, ids) tuples for the instances of registered models
+    with publication transitions after start, up to and including end.
+    """
+    transitioned_ids = []
+    with publication_manager.select_published(False):
+        for model, field_names, _ in registered_models:
+            ids = set()
+            for field_name in field_names:
+                ids.update(_filter_field_transitions(model, field_name, start, end).values_list("pk", flat=True))
+            if ids:
+                transitioned_ids.append((model, ids))
+    return transitioned_ids
+
+
+def get_publication_epoch():
+    """
+    Returns a value that changes every time a publication transition passes.
+
+    This can be included in cache keys to invalidate cached content when the
+    published content changes.
+    """
+    return get_version(PUBLICATION_VERSION)
+
+
+# Sent by run_publication_transitions() when transitions have passed after start, up to
+# and including end. The start is None if the time of the last check is not known.
+transitions_passed = Signal(providing_args=("start", "end"))
+
+
+# The cache key used to store the last time that transitions were checked.
+LAST_TRANSITION_CHECK_KEY = u"cms.publication.last_check"
+
+
+def run_publication_transitions(now=None):
+    """
+    Changes the publication epoch if any publication transitions have passed
+    since this function was last called.
+
+    Returns whether the publication epoch was changed.
+    """
+    if now is None:
+        now = timezone.now()
+    last_check = cache.get(LAST_TRANSITION_CHECK_KEY)
+    # If the last check has been evicted from the cache, assume that a transition has passed.
+    changed = last_check is None or has_transitions(last_check, now)
+    if changed:
+        bump_version(PUBLICATION_VERSION)
+    cache.set(LAST_TRANSITION_CHECK_KEY, now, None)
+    if changed:
+        transitions_passed.send(sender=None, start=last_check, end=now)
+    return changed
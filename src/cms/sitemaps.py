@@ -1,8 +1,37 @@
-"""Google sitemaps used by the page managment application."""
+"""
+Google sitemaps used by the page managment application.
 
+As well as working with the standard Django sitemap views, sitemaps can be
+generated in chunks of a fixed size, loading only the fields that they need.
+This allows the views in cms.views to stream very large sitemaps in constant
+memory.
+
+If the CMS_SITEMAPS_PRERENDER setting is True, then sitemaps are also written
+to storage as static files, along with gzipped copies, and the sitemap views
+serve the pre-rendered files instead of querying the database. When a model
+that a sitemap depends on is saved or deleted during a request, the affected
+pages of the sitemap are rewritten in the background once the request has
+finished. Changes made outside of a request, such as by imports, require the
+write_sitemaps command to be run.
+"""
+
+from __future__ import with_statement
+
+import os, gzip, tempfile, threading
+
+from django.conf import settings
 from django.contrib.sitemaps import Sitemap
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import default_storage, get_storage_class
+from django.core.paginator import EmptyPage
+from django.core.signals import request_started, request_finished
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_save, post_delete
+from django.utils.html import escape
 
-from cms.models import PublishedBase, OnlineBase, SearchMetaBase, PageBase
+from cms.background import run_in_background
+from cms.models import PublishedBase, OnlineBase, SearchMetaBase, PageBase, publication_manager
 
 
 # A dictionary of registered sitemap classes.
@@ -19,10 +48,124 @@ class BaseSitemap(Sitemap):
     
     model = None
     
+    # The number of items to load from the database at once.
+    chunk_size = 1000
+    
     def items(self):
         """Returns all items in this sitemap."""
         return self.model.objects.all()
     
+    def get_fields(self):
+        """
+        Returns the names of the fields needed to generate the sitemap, or
+        None to load all fields.
+        """
+        return None
+    
+    def get_models(self):
+        """
+        Returns the models that this sitemap depends on.
+        
+        Pre-rendered sitemaps are rewritten whenever an instance of one of
+        these models is saved or deleted.
+        """
+        return (self.model,)
+    
+    def get_queryset(self):
+        """Returns the items in this sitemap, loading only the required fields."""
+        queryset = self.items().order_by("pk")
+        fields = self.get_fields()
+        if fields is not None:
+            queryset = queryset.only(*fields)
+        return queryset
+    
+    def count(self):
+        """Returns the number of items in this sitemap."""
+        return self.items().count()
+    
+    def get_num_pages(self):
+        """Returns the number of pages in this sitemap."""
+        return max(1, (self.count() + self.limit - 1) // self.limit)
+    
+    def get_page_for_pk(self, pk):
+        """Returns the page of this sitemap that the item with the given primary key is, or would be, on."""
+        return self.items().filter(pk__lt=pk).count() // self.limit + 1
+    
+    def get_changed_pks(self, instance):
+        """
+        Returns the set of primary keys of items whose entries could be changed
+        by saving or deleting the given instance of one of the models returned
+        by get_models(), or None if the whole sitemap could be changed.
+        """
+        if self.model is not None and isinstance(instance, self.model):
+            return set((instance.pk,))
+        return None
+    
+    def iter_chunks(self, page=1):
+        """
+        Yields lists of items on the given page of this sitemap.
+        
+        Items are loaded in chunks using their primary key, so memory use does
+        not depend on the size of the sitemap.
+        """
+        queryset = self.get_queryset()
+        offset = (page - 1) * self.limit
+        if offset:
+            # Find the first item on this page without loading the items before it.
+            try:
+                start_pk = queryset.values_list("pk", flat=True)[offset]
+            except IndexError:
+                raise EmptyPage("That page contains no results.")
+            queryset = queryset.filter(pk__gte=start_pk)
+        remaining = self.limit
+        chunk_queryset = queryset
+        while remaining > 0:
+            chunk = list(chunk_queryset[:min(self.chunk_size, remaining)])
+            if not chunk:
+                break
+            yield chunk
+            remaining -= len(chunk)
+            chunk_queryset = queryset.filter(pk__gt=chunk[-1].pk)
+    
+    def get_locations(self, items):
+        """
+        Returns the locations of the given items.
+        
+        Subclasses can override this to compute the locations of a whole chunk
+        of items at once. A location of None excludes the item from the sitemap.
+        """
+        return [self.location(item) for item in items]
+    
+    def _get_item_attr(self, name, item, default=None):
+        """Returns the value of the named sitemap attribute for the given item."""
+        try:
+            attr = getattr(self, name)
+        except AttributeError:
+            return default
+        if callable(attr):
+            return attr(item)
+        return attr
+    
+    def get_url_info(self, items, domain, protocol):
+        """Returns the URL information for the given items, in the same format as get_urls()."""
+        urls = []
+        for item, location in zip(items, self.get_locations(items)):
+            if location is None:
+                continue
+            priority = self._get_item_attr("priority", item)
+            urls.append({
+                "item": item,
+                "location": u"{protocol}://{domain}{location}".format(
+                    protocol = self.protocol or protocol,
+                    domain = domain,
+                    location = location,
+                ),
+                "lastmod": self._get_item_attr("lastmod", item),
+                "changefreq": self._get_item_attr("changefreq", item),
+                "priority": str(priority if priority is not None else ""),
+            })
+        return urls
+    
     
 class PublishedBaseSitemap(BaseSitemap):
     
@@ -62,6 +205,10 @@ class PageBaseSitemap(SearchMetaBaseSitemap):
     
     Subclasses need to override the model property.
     """
+    
+    def lastmod(self, obj):
+        """Returns the last modified time of the given page, if known."""
+        return getattr(obj, "last_modified", None)
 
 
 class SitemapRegistrationError(Exception):
@@ -97,4 +244,320 @@ def register(model, sitemap_cls=None):
             "model": model,
         })
     # Register the sitemap.
-    registered_sitemaps[registration_key] = sitemap_cls
\ No newline at end of file
+    registered_sitemaps[registration_key] = sitemap_cls
+
+
+# Rendering.
+
+def get_index_locations(sitemaps, domain, protocol, sitemap_url_name="cms.views.sitemap"):
+    """
+    Returns the locations of every page of the given sitemaps, for use in a
+    sitemap index.
+    """
+    locations = []
+    for section in sorted(sitemaps.iterkeys()):
+        sitemap = sitemaps[section]
+        if callable(sitemap):
+            sitemap = sitemap()
+        location = u"{protocol}://{domain}{path}".format(
+            protocol = sitemap.protocol or protocol,
+            domain = domain,
+            path = reverse(sitemap_url_name, kwargs={"section": section}),
+        )
+        locations.append(location)
+        for page in xrange(2, sitemap.get_num_pages() + 1):
+            locations.append(u"{location}?p={page}".format(
+                location = location,
+                page = page,
+            ))
+    return locations
+
+
+def render_sitemap_index(locations):
+    """Yields the XML of a sitemap index listing the given locations."""
+    yield u'<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield u'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for location in locations:
+        yield u"<sitemap><loc>{location}</loc></sitemap>\n".format(
+            location = escape(location),
+        )
+    yield u"</sitemapindex>\n"
+
+
+def render_sitemap(url_chunks):
+    """
+    Yields the XML of a sitemap, given an iterable of lists of URL information,
+    as returned by BaseSitemap.get_url_info().
+    """
+    yield u'<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield u'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for urls in url_chunks:
+        parts = []
+        for url in urls:
+            parts.append(u"<url><loc>{location}</loc>".format(
+                location = escape(url["location"]),
+            ))
+            if url["lastmod"]:
+                parts.append(u"<lastmod>{lastmod}</lastmod>".format(
+                    lastmod = url["lastmod"].strftime("%Y-%m-%d"),
+                ))
+            if url["changefreq"]:
+                parts.append(u"<changefreq>{changefreq}</changefreq>".format(
+                    changefreq = escape(url["changefreq"]),
+                ))
+            if url["priority"]:
+                parts.append(u"<priority>{priority}</priority>".format(
+                    priority = escape(url["priority"]),
+                ))
+            parts.append(u"</url>\n")
+        yield u"".join(parts)
+    yield u"</urlset>\n"
+
+
+# Pre-rendered sitemaps.
+
+def is_prerender_enabled():
+    """Checks whether sitemaps should be written to storage."""
+    return getattr(settings, "CMS_SITEMAPS_PRERENDER", False)
+
+
+def get_sitemap_storage():
+    """Returns the storage used for pre-rendered sitemaps."""
+    storage_path = getattr(settings, "CMS_SITEMAPS_STORAGE", None)
+    if storage_path is None:
+        return default_storage
+    return get_storage_class(storage_path)()
+
+
+def get_sitemap_file_name(section=None, page=1):
+    """
+    Returns the name of the pre-rendered sitemap file for the given page of a
+    sitemap section, or the sitemap index if no section is given.
+    """
+    if section is None:
+        name = u"sitemap.xml"
+    elif page == 1:
+        name = u"sitemap-{section}.xml".format(
+            section = section,
+        )
+    else:
+        name = u"sitemap-{section}-{page}.xml".format(
+            section = section,
+            page = page,
+        )
+    return u"{directory}/{name}".format(
+        directory = getattr(settings, "CMS_SITEMAPS_DIRECTORY", "sitemaps"),
+        name = name,
+    )
+
+
+def _get_site_location():
+    """Returns the domain and protocol used in pre-rendered sitemaps."""
+    domain = getattr(settings, "CMS_SITEMAPS_DOMAIN", None)
+    if domain is None:
+        from django.contrib.sites.models import Site
+        if not Site._meta.installed:
+            raise ImproperlyConfigured("Pre-rendered sitemaps require the CMS_SITEMAPS_DOMAIN setting, or django.contrib.sites to be installed.")
+        domain = Site.objects.get_current().domain
+    return domain, getattr(settings, "CMS_SITEMAPS_PROTOCOL", "http")
+
+
+def _replace_file(storage, name, file_obj):
+    """
+    Replaces the named file in storage with the given file, so that the file
+    is never missing or partly written while it is being served.
+    """
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        path = None
+    if path is None:
+        # Storages without local paths can only replace files in one step if they overwrite existing names.
+        if storage.get_available_name(name) != name:
+            storage.delete(name)
+        storage.save(name, File(file_obj))
+    else:
+        temp_name = storage.save(name + ".tmp", File(file_obj))
+        os.rename(storage.path(temp_name), path)
+
+
+def _write_file(storage, name, content):
+    """
+    Writes the given iterable of unicode XML to storage, along with a gzipped
+    copy.
+    
+    The content is buffered in temporary files, so memory use does not depend
+    on the size of the sitemap. Existing files are replaced atomically where
+    the storage allows it.
+    """
+    with tempfile.TemporaryFile() as xml_file:
+        with tempfile.TemporaryFile() as gzip_file:
+            gzip_writer = gzip.GzipFile(fileobj=gzip_file, mode="wb")
+            for part in content:
+                part = part.encode("utf-8")
+                xml_file.write(part)
+                gzip_writer.write(part)
+            gzip_writer.close()
+            for file_name, file_obj in ((name, xml_file), (name + ".gz", gzip_file)):
+                file_obj.seek(0)
+                _replace_file(storage, file_name, file_obj)
+
+
+def write_sitemap_index(sitemaps=None, sitemap_url_name="cms.views.sitemap"):
+    """Writes the sitemap index to storage."""
+    if sitemaps is None:
+        sitemaps = registered_sitemaps
+    domain, protocol = _get_site_location()
+    locations = get_index_locations(sitemaps, domain, protocol, sitemap_url_name)
+    _write_file(get_sitemap_storage(), get_sitemap_file_name(), render_sitemap_index(locations))
+
+
+def write_sitemap_section(section, sitemaps=None, first_page=1):
+    """
+    Writes every page of the given sitemap section to storage, starting from
+    the given page.
+    
+    Returns the number of pages written. Pages left over from a larger version
+    of the section are deleted.
+    """
+    if sitemaps is None:
+        sitemaps = registered_sitemaps
+    sitemap = sitemaps[section]
+    if callable(sitemap):
+        sitemap = sitemap()
+    storage = get_sitemap_storage()
+    domain, protocol = _get_site_location()
+    with publication_manager.select_published(True):
+        num_pages = sitemap.get_num_pages()
+        for page in xrange(first_page, num_pages + 1):
+            url_chunks = (
+                sitemap.get_url_info(chunk, domain, protocol)
+                for chunk
+                in sitemap.iter_chunks(page)
+            )
+            _write_file(storage, get_sitemap_file_name(section, page), render_sitemap(url_chunks))
+    page = num_pages + 1
+    while storage.exists(get_sitemap_file_name(section, page)):
+        storage.delete(get_sitemap_file_name(section, page))
+        storage.delete(get_sitemap_file_name(section, page) + ".gz")
+        page += 1
+    return max(0, num_pages - first_page + 1)
+
+
+def write_sitemaps(sitemaps=None):
+    """
+    Writes all sitemaps, and the sitemap index, to storage.
+    
+    Returns the number of sitemap pages written.
+    """
+    if sitemaps is None:
+        sitemaps = registered_sitemaps
+    count = 0
+    for section in sitemaps.iterkeys():
+        count += write_sitemap_section(section, sitemaps)
+    write_sitemap_index(sitemaps)
+    return count
+
+
+def write_changed_sitemaps(changes, sitemaps=None):
+    """
+    Rewrites the pages of sitemap sections affected by the given changes, and
+    the sitemap index.
+    
+    The changes should be a dictionary mapping section names to the set of
+    primary keys of changed items, or to None if the whole section could have
+    changed. Items are ordered by primary key, so only the pages from the first
+    changed item onwards are rewritten. Returns the number of pages written.
+    """
+    if sitemaps is None:
+        sitemaps = registered_sitemaps
+    count = 0
+    for section, pks in changes.iteritems():
+        first_page = 1
+        if pks:
+            sitemap = sitemaps[section]
+            if callable(sitemap):
+                sitemap = sitemap()
+            with publication_manager.select_published(True):
+                first_page = sitemap.get_page_for_pk(min(pks))
+        count += write_sitemap_section(section, sitemaps, first_page)
+    write_sitemap_index(sitemaps)
+    return count
+
+
+def _merge_changes(changes, section, pks):
+    """Adds the changed primary keys of a section to the given changes, where None means the whole section."""
+    if section in changes and changes[section] is None:
+        return
+    if pks is None or section not in changes:
+        changes[section] = pks
+    else:
+        changes[section] |= pks
+
+
+# Sitemap changes made by the current request. This is None outside of a request.
+_pending_sections = threading.local()
+
+# Sitemap changes handed over by finished requests, waiting to be written in the background.
+_queued_changes = {}
+
+_queued_changes_lock = threading.Lock()
+
+
+def schedule_sitemap_write(sender, instance, **kwargs):
+    """
+    Signal handler that schedules the sitemap pages that depend on the saved
+    or deleted object to be rewritten once the current request has finished.
+    """
+    if not is_prerender_enabled():
+        return
+    changes = getattr(_pending_sections, "changes", None)
+    if changes is None:
+        return
+    for section, sitemap in registered_sitemaps.iteritems():
+        if callable(sitemap):
+            sitemap = sitemap()
+        if any(issubclass(sender, model) for model in sitemap.get_models()):
+            _merge_changes(changes, section, sitemap.get_changed_pks(instance))
+
+
+def start_pending_sitemaps(**kwargs):
+    """Starts collecting the sitemap changes made by the current request."""
+    _pending_sections.changes = {}
+
+
+def _write_queued_sitemaps():
+    """Writes all sitemap changes queued by finished requests."""
+    with _queued_changes_lock:
+        changes = _queued_changes.copy()
+        _queued_changes.clear()
+    if changes:
+        write_changed_sitemaps(changes)
+
+
+def write_pending_sitemaps(**kwargs):
+    """
+    Queues the sitemap changes made by the current request to be written in
+    the background.
+    
+    Changes from several requests are merged while they are waiting, so a burst
+    of saves only rewrites each page once.
+    """
+    changes = getattr(_pending_sections, "changes", None)
+    _pending_sections.changes = None
+    if changes:
+        with _queued_changes_lock:
+            queued = bool(_queued_changes)
+            for section, pks in changes.iteritems():
+                _merge_changes(_queued_changes, section, pks)
+        if not queued:
+            run_in_background(_write_queued_sitemaps)
+
+
+post_save.connect(schedule_sitemap_write)
+
+post_delete.connect(schedule_sitemap_write)
+
+request_started.connect(start_pending_sitemaps)
+
+request_finished.connect(write_pending_sitemaps)
@@ -4,7 +4,7 @@ from django import template
 from django.utils.safestring import mark_safe
 from django.template.defaultfilters import stringfilter
 
-from cms.html import process as process_html
+from cms.html import process_cached as process_html
 
 
 register = template.Library()
@@ -19,6 +19,8 @@ def html(text):
     The text is checked for permalinks embedded in <a> tags, expanding the
     permalinks to their referenced URL. Images containing a permalink source
     are checked for size and thumbnailed as appropriate.
+    
+    The processed text is cached until any of the referenced objects change.
     """
     if not text:
         return ""
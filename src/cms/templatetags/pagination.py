@@ -6,14 +6,35 @@ from django.core.paginator import Paginator, InvalidPage
 from django.http import Http404
 from django.utils.html import escape
 
+from cms.pagination import CursorPaginator, CursorPage
+
 
 register = template.Library()
 
 
 @register.assignment_tag(takes_context=True)
-def paginate(context, queryset, per_page=10, key="page"):
-    """Paginates the given queryset as sets it in the context as a variable."""
+def paginate(context, queryset, per_page=10, key="page", cursor=False):
+    """
+    Paginates the given queryset as sets it in the context as a variable.
+    
+    If cursor is True, then the queryset is paginated using cursors based on
+    its ordering, which avoids counting the queryset and is fast on deep
+    pages. Orderings that cannot be used for cursors fall back to page
+    numbers.
+    """
     request = context["request"]
+    if cursor:
+        try:
+            paginator = CursorPaginator(queryset, per_page)
+        except ValueError:
+            paginator = None
+        if paginator is not None:
+            try:
+                page = paginator.page(request.GET.get(key))
+            except InvalidPage:
+                raise Http404, "There are no items on that page."
+            page._pagination_key = key
+            return page
     # Parse the page number.
     try:
         page_number = int(request.GET[key])
@@ -30,12 +51,17 @@ def paginate(context, queryset, per_page=10, key="page"):
 
 @register.inclusion_tag("pagination/pagination.html", takes_context=True)
 def pagination(context, page_obj, pagination_key=None):
-    """Renders the pagination for the given page of items."""
+    """
+    Renders the pagination for the given page of items.
+    
+    Pages from a cursor paginator only have next and previous links.
+    """
     return {
         "request": context["request"],
         "page_obj": page_obj,
         "paginator": page_obj.paginator,
-        "pagination_key": pagination_key or getattr(page_obj, "_pagination_key", "page")
+        "pagination_key": pagination_key or getattr(page_obj, "_pagination_key", "page"),
+        "cursor_pagination": isinstance(page_obj, CursorPage),
     }
 
 
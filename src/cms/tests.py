@@ -1,8 +1,49 @@
-from django.test import TestCase
+import datetime, gzip, re, threading
+from cStringIO import StringIO
+from unittest import skipIf
 
+from PIL import Image
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.conf.urls import patterns, url
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.urlresolvers import reverse, clear_url_caches
+from django.core.files.base import ContentFile
+from django.core.paginator import InvalidPage
+from django.http import HttpResponse, Http404
+from django.template import Template, Context
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.http import urlsafe_base64_encode
+
+from cms import permalinks
+from cms.cache import get_version, bump_version, get_object_version_name
+
+from cms import timing, thumbnails, sitemaps, views
+from cms.html import process, process_cached, get_permalinks, start_pending_rerenders, run_pending_rerenders, _process
+from cms.pagination import CursorPaginator
+from cms.publication import run_publication_transitions
+from cms.middleware import PublicationMiddleware, TimingMiddleware
+from cms.models import managers
+from cms.models.managers import PublicationManager, PublicationManagementError, ThreadContextStack, GreenletContextStack, ContextVarContextStack
+from cms.apps.media.models import File
+from cms.apps.news.models import NewsFeed, Article, ArticleSitemap
+from cms.apps.pages.models import Page
+from cms.models import publication_manager
 from cms.models.fields import resolve_link, LinkResolutionError
 
 
+urlpatterns = patterns("",
+    url(r"^r/(?P<content_type_id>\d+)-(?P<object_id>[^/]+)/$", "django.contrib.contenttypes.views.shortcut", name="permalink_redirect"),
+    url(r"^sitemap-(?P<section>.+)\.xml$", "cms.views.sitemap"),
+)
+
+
 class TestLinkField(TestCase):
     
     def testResolveLink(self):
@@ -10,4 +51,605 @@ class TestLinkField(TestCase):
         self.assertEqual(resolve_link("www.example.com/foo/"), "http://www.example.com/foo/")
         self.assertEqual(resolve_link("www.example.com"), "http://www.example.com/")
         self.assertEqual(resolve_link("/foo/"), "/foo/")
-        self.assertRaises(LinkResolutionError, lambda: resolve_link("foo/"))
\ No newline at end of file
+        self.assertRaises(LinkResolutionError, lambda: resolve_link("foo/"))
+
+
+@override_settings(ROOT_URLCONF="cms.tests")
+class TestHtmlProcess(TestCase):
+    
+    def setUp(self):
+        self.users = [
+            User.objects.create(username="user{index}".format(index=index))
+            for index in xrange(5)
+        ]
+        
+    def testResolveMany(self):
+        permalink = permalinks.create(self.users[0])
+        self.assertEqual(permalinks.resolve_many([permalink, "/foo/", "/r/999-1/", "/r/{id}-bar/".format(id=ContentType.objects.get_for_model(User).id)]), {
+            permalink: self.users[0],
+            "/foo/": None,
+            "/r/999-1/": None,
+            "/r/{id}-bar/".format(id=ContentType.objects.get_for_model(User).id): None,
+        })
+        
+    def testParse(self):
+        content_type_id = ContentType.objects.get_for_model(User).id
+        permalink = permalinks.create(self.users[0])
+        self.assertEqual(permalink, reverse("permalink_redirect", kwargs={
+            "content_type_id": content_type_id,
+            "object_id": self.users[0].id,
+        }))
+        self.assertEqual(permalinks.parse(permalink), (unicode(content_type_id), unicode(self.users[0].id)))
+        self.assertRaises(permalinks.PermalinkError, lambda: permalinks.parse("/foo/"))
+        
+    def testExpand(self):
+        cache.clear()
+        content_type = ContentType.objects.get_for_model(NewsFeed)
+        homepage = Page.objects.create(
+            title = "Homepage",
+            content_type = content_type,
+        )
+        section = Page.objects.create(
+            parent = homepage,
+            title = "Section",
+            url_title = "section",
+            content_type = content_type,
+        )
+        subsection = Page.objects.create(
+            parent = section,
+            title = "Subsection",
+            url_title = "subsection",
+            content_type = content_type,
+        )
+        permalink = permalinks.create(subsection)
+        self.assertEqual(permalinks.expand(permalink), "/section/subsection/")
+        # Repeat expansions are cached.
+        with self.assertNumQueries(0):
+            self.assertEqual(permalinks.expand(permalink), "/section/subsection/")
+        # Changing an ancestor invalidates the cache.
+        section.url_title = "foo"
+        section.save()
+        self.assertEqual(permalinks.expand(permalink), "/foo/subsection/")
+        # Deleting the object invalidates the cache.
+        subsection.delete()
+        self.assertRaises(ObjectDoesNotExist, lambda: permalinks.expand(permalink))
+        
+    def testObjectVersions(self):
+        content_type = ContentType.objects.get_for_model(User)
+        user_version_name = get_object_version_name("auth", "user", self.users[0].pk)
+        content_type_version_name = get_object_version_name("contenttypes", "contenttype", content_type.pk)
+        user_version = get_version(user_version_name)
+        content_type_version = get_version(content_type_version_name)
+        self.users[0].save()
+        content_type.save()
+        # Only models that can be linked to have object versions.
+        self.assertNotEqual(get_version(user_version_name), user_version)
+        self.assertEqual(get_version(content_type_version_name), content_type_version)
+        
+    def testProcess(self):
+        text = u"".join(
+            u'<p><a href="{permalink}">Link</a> <a href="{permalink}">Link again</a></p>'.format(
+                permalink = permalinks.create(user),
+            )
+            for user in self.users
+        ) + u'<a href="/foo/">Foo</a>'
+        with self.assertNumQueries(1):
+            processed_text = process(text)
+        for user in self.users:
+            self.assertEqual(processed_text.count(u'href="{url}"'.format(url=user.get_absolute_url())), 2)
+        self.assertTrue(u'<a href="/foo/">Foo</a>' in processed_text)
+        
+    def testTokenizer(self):
+        text = u'<p><A data-note="a > b" HREF="/r/1-1/" class=link download>Foo</A> <img src=\'/r/1-2/\'/> <a href="/r/1-3/">Bar</a> <abbr title="a">A</abbr></p>'
+        self.assertEqual(get_permalinks(text), set((u"/r/1-1/", u"/r/1-2/", u"/r/1-3/")))
+        resolved_permalinks = {
+            u"/r/1-1/": (None, u"/foo/", u"Foo & co"),
+            u"/r/1-3/": None,
+        }
+        self.assertEqual(
+            _process(text, resolved_permalinks),
+            u'<p><A data-note="a > b" HREF="/foo/" class=link download title="Foo &amp; co">Foo</A> <img src=\'/r/1-2/\'/> <a href="/r/1-3/">Bar</a> <abbr title="a">A</abbr></p>',
+        )
+        # Attribute names inside quoted values are ignored.
+        text = u'<a title="see href=/r/1-1/" href="/r/1-2/">x</a>'
+        self.assertEqual(get_permalinks(text), set((u"/r/1-2/",)))
+        self.assertEqual(
+            _process(text, {u"/r/1-2/": (None, u"/bar/", u"Bar")}),
+            u'<a title="see href=/r/1-1/" href="/bar/">x</a>',
+        )
+        
+    def testProcessCached(self):
+        cache.clear()
+        text = u'<a href="{permalink}">Link</a>'.format(
+            permalink = permalinks.create(self.users[0]),
+        )
+        self.assertEqual(process_cached(text), process(text))
+        # Repeat renders are served from the cache.
+        with self.assertNumQueries(0):
+            self.assertTrue(u'href="/users/user0/"' in process_cached(text))
+        # Changing the linked object invalidates the cache.
+        self.users[0].username = "foo"
+        self.users[0].save()
+        self.assertTrue(u'href="/users/foo/"' in process_cached(text))
+        # Deleting the linked object invalidates the cache.
+        self.users[0].delete()
+        self.assertEqual(process_cached(text), text)
+        
+    def testPrecomputedHtmlField(self):
+        page = Page.objects.create(
+            title = "News",
+            content_type = ContentType.objects.get_for_model(NewsFeed),
+        )
+        news_feed = NewsFeed.objects.create(
+            page = page,
+        )
+        text = u'<a href="{permalink}">Link</a>'.format(
+            permalink = permalinks.create(self.users[0]),
+        )
+        article = Article.objects.create(
+            news_feed = news_feed,
+            title = "Article",
+            url_title = "article",
+            content = text,
+        )
+        self.assertEqual(article.content.processed, process(text))
+        # The processed version is used directly.
+        processed_text = process(text)
+        article = Article.objects.get(id=article.id)
+        with publication_manager.select_published(True), self.assertNumQueries(0):
+            self.assertEqual(process_cached(article.content), processed_text)
+        # Links to unpublished content are not stored.
+        draft = Article.objects.create(
+            news_feed = news_feed,
+            title = "Draft",
+            url_title = "draft",
+            is_online = False,
+        )
+        draft_text = u'<a href="{permalink}">Draft</a>'.format(
+            permalink = permalinks.create(draft),
+        )
+        linking_article = Article.objects.create(
+            news_feed = news_feed,
+            title = "Linking article",
+            url_title = "linking-article",
+            content = draft_text,
+        )
+        self.assertEqual(linking_article.content.processed, draft_text)
+        # Publishing the linked content re-renders the stored version.
+        draft.is_online = True
+        draft.save()
+        self.assertTrue(u'href="{url}"'.format(url=draft.get_absolute_url()) in Article.objects.get(id=linking_article.id).content.processed)
+        # Content is also re-rendered when a publication transition publishes it.
+        now = timezone.now()
+        draft.date = (now + datetime.timedelta(days=2)).date()
+        draft.save()
+        run_publication_transitions(now - datetime.timedelta(days=3))
+        draft.date = (now - datetime.timedelta(days=2)).date()
+        Article.objects.filter(id=draft.id).update(date=draft.date)
+        self.assertEqual(Article.objects.get(id=linking_article.id).content.processed, draft_text)
+        run_publication_transitions(now)
+        self.assertTrue(u'href="{url}"'.format(url=draft.get_absolute_url()) in Article.objects.get(id=linking_article.id).content.processed)
+        # Moving a page re-renders links to the content under it.
+        page.url_title = "latest"
+        page.save()
+        draft = Article.objects.get(id=draft.id)
+        self.assertTrue(u'href="{url}"'.format(url=draft.get_absolute_url()) in Article.objects.get(id=linking_article.id).content.processed)
+        # The processed version is ignored if the text changes.
+        article.content = u"<p>Foo</p>"
+        self.assertEqual(article.content.processed, None)
+        # Changing a linked object re-renders the processed version.
+        self.users[0].username = "foo"
+        self.users[0].save()
+        self.assertTrue(u'href="/users/foo/"' in Article.objects.get(id=article.id).content.processed)
+        # During a request, re-renders are deferred until the request has finished.
+        start_pending_rerenders()
+        try:
+            self.users[0].username = "bar"
+            self.users[0].save()
+            # Saving a page without changing its URL doesn't re-render everything.
+            page.title = "Latest news"
+            page.save()
+            self.assertTrue(u'href="/users/foo/"' in Article.objects.get(id=article.id).content.processed)
+        finally:
+            with self.settings(CMS_BACKGROUND_TASKS=False):
+                run_pending_rerenders()
+        self.assertTrue(u'href="/users/bar/"' in Article.objects.get(id=article.id).content.processed)
+
+
+@override_settings(ROOT_URLCONF="cms.tests")
+class TestVersions(TransactionTestCase):
+    
+    def testCommitBumpsVersions(self):
+        with transaction.atomic():
+            version = bump_version("test")
+            self.assertEqual(get_version("test"), version)
+        # The counter is changed again once the transaction is committed.
+        self.assertNotEqual(get_version("test"), version)
+
+
+class TestSitemaps(TestCase):
+    
+    def setUp(self):
+        page = Page.objects.create(
+            title = "News",
+            content_type = ContentType.objects.get_for_model(NewsFeed),
+        )
+        news_feed = NewsFeed.objects.create(
+            page = page,
+        )
+        for index in xrange(5):
+            Article.objects.create(
+                news_feed = news_feed,
+                title = "Article {index}".format(index=index),
+                url_title = "article-{index}".format(index=index),
+            )
+        self.sitemaps = {"news-article": type("TestArticleSitemap", (ArticleSitemap,), {
+            "limit": 2,
+            "chunk_size": 1,
+        })}
+        self.factory = RequestFactory()
+        clear_url_caches()
+        
+    def tearDown(self):
+        clear_url_caches()
+        
+    def testIterChunks(self):
+        sitemap = self.sitemaps["news-article"]()
+        self.assertEqual(sitemap.get_num_pages(), 3)
+        self.assertEqual([len(chunk) for chunk in sitemap.iter_chunks(1)], [1, 1])
+        self.assertEqual([len(chunk) for chunk in sitemap.iter_chunks(3)], [1])
+        
+    def testSitemapIndex(self):
+        response = views.sitemap_index(self.factory.get("/sitemap.xml"), self.sitemaps)
+        content = "".join(response.streaming_content)
+        self.assertTrue("/sitemap-news-article.xml</loc>" in content)
+        self.assertTrue("/sitemap-news-article.xml?p=3</loc>" in content)
+        self.assertFalse("?p=4" in content)
+        
+    def testSitemap(self):
+        locations = []
+        for page in (1, 2, 3):
+            response = views.sitemap(self.factory.get("/sitemap-news-article.xml", {"p": page}), self.sitemaps, "news-article")
+            content = "".join(response.streaming_content)
+            locations.extend(re.findall("<loc>(.*?)</loc>", content))
+        self.assertEqual(len(set(locations)), 5)
+        self.assertTrue(all("/article-" in location for location in locations))
+        self.assertRaises(Http404, lambda: views.sitemap(self.factory.get("/sitemap-news-article.xml", {"p": 4}), self.sitemaps, "news-article"))
+        
+    @override_settings(CMS_SITEMAPS_PRERENDER=True, CMS_SITEMAPS_DOMAIN="example.com", CMS_SITEMAPS_DIRECTORY="test-sitemaps")
+    def testPrerenderedSitemap(self):
+        self.assertEqual(sitemaps.write_sitemaps(self.sitemaps), 3)
+        try:
+            with self.assertNumQueries(0):
+                response = views.sitemap(self.factory.get("/sitemap-news-article.xml", {"p": 3}), self.sitemaps, "news-article")
+                self.assertTrue("http://example.com/" in "".join(response.streaming_content))
+                response = views.sitemap_index(self.factory.get("/sitemap.xml", HTTP_ACCEPT_ENCODING="gzip"), self.sitemaps)
+                self.assertEqual(response["Content-Encoding"], "gzip")
+                content = gzip.GzipFile(fileobj=StringIO("".join(response.streaming_content))).read()
+                self.assertTrue("/sitemap-news-article.xml?p=3</loc>" in content)
+            # Changes outside of a request are left to the write_sitemaps command.
+            article = Article.objects.order_by("-pk")[0]
+            article.save()
+            self.assertEqual(getattr(sitemaps._pending_sections, "changes", None), None)
+            # Saving an article during a request schedules its page to be rewritten.
+            sitemaps.start_pending_sitemaps()
+            article.save()
+            changes = sitemaps._pending_sections.changes
+            self.assertEqual(changes, {"news-article": set((article.pk,))})
+            # Only the pages from the changed item onwards are rewritten.
+            storage = sitemaps.get_sitemap_storage()
+            storage.delete(sitemaps.get_sitemap_file_name("news-article", 1))
+            self.assertEqual(sitemaps.write_changed_sitemaps(changes, self.sitemaps), 1)
+            self.assertFalse(storage.exists(sitemaps.get_sitemap_file_name("news-article", 1)))
+            self.assertTrue(storage.exists(sitemaps.get_sitemap_file_name("news-article", 3)))
+            # Files are replaced through temporary files, which are not left behind.
+            self.assertFalse(any(name.endswith(".tmp") for name in storage.listdir("test-sitemaps")[1]))
+        finally:
+            sitemaps._pending_sections.changes = None
+            storage = sitemaps.get_sitemap_storage()
+            for name in storage.listdir("test-sitemaps")[1]:
+                storage.delete("test-sitemaps/" + name)
+
+
+class TestArticleNeighbours(TestCase):
+    
+    def setUp(self):
+        page = Page.objects.create(
+            title = "News",
+            content_type = ContentType.objects.get_for_model(NewsFeed),
+        )
+        news_feed = NewsFeed.objects.create(
+            page = page,
+        )
+        today = datetime.date.today()
+        # Several articles share a date.
+        for index, date in enumerate((today, today, today - datetime.timedelta(days=1), today)):
+            Article.objects.create(
+                news_feed = news_feed,
+                title = "Article {index}".format(index=index),
+                url_title = "article-{index}".format(index=index),
+                date = date,
+            )
+        
+    def testGetNeighbours(self):
+        articles = list(Article.objects.order_by("date", "id"))
+        for index, article in enumerate(articles):
+            with self.assertNumQueries(1):
+                before, after = Article.objects.get_neighbours(article)
+            self.assertEqual(before and before.id, articles[index - 1].id if index > 0 else None)
+            self.assertEqual(after and after.id, articles[index + 1].id if index < len(articles) - 1 else None)
+            
+    def testGetNeighboursMySQL(self):
+        articles = list(Article.objects.order_by("date", "id"))
+        # MySQL fetches each neighbour separately.
+        connection.vendor = "mysql"
+        try:
+            with self.assertNumQueries(2):
+                before, after = Article.objects.get_neighbours(articles[1])
+        finally:
+            del connection.vendor
+        self.assertEqual((before.id, after.id), (articles[0].id, articles[2].id))
+
+
+class TestCursorPaginator(TestCase):
+    
+    def setUp(self):
+        for index in xrange(7):
+            User.objects.create(
+                username = "user-{index}".format(index=index),
+                last_name = "Name {index}".format(index=index // 3),
+            )
+        self.queryset = User.objects.order_by("-last_name")
+        self.users = list(User.objects.order_by("-last_name", "-pk"))
+        
+    def testPages(self):
+        paginator = CursorPaginator(self.queryset, 3)
+        self.assertEqual(paginator.ordering, ("-last_name", "-pk",))
+        # Page forwards through the queryset.
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            with self.assertNumQueries(1):
+                pages.append(paginator.page(pages[-1].next_page_number()))
+        self.assertEqual([list(page) for page in pages], [self.users[0:3], self.users[3:6], self.users[6:7]])
+        self.assertFalse(pages[0].has_previous())
+        # Page backwards through the queryset.
+        page = paginator.page(pages[-1].previous_page_number())
+        self.assertEqual(list(page), self.users[3:6])
+        page = paginator.page(page.previous_page_number())
+        self.assertEqual(list(page), self.users[0:3])
+        self.assertFalse(page.has_previous())
+        # The count is cached.
+        cache.clear()
+        self.assertEqual(paginator.count, 7)
+        with self.assertNumQueries(0):
+            self.assertEqual(CursorPaginator(self.queryset, 3).num_pages, 3)
+        
+    def testPaginateTag(self):
+        template = Template("{% load pagination %}{% paginate users 3 cursor=True as page_obj %}{{page_obj|length}}{% pagination page_obj %}")
+        request = RequestFactory().get("/")
+        content = template.render(Context({"request": request, "users": self.queryset}))
+        self.assertTrue(content.startswith("3"))
+        next_cursor = re.search(r'rel="next" href="/\?page=([^"]+)"', content).group(1)
+        request = RequestFactory().get("/", {"page": next_cursor})
+        content = template.render(Context({"request": request, "users": self.queryset}))
+        self.assertTrue('rel="prev"' in content)
+        
+    def testReversedQueryset(self):
+        paginator = CursorPaginator(self.queryset.reverse(), 3)
+        self.assertEqual(paginator.ordering, ("last_name", "pk",))
+        users = list(reversed(self.users))
+        page = paginator.page()
+        self.assertEqual(list(page), users[0:3])
+        page = paginator.page(page.next_page_number())
+        self.assertEqual(list(page), users[3:6])
+        page = paginator.page(page.previous_page_number())
+        self.assertEqual(list(page), users[0:3])
+        
+    def testUnsupportedOrdering(self):
+        for ordering in (("?",), ("groups__name",), ("username", "missing")):
+            self.assertRaises(ValueError, lambda: CursorPaginator(User.objects.order_by(*ordering), 3))
+        # The paginate tag falls back to page numbers.
+        template = Template("{% load pagination %}{% paginate users 3 cursor=True as page_obj %}{{page_obj.number}}")
+        request = RequestFactory().get("/", {"page": "2"})
+        content = template.render(Context({"request": request, "users": User.objects.order_by("groups__name", "pk")}))
+        self.assertEqual(content, "2")
+        
+    def testInvalidCursor(self):
+        paginator = CursorPaginator(self.queryset, 3)
+        self.assertRaises(InvalidPage, lambda: paginator.page("foo"))
+        self.assertRaises(InvalidPage, lambda: paginator.page(paginator.page().next_cursor[:-2]))
+        # Well-formed tokens with malformed data are also rejected.
+        for data in ('{"a": 1}', '["n", null, null]', '["n", "Name 1"]', '["x", "Name 1", "1"]', '["n", "Name 1", ""]', '"n"'):
+            self.assertRaises(InvalidPage, lambda: paginator.page(urlsafe_base64_encode(data)))
+
+
+class TestThumbnails(TestCase):
+    
+    def setUp(self):
+        cache.clear()
+        image_data = StringIO()
+        Image.new("RGB", (400, 200)).save(image_data, "PNG")
+        self.file = File(title="Image")
+        self.file.file.save("test.png", ContentFile(image_data.getvalue()), save=False)
+        
+    def tearDown(self):
+        self.file.file.delete(save=False)
+        
+    def testAsyncThumbnail(self):
+        with self.settings(CMS_THUMBNAIL_WORKERS=1):
+            self.assertEqual(thumbnails.get_thumbnail(self.file.file, 40, 20), None)
+            # Concurrent requests for the same thumbnail are coalesced.
+            self.assertEqual(thumbnails.get_thumbnail(self.file.file, 40, 20), None)
+            self.assertEqual(len(thumbnails._pending_results), 1)
+            thumbnails.wait_for_thumbnails(10)
+            thumbnail = thumbnails.get_thumbnail(self.file.file, 40, 20)
+        self.assertEqual((thumbnail.width, thumbnail.height), (40, 20))
+        
+    def testSyncThumbnail(self):
+        with self.settings(CMS_THUMBNAIL_WORKERS=0):
+            thumbnail = thumbnails.get_thumbnail(self.file.file, 40, 20)
+        self.assertEqual((thumbnail.width, thumbnail.height), (40, 20))
+        
+    def testFailedThumbnail(self):
+        self.file.file.delete(save=False)
+        self.file.file.save("test.png", ContentFile("Not an image."), save=False)
+        for workers in (0, 1):
+            cache.clear()
+            with self.settings(CMS_THUMBNAIL_WORKERS=workers):
+                if workers:
+                    self.assertEqual(thumbnails.get_thumbnail(self.file.file, 40, 20), None)
+                    thumbnails.wait_for_thumbnails(10)
+                # Failed thumbnails are reported, and no longer pending.
+                self.assertRaises(IOError, lambda: thumbnails.get_thumbnail(self.file.file, 40, 20))
+            self.assertEqual(thumbnails._pending_results, {})
+
+
+class TestPublicationManager(TestCase):
+    
+    def testEndToken(self):
+        manager = PublicationManager()
+        self.assertFalse(manager.select_published_active())
+        outer_token = manager.begin(True)
+        inner_token = manager.begin(False)
+        manager.begin(False)
+        self.assertFalse(manager.select_published_active())
+        # Ending the inner block also ends the block left open within it.
+        manager.end(inner_token)
+        self.assertTrue(manager.select_published_active())
+        manager.end(outer_token)
+        self.assertFalse(manager.select_published_active())
+        self.assertRaises(PublicationManagementError, manager.end)
+        
+    def testInterleavedRequests(self):
+        middleware = PublicationMiddleware()
+        factory = RequestFactory()
+        staff_user = User(username="staff", is_staff=True, is_active=True)
+        results = {}
+        preview_started = threading.Event()
+        published_finished = threading.Event()
+        def preview_request():
+            request = factory.get("/", {"preview": "1"})
+            request.user = staff_user
+            middleware.process_request(request)
+            preview_started.set()
+            published_finished.wait(5)
+            results["preview"] = publication_manager.select_published_active()
+            middleware.process_response(request, HttpResponse())
+        def published_request():
+            preview_started.wait(5)
+            request = factory.get("/")
+            request.user = AnonymousUser()
+            middleware.process_request(request)
+            results["published"] = publication_manager.select_published_active()
+            middleware.process_response(request, HttpResponse())
+            results["published_after"] = publication_manager.select_published_active()
+            published_finished.set()
+        threads = [threading.Thread(target=preview_request), threading.Thread(target=published_request)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {"preview": False, "published": True, "published_after": False})
+        
+    def testThreadInterleaving(self):
+        manager = PublicationManager(ThreadContextStack())
+        results = []
+        started = threading.Event()
+        def other_thread():
+            started.wait(5)
+            results.append(manager.select_published_active())
+            manager.begin(False)
+            results.append(manager.select_published_active())
+        manager.begin(True)
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        started.set()
+        thread.join()
+        self.assertEqual(results, [False, False])
+        self.assertTrue(manager.select_published_active())
+        
+    @skipIf(managers.greenlet is None, "greenlet is not installed.")
+    def testGreenletInterleaving(self):
+        manager = PublicationManager(GreenletContextStack())
+        results = []
+        def preview_greenlet():
+            token = manager.begin(False)
+            published.switch()
+            results.append(("preview", manager.select_published_active()))
+            manager.end(token)
+            published.switch()
+        def published_greenlet():
+            token = manager.begin(True)
+            preview.switch()
+            results.append(("published", manager.select_published_active()))
+            manager.end(token)
+            results.append(("published_after", manager.select_published_active()))
+        preview = managers.greenlet.greenlet(preview_greenlet)
+        published = managers.greenlet.greenlet(published_greenlet)
+        preview.switch()
+        self.assertEqual(results, [("preview", False), ("published", True), ("published_after", False)])
+        self.assertFalse(manager.select_published_active())
+        
+    @skipIf(managers.contextvars is None, "contextvars is not available.")
+    def testContextVarInterleaving(self):
+        manager = PublicationManager(ContextVarContextStack())
+        preview = managers.contextvars.copy_context()
+        published = managers.contextvars.copy_context()
+        preview_token = preview.run(manager.begin, False)
+        published_token = published.run(manager.begin, True)
+        self.assertFalse(preview.run(manager.select_published_active))
+        self.assertTrue(published.run(manager.select_published_active))
+        preview.run(manager.end, preview_token)
+        self.assertTrue(published.run(manager.select_published_active))
+        published.run(manager.end, published_token)
+        self.assertFalse(published.run(manager.select_published_active))
+        self.assertFalse(manager.select_published_active())
+        
+    def testOuterBlockPreserved(self):
+        middleware = PublicationMiddleware()
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        with publication_manager.select_published(False):
+            middleware.process_request(request)
+            self.assertTrue(publication_manager.select_published_active())
+            middleware.process_response(request, HttpResponse())
+            self.assertFalse(publication_manager.select_published_active())
+
+
+class TestTiming(TestCase):
+    
+    def testStages(self):
+        # Stages are ignored when not recording.
+        with timing.stage("foo"):
+            pass
+        self.assertEqual(timing.stop_recording(), None)
+        # Record some stages.
+        timing.start_recording()
+        query_log_length = len(connection.queries)
+        with timing.stage("foo"):
+            list(ContentType.objects.all())
+            with timing.stage("bar"):
+                pass
+        with timing.stage("bar"):
+            pass
+        # Queries are counted without being logged.
+        self.assertEqual(len(connection.queries), query_log_length)
+        timings = dict((stage.name, stage) for stage in timing.stop_recording())
+        self.assertEqual(sorted(timings), ["bar", "foo", "total"])
+        self.assertEqual(timings["foo"].count, 1)
+        self.assertEqual(timings["foo"].query_count, 1)
+        self.assertEqual(timings["bar"].count, 2)
+        self.assertEqual(timings["bar"].query_count, 0)
+        self.assertEqual(timings["total"].query_count, 1)
+        
+    def testMiddleware(self):
+        request = RequestFactory().get("/")
+        middleware = TimingMiddleware()
+        timing.reset_counters()
+        with self.settings(CMS_TIMING=True, CMS_TIMING_SINKS=("cms.timing.record_counters",)):
+            middleware.process_request(request)
+            with timing.stage("foo"):
+                pass
+            response = middleware.process_response(request, HttpResponse())
+        self.assertTrue(response["Server-Timing"].startswith('foo;dur='))
+        self.assertEqual([counter.name for counter in timing.get_counters()], ["foo", "total"])
@@ -0,0 +1,205 @@
+"""
+Asynchronous generation of thumbnails.
+
+Generating a thumbnail means loading and resizing the original image, which is
+far too slow to do while rendering a page. Instead, thumbnails are generated by
+a pool of worker processes, and the original image is used until the thumbnail
+is ready.
+
+The number of worker processes is set using the CMS_THUMBNAIL_WORKERS setting.
+This defaults to 0, meaning that thumbnails are generated synchronously, as
+they are needed. Once a thumbnail generated by the pool is ready, any stored
+HTML linking to its image is re-rendered in the background.
+"""
+
+from __future__ import with_statement
+
+import os, functools, threading, multiprocessing
+
+from django.conf import settings
+from django.core import urlresolvers
+from django.core.cache import cache
+from django.db import models
+from django.db.models.fields.files import FieldFile
+
+import optimizations
+
+from cms import permalinks
+from cms.background import run_in_background
+
+
+def get_thumbnail_workers():
+    """Returns the number of worker processes used to generate thumbnails."""
+    return getattr(settings, "CMS_THUMBNAIL_WORKERS", 0)
+
+
+# How long a thumbnail can be waiting for generation before it is requested again.
+PENDING_TIMEOUT = 60 * 5
+
+# How long to wait before retrying a thumbnail that could not be generated.
+FAILED_TIMEOUT = 60 * 60
+
+
+def _get_thumbnail_cache_key(thumbnail):
+    """Returns the key used by the asset cache to store the given thumbnail."""
+    return thumbnail._asset.get_cache_key()
+
+
+def _get_pending_key(cache_key):
+    """Returns the cache key used to mark a thumbnail as waiting for generation."""
+    return u"cms.thumbnails.pending.{cache_key}".format(
+        cache_key = cache_key,
+    )
+
+
+def _get_failed_key(cache_key):
+    """Returns the cache key used to mark a thumbnail as failed."""
+    return u"cms.thumbnails.failed.{cache_key}".format(
+        cache_key = cache_key,
+    )
+
+
+def _get_field_file(app_label, model_name, field_name, name):
+    """Recreates a file stored in the given model field."""
+    field = models.get_model(app_label, model_name)._meta.get_field(field_name)
+    return FieldFile(None, field, name)
+
+
+def _generate_thumbnail(app_label, model_name, field_name, name, width, height, method):
+    """
+    Generates the given thumbnail.
+
+    Returns the cached name and meta of the thumbnail, or None if the
+    thumbnail could not be generated. This is run in a worker process, so it
+    must not access the database, and must not raise, as the pool has no way
+    of reporting errors.
+    """
+    try:
+        thumbnail = optimizations.get_thumbnail(_get_field_file(app_label, model_name, field_name, name), width, height, method)
+        return thumbnail._asset_cache.get_name_and_meta(thumbnail._asset)
+    except Exception:  # PIL raises all sorts of exceptions.
+        return None
+
+
+def _init_worker():
+    """Initializes a worker process."""
+    # Don't share cache connections with the parent process.
+    for cache_backend in (cache, optimizations.default_asset_cache._cache):
+        getattr(cache_backend, "close", lambda: None)()
+
+
+_pool = None
+
+_pool_pid = None
+
+_pool_lock = threading.Lock()
+
+# Thumbnails generated by this process that have not yet completed, indexed by cache key.
+_pending_results = {}
+
+
+def _get_pool():
+    """Returns the worker pool for this process, starting it if required."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        # A pool inherited from a parent process cannot be used.
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(get_thumbnail_workers(), initializer=_init_worker)
+            _pool_pid = os.getpid()
+            _pending_results.clear()
+        return _pool
+
+
+def _rerender_linking_html(permalink):
+    """Re-renders the stored HTML linking to the given permalink."""
+    from cms.html import schedule_rerender
+    schedule_rerender(permalink)
+
+
+def _thumbnail_generated(cache_key, permalink, name_and_meta):
+    """
+    Stores the result of generating a thumbnail in the asset cache.
+
+    If a permalink is given, then stored HTML linking to it, which will have
+    been stored without the thumbnail, is re-rendered in the background.
+    """
+    if name_and_meta is None:
+        cache.set(_get_failed_key(cache_key), True, FAILED_TIMEOUT)
+    else:
+        optimizations.default_asset_cache._cache.set(cache_key, name_and_meta)
+    cache.delete(_get_pending_key(cache_key))
+    with _pool_lock:
+        _pending_results.pop(cache_key, None)
+    if permalink is not None:
+        run_in_background(_rerender_linking_html, permalink)
+
+
+def _get_permalink(obj):
+    """Returns the permalink for the given object, or None if it cannot be linked to."""
+    if obj is None or obj.pk is None:
+        return None
+    try:
+        return permalinks.create(obj)
+    except urlresolvers.NoReverseMatch:
+        return None
+
+
+def generate_thumbnail(file, width=None, height=None, method="proportional"):
+    """
+    Queues the given thumbnail for generation by the worker pool.
+
+    Requests for a thumbnail that is already queued, in this or any other
+    process, are ignored.
+    """
+    thumbnail = optimizations.get_thumbnail(file, width, height, method)
+    cache_key = _get_thumbnail_cache_key(thumbnail)
+    if cache.get(_get_failed_key(cache_key)):
+        return
+    if not cache.add(_get_pending_key(cache_key), True, PENDING_TIMEOUT):
+        return
+    opts = file.instance._meta
+    args = (opts.app_label, opts.object_name, file.field.name, file.name, width, height, method)
+    if get_thumbnail_workers():
+        callback = functools.partial(_thumbnail_generated, cache_key, _get_permalink(file.instance))
+        pool = _get_pool()
+        with _pool_lock:
+            _pending_results[cache_key] = pool.apply_async(_generate_thumbnail, args, callback=callback)
+    else:
+        name_and_meta = None
+        try:
+            name_and_meta = _generate_thumbnail(*args)
+        finally:
+            # The caller will use the thumbnail straight away, so nothing needs re-rendering.
+            _thumbnail_generated(cache_key, None, name_and_meta)
+
+
+def get_thumbnail(file, width=None, height=None, method="proportional"):
+    """
+    Returns the thumbnail of the given size, or None if it has not been
+    generated yet.
+
+    If the thumbnail has not been generated, then it is queued for generation.
+    Raises IOError if the thumbnail could not be generated.
+    """
+    thumbnail = optimizations.get_thumbnail(file, width, height, method)
+    cache_key = _get_thumbnail_cache_key(thumbnail)
+    if thumbnail._asset_cache._cache.get(cache_key) is None:
+        generate_thumbnail(file, width, height, method)
+        if cache.get(_get_failed_key(cache_key)):
+            raise IOError("The thumbnail for {name} could not be generated.".format(
+                name = file.name,
+            ))
+        if get_thumbnail_workers():
+            return None
+        # Thumbnails are generated synchronously, so may now be available.
+        if thumbnail._asset_cache._cache.get(cache_key) is None:
+            return None
+    return thumbnail
+
+
+def wait_for_thumbnails(timeout=None):
+    """Waits for all thumbnails queued by this process to be generated."""
+    with _pool_lock:
+        results = list(_pending_results.itervalues())
+    for result in results:
+        result.wait(timeout)
@@ -0,0 +1,333 @@
+"""
+Instrumentation of the page request pipeline.
+
+Stages of the request pipeline, such as page tree lookup, content loading,
+URL resolution, the content view, template rendering and HTML processing, are
+wrapped in timing stages. When the TimingMiddleware is installed and the
+CMS_TIMING setting is True, the wall time and the number and duration of SQL
+queries of each stage are recorded for every request.
+
+The recorded timings are added to the response as a Server-Timing header, and
+passed to every metrics sink listed in the CMS_TIMING_SINKS setting. A sink is
+a callable that accepts the request and a list of Timing objects. When timing
+is not enabled, each stage costs a single thread-local lookup.
+"""
+
+from __future__ import with_statement
+
+import logging, threading, time
+from functools import wraps
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections
+from django.utils.module_loading import import_by_path
+
+
+logger = logging.getLogger("cms.timing")
+
+
+class Timing(object):
+
+    """The accumulated timing of a single stage of a request."""
+
+    __slots__ = ("name", "count", "duration", "query_count", "query_duration",)
+
+    def __init__(self, name):
+        """Initializes the Timing."""
+        self.name = name
+        self.count = 0
+        self.duration = 0.0
+        self.query_count = 0
+        self.query_duration = 0.0
+
+    def __repr__(self):
+        """Returns a debug representation of the Timing."""
+        return "<Timing {name}: {count} calls, {duration:.1f}ms, {query_count} queries, {query_duration:.1f}ms>".format(
+            name = self.name,
+            count = self.count,
+            duration = self.duration * 1000,
+            query_count = self.query_count,
+            query_duration = self.query_duration * 1000,
+        )
+
+
+class TimingRecorder(object):
+
+    """Records the timings of a single request."""
+
+    def __init__(self):
+        """Initializes the TimingRecorder."""
+        self.start_time = time.time()
+        self.timings = {}
+        self.query_count = 0
+        self.query_duration = 0.0
+
+    def _get_query_state(self):
+        """
+        Returns the number of queries run since recording started, and their total
+        duration.
+        """
+        return self.query_count, self.query_duration
+
+    def record(self, name, duration, query_count, query_duration):
+        """Adds the given measurements to the named stage."""
+        try:
+            timing = self.timings[name]
+        except KeyError:
+            timing = self.timings[name] = Timing(name)
+        timing.count += 1
+        timing.duration += duration
+        timing.query_count += query_count
+        timing.query_duration += query_duration
+
+    def finish(self):
+        """
+        Stops recording, and returns a list of timings, including a total timing
+        for the whole request.
+        """
+        self.record("total", time.time() - self.start_time, self.query_count, self.query_duration)
+        return sorted(self.timings.itervalues(), key=lambda timing: timing.name)
+
+
+_local = threading.local()
+
+
+class _TimingCursor(object):
+
+    """
+    A database cursor that records the number and duration of its queries in the
+    current TimingRecorder.
+    
+    Unlike a debug cursor, no record of the individual queries is kept.
+    """
+
+    def __init__(self, cursor):
+        """Initializes the _TimingCursor."""
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        """Returns an attribute of the wrapped cursor."""
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        """Iterates over the results of the wrapped cursor."""
+        return iter(self._cursor)
+
+    def _timed(self, func, *args):
+        """Calls the given cursor method, timing it if timings are being recorded."""
+        recorder = getattr(_local, "recorder", None)
+        if recorder is None:
+            return func(*args)
+        start_time = time.time()
+        try:
+            return func(*args)
+        finally:
+            recorder.query_count += 1
+            recorder.query_duration += time.time() - start_time
+
+    def execute(self, *args):
+        """Runs a query."""
+        return self._timed(self._cursor.execute, *args)
+
+    def executemany(self, *args):
+        """Runs a query against several sets of parameters."""
+        return self._timed(self._cursor.executemany, *args)
+
+
+def _install_timing_cursor(connection):
+    """Makes the given database connection create cursors that record query timings."""
+    if getattr(connection, "_timing_cursor_installed", False):
+        return
+    create_cursor = connection.create_cursor
+    def create_timing_cursor():
+        return _TimingCursor(create_cursor())
+    connection.create_cursor = create_timing_cursor
+    connection._timing_cursor_installed = True
+
+
+def start_recording():
+    """Starts recording timings for the current thread."""
+    for connection in connections.all():
+        _install_timing_cursor(connection)
+    _local.recorder = TimingRecorder()
+
+
+def stop_recording():
+    """
+    Stops recording timings for the current thread.
+
+    Returns a list of recorded timings, or None if timings were not being
+    recorded.
+    """
+    recorder = getattr(_local, "recorder", None)
+    if recorder is None:
+        return None
+    _local.recorder = None
+    return recorder.finish()
+
+
+def discard_recording(**kwargs):
+    """
+    Signal handler that stops recording timings at the end of a request, in
+    case the request failed before the timings were reported.
+    """
+    _local.recorder = None
+
+
+request_finished.connect(discard_recording)
+
+
+class _Stage(object):
+
+    """Context manager that records the timing of a stage."""
+
+    __slots__ = ("_recorder", "_name", "_start_time", "_query_state",)
+
+    def __init__(self, recorder, name):
+        """Initializes the _Stage."""
+        self._recorder = recorder
+        self._name = name
+
+    def __enter__(self):
+        """Starts timing the stage."""
+        self._query_state = self._recorder._get_query_state()
+        self._start_time = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stops timing the stage."""
+        duration = time.time() - self._start_time
+        query_count, query_duration = self._recorder._get_query_state()
+        start_query_count, start_query_duration = self._query_state
+        self._recorder.record(self._name, duration, query_count - start_query_count, query_duration - start_query_duration)
+
+
+class _NullStage(object):
+
+    """Context manager used when timings are not being recorded."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+def stage(name):
+    """
+    Returns a context manager that records the timing of the named stage.
+
+    Nested stages are recorded independently, so the timing of an outer stage
+    includes the timing of any inner stages.
+    """
+    recorder = getattr(_local, "recorder", None)
+    if recorder is None:
+        return _null_stage
+    return _Stage(recorder, name)
+
+
+def timed(name):
+    """Decorator that records the timing of each call to a function as the named stage."""
+    def decorator(func):
+        @wraps(func)
+        def do_timed(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return do_timed
+    return decorator
+
+
+def format_server_timing(timings):
+    """Formats the given timings as a Server-Timing header value."""
+    metrics = []
+    for timing in timings:
+        metrics.append(u'{name};dur={duration:.1f};desc="{count} calls, {query_count} queries"'.format(
+            name = timing.name,
+            duration = timing.duration * 1000,
+            count = timing.count,
+            query_count = timing.query_count,
+        ))
+        if timing.query_count:
+            metrics.append(u"{name}-db;dur={query_duration:.1f}".format(
+                name = timing.name,
+                query_duration = timing.query_duration * 1000,
+            ))
+    return u", ".join(metrics)
+
+
+# Metrics sinks.
+
+def log_timings(request, timings):
+    """Metrics sink that logs the timings of every request to the cms.timing logger."""
+    logger.info(u"{path} {timings}".format(
+        path = request.path,
+        timings = u" ".join(
+            u"{name}={duration:.1f}ms/{query_count}q".format(
+                name = timing.name,
+                duration = timing.duration * 1000,
+                query_count = timing.query_count,
+            )
+            for timing in timings
+        ),
+    ))
+
+
+_counters = {}
+
+_counters_lock = threading.Lock()
+
+
+def record_counters(request, timings):
+    """Metrics sink that accumulates the timings of all requests in this process."""
+    with _counters_lock:
+        for timing in timings:
+            try:
+                counter = _counters[timing.name]
+            except KeyError:
+                counter = _counters[timing.name] = Timing(timing.name)
+            counter.count += timing.count
+            counter.duration += timing.duration
+            counter.query_count += timing.query_count
+            counter.query_duration += timing.query_duration
+
+
+def get_counters():
+    """Returns a list of timings accumulated by record_counters() in this process."""
+    with _counters_lock:
+        counters = []
+        for counter in _counters.itervalues():
+            timing = Timing(counter.name)
+            timing.count = counter.count
+            timing.duration = counter.duration
+            timing.query_count = counter.query_count
+            timing.query_duration = counter.query_duration
+            counters.append(timing)
+    return sorted(counters, key=lambda timing: timing.name)
+
+
+def reset_counters():
+    """Clears all timings accumulated by record_counters()."""
+    with _counters_lock:
+        _counters.clear()
+
+
+_sinks = {}
+
+
+def get_sinks():
+    """Returns the metrics sinks listed in the CMS_TIMING_SINKS setting."""
+    sink_paths = tuple(getattr(settings, "CMS_TIMING_SINKS", ()))
+    try:
+        return _sinks[sink_paths]
+    except KeyError:
+        sinks = _sinks[sink_paths] = [
+            import_by_path(sink)
+            for sink
+            in sink_paths
+        ]
+        return sinks
@@ -1,8 +1,15 @@
 """Views used by the CMS."""
 
+from django.contrib.sites.models import get_current_site
+from django.core.paginator import EmptyPage
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import patch_vary_headers
 from django.views import generic
 
+from cms.models import publication_manager
+from cms.sitemaps import get_index_locations, render_sitemap_index, render_sitemap, is_prerender_enabled, get_sitemap_storage, get_sitemap_file_name
+
 
 def handler500(request):
     """Renders a pretty error page."""
@@ -51,4 +58,123 @@ class SearchMetaDetailView(SearchMetaDetailMixin, generic.DetailView):
     
 class PageDetailView(PageDetailMixin, generic.DetailView):
     
-    """A simple page detail view."""
\ No newline at end of file
+    """A simple page detail view."""
+    
+    
+def _get_sitemap(sitemaps, section):
+    """Returns an instance of the named sitemap."""
+    try:
+        sitemap = sitemaps[section]
+    except KeyError:
+        raise Http404(u"No sitemap available for section: {section!r}".format(
+            section = section,
+        ))
+    if callable(sitemap):
+        sitemap = sitemap()
+    return sitemap
+
+
+def _get_page_number(request):
+    """Returns the sitemap page number requested."""
+    try:
+        page = int(request.GET.get("p", 1))
+    except ValueError:
+        raise Http404("Page is not a number.")
+    if page < 1:
+        raise Http404("Page is not valid.")
+    return page
+
+
+def _create_sitemap_response(content):
+    """Returns a streaming response for the given XML content."""
+    response = StreamingHttpResponse(content, content_type="application/xml")
+    response["X-Robots-Tag"] = "noindex, noodp, noarchive"
+    return response
+
+
+def _serve_prerendered_sitemap(request, name):
+    """
+    Returns a response serving the given pre-rendered sitemap file from
+    storage, or None if the file has not been written.
+    
+    The gzipped version of the file is served to clients that accept it.
+    """
+    storage = get_sitemap_storage()
+    compressed = "gzip" in request.META.get("HTTP_ACCEPT_ENCODING", "")
+    if compressed:
+        name += ".gz"
+    try:
+        sitemap_file = storage.open(name)
+    except (IOError, OSError):
+        return None
+    def render():
+        try:
+            for chunk in sitemap_file.chunks():
+                yield chunk
+        finally:
+            sitemap_file.close()
+    response = _create_sitemap_response(render())
+    if compressed:
+        response["Content-Encoding"] = "gzip"
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+def sitemap_index(request, sitemaps, sitemap_url_name="cms.views.sitemap"):
+    """
+    Renders a sitemap index, listing a page of each sitemap for every 50,000
+    items it contains.
+    
+    If sitemaps are pre-rendered, then the index is served from storage.
+    """
+    if is_prerender_enabled():
+        response = _serve_prerendered_sitemap(request, get_sitemap_file_name())
+        if response is not None:
+            return response
+    protocol = "https" if request.is_secure() else "http"
+    domain = get_current_site(request).domain
+    locations = get_index_locations(sitemaps, domain, protocol, sitemap_url_name)
+    return _create_sitemap_response(render_sitemap_index(locations))
+
+
+def sitemap(request, sitemaps, section=None):
+    """
+    Renders a single page of a sitemap.
+    
+    The sitemap is streamed to the client one chunk of items at a time, so
+    memory use does not depend on the size of the sitemap. If sitemaps are
+    pre-rendered, then the page is served from storage.
+    """
+    if section is None:
+        raise Http404("No sitemap section given.")
+    sitemap = _get_sitemap(sitemaps, section)
+    page = _get_page_number(request)
+    if is_prerender_enabled():
+        response = _serve_prerendered_sitemap(request, get_sitemap_file_name(section, page))
+        if response is not None:
+            return response
+    protocol = "https" if request.is_secure() else "http"
+    domain = get_current_site(request).domain
+    # The response is rendered after the publication middleware has finished,
+    # so the publication state of this request has to be restored.
+    select_published = publication_manager.select_published_active()
+    chunks = sitemap.iter_chunks(page)
+    with publication_manager.select_published(select_published):
+        try:
+            first_chunk = next(chunks, None)
+        except EmptyPage:
+            raise Http404(u"Page {page} empty".format(
+                page = page,
+            ))
+    if first_chunk is None and page > 1:
+        raise Http404(u"Page {page} empty".format(
+            page = page,
+        ))
+    def iter_urls():
+        chunk = first_chunk
+        while chunk is not None:
+            with publication_manager.select_published(select_published):
+                urls = sitemap.get_url_info(chunk, domain, protocol)
+                chunk = next(chunks, None)
+            yield urls
+    return _create_sitemap_response(render_sitemap(iter_urls()))